@@ -7,6 +7,8 @@ import gc
 from bs4 import BeautifulSoup
 
 from util import nios2_as
+import image
+import grader
 from exercises import Exercises
 
 app = application = default_app()
@@ -18,12 +20,12 @@ def post_as():
     asm = request.forms.get("asm")
     obj = nios2_as(asm.encode('utf-8'))
 
-    if not(isinstance(obj, dict)):
+    if not(isinstance(obj, image.Image)):
         return {'prog': 'Error: %s' % obj,
                 'success': False,
                 'code': asm}
 
-    return {'prog': json.dumps(obj),
+    return {'prog': json.dumps(obj.to_json()),
             'success': True,
             'code': asm}
 
@@ -57,15 +59,10 @@ def post_example(eid):
     if ex is None:
         return {'asm_error': 'Exercise ID not found'}
 
-    extra_info = ''
-    res = ex['checker'](asm)
-    if len(res) == 2:
-        success, feedback = res
-    elif len(res) == 3:
-        success, feedback, extra_info = res
-
-    if extra_info is None:
-        extra_info = ''
+    try:
+        success, feedback, extra_info = grader.grade(eid, asm)
+    except grader.Busy:
+        success, feedback, extra_info = False, 'Too many submissions right now, please try again in a minute', ''
 
     return {'eid': eid,
             'exercise_code': asm,
@@ -86,20 +83,10 @@ def post_moodle(eid,uid):
     if ex is None:
         return 'Exercise ID not found'
 
-    # retry
-    for retry in range(5):
-        try:
-            res = ex['checker'](asm)
-            if len(res) == 2:
-                success, feedback = res
-            elif len(res) == 3:
-                success, feedback, _ = res
-            break
-        except OSError as e:
-            print('Retrying, got exception: %s'%e)
-            gc.collect()
-            continue
-
+    try:
+        success, feedback, _ = grader.grade(eid, asm)
+    except grader.Busy:
+        return 'Too many submissions right now, please try again in a minute'
 
     # de-HTML
     soup = BeautifulSoup(feedback, features="html.parser")
@@ -0,0 +1,918 @@
+
+import re
+import struct
+import copy
+import image
+
+# A Nios II assembler and linker for the part of the language the exercises
+# use, in Python. assemble() returns the same object as running
+# nios2-elf-as, then nios2-elf-ld with de10.ld, then elf.elf_to_image(), but
+# without forking either tool.
+#
+# Anything it can't be sure to handle exactly like binutils raises
+# Unsupported, and the caller goes to the real tools instead. This includes
+# every error in the source, so students still get the binutils messages.
+
+class Unsupported(Exception):
+    pass
+
+
+REGS = dict([('r%d' % i, i) for i in range(32)] +
+            [('zero', 0), ('at', 1), ('et', 24), ('bt', 25), ('gp', 26),
+             ('sp', 27), ('fp', 28), ('ea', 29), ('sstatus', 30), ('ba', 30),
+             ('ra', 31)])
+
+CTL_REGS = dict([('ctl%d' % i, i) for i in range(32)] +
+                [('status', 0), ('estatus', 1), ('bstatus', 2), ('ienable', 3),
+                 ('ipending', 4), ('cpuid', 5), ('exception', 7), ('pteaddr', 8),
+                 ('tlbacc', 9), ('tlbmisc', 10), ('eccinj', 11), ('badaddr', 12),
+                 ('config', 13), ('mpubase', 14), ('mpuacc', 15)])
+
+NOP = 0x0001883a
+
+def i_type(op, a, b, imm):
+    return (a << 27) | (b << 22) | ((imm & 0xffff) << 6) | op
+
+def r_type(opx, a, b, c, imm5=0):
+    return (a << 27) | (b << 22) | (c << 17) | (opx << 11) | (imm5 << 6) | 0x3a
+
+def j_type(op, imm26):
+    return ((imm26 & 0x3ffffff) << 6) | op
+
+
+# mnemonic: (form, opcode or opx, extra). The forms are encoded by
+# Assembler.encode(); pseudo-instructions name the instruction they become.
+INSNS = {}
+
+for _mn, _opx in [('add', 0x31), ('sub', 0x39), ('and', 0x0e), ('or', 0x16),
+                  ('xor', 0x1e), ('nor', 0x06), ('mul', 0x27), ('div', 0x25),
+                  ('divu', 0x24), ('mulxss', 0x1f), ('mulxsu', 0x17),
+                  ('mulxuu', 0x07), ('sll', 0x13), ('srl', 0x1b), ('sra', 0x3b),
+                  ('rol', 0x03), ('ror', 0x0b), ('cmpeq', 0x20), ('cmpne', 0x18),
+                  ('cmpge', 0x08), ('cmpgeu', 0x28), ('cmplt', 0x10),
+                  ('cmpltu', 0x30)]:
+    INSNS[_mn] = ('rrr', _opx, False)
+# rC, rA, rB with rA and rB swapped
+for _mn, _opx in [('cmpgt', 0x10), ('cmple', 0x08), ('cmpgtu', 0x30), ('cmpleu', 0x28)]:
+    INSNS[_mn] = ('rrr', _opx, True)
+for _mn, _opx in [('slli', 0x12), ('srli', 0x1a), ('srai', 0x3a), ('roli', 0x02)]:
+    INSNS[_mn] = ('shift', _opx, None)
+# rB, rA, IMM16 (signed or unsigned), plus 1 for the pseudo-instructions
+for _mn, _op in [('addi', 0x04), ('muli', 0x24), ('cmpgei', 0x08), ('cmplti', 0x10),
+                 ('cmpnei', 0x18), ('cmpeqi', 0x20)]:
+    INSNS[_mn] = ('imm', _op, ('s16', 0))
+for _mn, _op in [('andi', 0x0c), ('ori', 0x14), ('xori', 0x1c), ('andhi', 0x2c),
+                 ('orhi', 0x34), ('xorhi', 0x3c), ('cmpgeui', 0x28), ('cmpltui', 0x30)]:
+    INSNS[_mn] = ('imm', _op, ('u16', 0))
+for _mn, _op, _kind in [('cmpgti', 0x08, 's16'), ('cmplei', 0x10, 's16'),
+                        ('cmpgtui', 0x28, 'u16'), ('cmpleui', 0x30, 'u16')]:
+    INSNS[_mn] = ('imm', _op, (_kind, 1))
+for _mn, _op in [('ldb', 0x07), ('ldbu', 0x03), ('ldh', 0x0f), ('ldhu', 0x0b),
+                 ('ldw', 0x17), ('stb', 0x05), ('sth', 0x0d), ('stw', 0x15),
+                 ('ldbio', 0x27), ('ldbuio', 0x23), ('ldhio', 0x2f), ('ldhuio', 0x2b),
+                 ('ldwio', 0x37), ('stbio', 0x25), ('sthio', 0x2d), ('stwio', 0x35)]:
+    INSNS[_mn] = ('mem', _op, None)
+for _mn, _op in [('beq', 0x26), ('bne', 0x1e), ('bge', 0x0e), ('bgeu', 0x2e),
+                 ('blt', 0x16), ('bltu', 0x36)]:
+    INSNS[_mn] = ('branch', _op, False)
+for _mn, _op in [('bgt', 0x16), ('ble', 0x0e), ('bgtu', 0x36), ('bleu', 0x2e)]:
+    INSNS[_mn] = ('branch', _op, True)
+INSNS.update({
+    'br': ('br', 0x06, None),
+    'call': ('call', 0x00, None),
+    'jmpi': ('call', 0x01, None),
+    'jmp': ('jump', 0x0d, 0),
+    'callr': ('jump', 0x1d, 31),
+    'ret': ('fixed', 0xf800283a, None),
+    'eret': ('fixed', 0xef80083a, None),
+    'nop': ('fixed', NOP, None),
+    'break': ('trap', 0x34, 30),
+    'trap': ('trap', 0x2d, 29),
+    'nextpc': ('nextpc', 0x1c, None),
+    'rdctl': ('rdctl', 0x26, None),
+    'wrctl': ('wrctl', 0x2e, None),
+    'mov': ('mov', 0x31, None),
+    'movi': ('movi', 0x04, 's16'),
+    'movui': ('movi', 0x14, 'u16'),
+    'movhi': ('movi', 0x34, 'u16'),
+    'movia': ('movia', None, None),
+    'subi': ('subi', 0x04, None),
+})
+
+
+# Where de10.ld puts the sections it knows: a fixed address, or None to
+# follow the previous one. Any other section is an orphan to ld.
+LAYOUT = [('.reset', 0x00), ('.exceptions', 0x20), ('.text', None), ('.data', None)]
+
+# gas' expression operators, by precedence (all left-associative)
+BINARY_OPS = {'*': 3, '/': 3, '%': 3, '<<': 3, '>>': 3,
+              '|': 2, '&': 2, '^': 2,
+              '+': 1, '-': 1}
+
+TOKEN_RE = re.compile(r'\s*(?:(0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)(?![\w.$])'
+                      r'|([A-Za-z_.][\w.]*)(?![$])|(<<|>>|[-+*/%|&^~()]))', re.ASCII)
+SYMBOL_RE = re.compile(r'[A-Za-z_.][\w.]*\Z', re.ASCII)
+LABEL_RE = re.compile(r'\s*([A-Za-z_.][\w.]*)\s*:', re.ASCII)
+EQUALS_RE = re.compile(r'([A-Za-z_.][\w.]*)\s*=(?!=)(.*)', re.ASCII)
+RELOC_RE = re.compile(r'\s*%(lo|hi|hiadj)\((.*)\)\s*\Z', re.ASCII)
+MEM_RE = re.compile(r'(.*)\(\s*(\w+)\s*\)\s*\Z', re.ASCII)
+REPT_RE = re.compile(r'\s*([1-9][0-9]*)\s+\.[a-z]', re.ASCII)
+CODE_RE = re.compile(r'(?:[^"#]|"(?:[^"\\]|\\.)*")*')
+QUOTED_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+NON_PRINTABLE_RE = re.compile(r'[^\t -~]')
+UNSUPPORTED_RE = re.compile(r"[;\\']|/[*/]")
+STRING_RE = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*(,|\Z)')
+ESCAPES = {'n': 10, 't': 9, 'r': 13, 'b': 8, 'f': 12, '\\': 92, '"': 34}
+
+MAX_REPT = 1 << 20      # lines, after expanding .rept
+
+
+class Section(object):
+    def __init__(self, name, code):
+        self.name = name
+        self.code = code        # code sections get padded out to their alignment
+        self.align = 1
+        self.size = 0
+        self.items = []         # (offset, kind, args)
+        self.addr = None
+
+    def need_align(self, align):
+        self.align = max(self.align, align)
+
+    def add(self, kind, args, size):
+        self.items.append((self.size, kind, args))
+        self.size += size
+
+    def copy(self):
+        sec = Section(self.name, self.code)
+        sec.align = self.align
+        sec.size = self.size
+        sec.items = list(self.items)
+        return sec
+
+
+class Assembler(object):
+    def __init__(self):
+        self.sections = {}
+        self.labels = {}        # name: (section, offset)
+        self.order = {}         # label: statement it was defined in
+        self.moved = {}         # label: statement that moved it
+        self.globals = set()
+        self.count = 0          # statements so far
+        self.now = None         # the statement being encoded
+        self.equs = {}          # name: expression
+        self.section = self.get_section('.text', True)
+        # The labels gas might still move onto an alignment: the last ones
+        # defined, and whether only labels (or .global) have come since
+        self.last_labels = []
+        self.fresh = True
+        self.auto_align = True
+        self.ended = False      # after .end
+
+    def get_section(self, name, code):
+        sec = self.sections.get(name)
+        if sec is None:
+            sec = self.sections[name] = Section(name, code)
+        elif sec.code != code:
+            raise Unsupported('section flags changed')
+        return sec
+
+    ###################################################################
+    # Pass 1: statements into sections, and where each label is
+
+    def run(self, lines):
+        self.feed(lines)
+        return self.link()
+
+    # Reads lines (a list, which .rept expands in place) into the sections
+    def feed(self, lines):
+        i = 0
+        while i < len(lines) and not self.ended:
+            self.count += 1
+            stmt = self.statement(lines[i])
+            i += 1
+            if stmt is None:
+                continue
+            name, args = stmt
+            if name == '.rept':
+                self.fresh = False
+                body, end = self.rept_body(lines, i)
+                # Anything after a plain count is the first line repeated
+                m = REPT_RE.match(args)
+                if m is not None:
+                    n = int(m.group(1))
+                    body = [args[m.end(1):]] + body
+                else:
+                    n = self.absolute(args)
+                if n < 0 or n*len(body) + len(lines) > MAX_REPT:
+                    raise Unsupported('.rept count')
+                lines[i:end + 1] = body*n
+            elif name == '.end':
+                self.ended = True
+            elif name.startswith('.'):
+                self.directive(name, args)
+            else:
+                self.instruction(name, args)
+
+    # An independent copy of what's been read so far
+    def copy(self):
+        new = copy.copy(self)
+        secs = dict([(id(sec), sec.copy()) for sec in self.sections.values()])
+        new.sections = dict([(name, secs[id(sec)]) for name, sec in self.sections.items()])
+        new.section = secs[id(self.section)]
+        new.labels = dict([(name, (secs[id(sec)], off))
+                           for name, (sec, off) in self.labels.items()])
+        new.order = dict(self.order)
+        new.moved = dict(self.moved)
+        new.globals = set(self.globals)
+        new.equs = dict(self.equs)
+        new.last_labels = list(self.last_labels)
+        return new
+
+    # Strips the comment and labels off a line, defining the labels, and
+    # returns (mnemonic or directive, operands) or None
+    def statement(self, text):
+        code = self.strip_comment(text)
+        while True:
+            m = LABEL_RE.match(code)
+            if m is None:
+                break
+            self.define(m.group(1))
+            self.labels[m.group(1)] = (self.section, self.section.size)
+            self.order[m.group(1)] = self.count
+            if not self.fresh:
+                self.last_labels = []
+                self.fresh = True
+            self.last_labels.append(m.group(1))
+            code = code[m.end():]
+        code = code.strip()
+        if not code:
+            return None
+        m = EQUALS_RE.match(code)
+        if m is not None:
+            return ('.equ', '%s, %s' % (m.group(1), m.group(2)))
+        parts = code.split(None, 1)
+        return (parts[0], parts[1] if len(parts) > 1 else '')
+
+    def strip_comment(self, text):
+        m = CODE_RE.match(text)
+        code = m.group(0)
+        if text[m.end():m.end() + 1] == '"':
+            raise Unsupported('unterminated string')
+        # Line separators, macro arguments, character constants, C comments...
+        if NON_PRINTABLE_RE.search(code) or UNSUPPORTED_RE.search(QUOTED_RE.sub('', code)):
+            raise Unsupported('syntax')
+        return code
+
+    def define(self, name):
+        if (name in self.labels or name in self.equs or name in REGS or
+                name in CTL_REGS or name == '.' or name.startswith('.L')):
+            raise Unsupported('symbol %s' % name)
+
+    # The lines up to the matching .endr, and the index of the .endr
+    def rept_body(self, lines, start):
+        depth = 0
+        for j in range(start, len(lines)):
+            stmt = self.directive_name(lines[j])
+            if stmt == '.rept':
+                depth += 1
+            elif stmt == '.endr':
+                if depth == 0:
+                    return lines[start:j], j
+                depth -= 1
+        raise Unsupported('.rept without .endr')
+
+    def directive_name(self, text):
+        code = self.strip_comment(text)
+        while True:
+            m = LABEL_RE.match(code)
+            if m is None:
+                break
+            code = code[m.end():]
+        parts = code.split(None, 1)
+        return parts[0] if parts else None
+
+    def directive(self, name, args):
+        sec = self.section
+        start = sec.size
+        if name in ('.text', '.data'):
+            if args.strip():
+                raise Unsupported('subsection')
+            self.section = self.get_section(name, name == '.text')
+        elif name == '.section':
+            self.section = self.section_directive(args)
+        elif name in ('.global', '.globl'):
+            for sym in split_operands(args):
+                if not SYMBOL_RE.match(sym):
+                    raise Unsupported('.global %s' % sym)
+                self.globals.add(sym)
+        elif name in ('.equ', '.set'):
+            ops = split_operands(args)
+            if len(ops) != 2 or not SYMBOL_RE.match(ops[0]):
+                raise Unsupported(name)
+            self.define(ops[0])
+            self.equs[ops[0]] = ops[1]
+        elif name in ('.word', '.hword', '.byte'):
+            size = {'.word': 4, '.hword': 2, '.byte': 1}[name]
+            ops = split_operands(args)
+            if not ops:
+                raise Unsupported('empty %s' % name)
+            # gas pads these onto their alignment, leaving labels before
+            # the padding. In code it doesn't always.
+            pad = -sec.size % size
+            if pad and (sec.code or not self.auto_align):
+                raise Unsupported('unaligned %s' % name)
+            sec.add('bytes', bytes(pad), pad)
+            sec.need_align(size)
+            sec.add(name, (ops, self.count), size*len(ops))
+        elif name in ('.ascii', '.asciz', '.string'):
+            data = parse_strings(args, name != '.ascii')
+            sec.add('bytes', data, len(data))
+        elif name in ('.skip', '.space'):
+            ops = split_operands(args)
+            if len(ops) not in (1, 2):
+                raise Unsupported(name)
+            n = self.absolute(ops[0])
+            fill = self.absolute(ops[1]) if len(ops) == 2 else 0
+            if n < 0 or n > 1 << 26 or not 0 <= fill <= 0xff:
+                raise Unsupported(name)
+            sec.add('bytes', bytes([fill])*n, n)
+        elif name == '.align':
+            ops = split_operands(args)
+            if len(ops) != 1:
+                raise Unsupported('.align fill')
+            n = self.absolute(ops[0])
+            if not 0 <= n <= 15:
+                raise Unsupported('.align %d' % n)
+            if n == 0:
+                # Turns off gas' automatic alignment
+                self.auto_align = False
+                return
+            pad = -sec.size % (1 << n)
+            sec.need_align(1 << n)
+            if not sec.code:
+                sec.add('bytes', bytes(pad), pad)
+            elif pad:
+                # Code is padded with nops, and the labels just before
+                # move past the padding. Other padding depends on how gas
+                # saw the section's alignment so far.
+                if pad % 4:
+                    raise Unsupported('code alignment padding')
+                moved = self.labels_here(sec)
+                if [l for l, (ls, off) in self.labels.items()
+                        if ls is sec and off == sec.size and l not in moved]:
+                    raise Unsupported('labels moved by gas')
+                sec.add('bytes', struct.pack('<I', NOP)*(pad // 4), pad)
+                for label in moved:
+                    self.labels[label] = (sec, sec.size)
+                    self.moved[label] = self.count
+            self.last_labels = []
+        else:
+            raise Unsupported('directive %s' % name)
+
+        # Emitting data or switching sections leaves the labels where they
+        # are. gas may or may not move them past anything else.
+        if sec.size != start or self.section is not sec:
+            self.last_labels = []
+        elif name not in ('.global', '.globl', '.align'):
+            self.fresh = False
+
+    # .section name, "flags": only those de10.ld places
+    def section_directive(self, args):
+        ops = split_operands(args)
+        name = ops[0] if ops else ''
+        if name in ('.text', '.data') and len(ops) == 1:
+            return self.get_section(name, name == '.text')
+        if name not in ('.reset', '.exceptions') or len(ops) not in (2, 3):
+            raise Unsupported('section %s' % args)
+        flags = ops[1]
+        if not re.match(r'"[awx]*"\Z', flags) or 'a' not in flags:
+            raise Unsupported('section flags %s' % flags)
+        if len(ops) == 3 and ops[2] not in ('@progbits', '%progbits'):
+            raise Unsupported('section type %s' % ops[2])
+        return self.get_section(name, 'x' in flags)
+
+    def instruction(self, mn, args):
+        if mn not in INSNS:
+            raise Unsupported('instruction %s' % mn)
+        sec = self.section
+        # gas doesn't always align these either
+        if sec.size % 4:
+            raise Unsupported('unaligned instruction')
+        self.last_labels = []
+        sec.need_align(4)
+        sec.add('insn', (mn, split_operands(args), self.count), 8 if mn == 'movia' else 4)
+
+    # The last labels, if they're in sec, as long as nothing but labels
+    # came after them (otherwise where gas puts them is harder to say)
+    def labels_here(self, sec):
+        here = [l for l in self.last_labels if self.labels[l][0] is sec]
+        if here and not self.fresh:
+            raise Unsupported('label %s moved by gas' % here[0])
+        return here
+
+    ###################################################################
+    # Expressions: values are (section, offset), with section None for
+    # absolute values
+
+    # Evaluates an expression that has to be known in pass 1, from the
+    # .equ symbols defined so far
+    def absolute(self, text):
+        sec, val = self.evaluate(text, True)
+        if sec is not None:
+            raise Unsupported('relocatable value in %s' % text)
+        return val
+
+    def evaluate(self, text, pass1=False, depth=0):
+        if depth == 0:
+            self.forward = self.difference = False
+        tokens = tokenize(text)
+        val, pos = self.expr(tokens, 0, 1, pass1, depth)
+        if pos != len(tokens):
+            raise Unsupported('expression %s' % text)
+        # gas gets the difference of labels wrong in some places (%lo() of
+        # it, say) when they're only defined further down
+        if self.forward and self.difference:
+            raise Unsupported('difference of labels defined later')
+        return val
+
+    def expr(self, tokens, pos, level, pass1, depth):
+        lhs, pos = self.operand(tokens, pos, pass1, depth)
+        while pos < len(tokens) and BINARY_OPS.get(tokens[pos]) is not None:
+            op = tokens[pos]
+            prec = BINARY_OPS[op]
+            if prec < level:
+                break
+            rhs, pos = self.expr(tokens, pos + 1, prec + 1, pass1, depth)
+            if op == '-' and lhs[0] is not None and rhs[0] is not None:
+                self.difference = True
+            lhs = binary(op, lhs, rhs)
+        return lhs, pos
+
+    def operand(self, tokens, pos, pass1, depth):
+        if pos >= len(tokens):
+            raise Unsupported('missing operand')
+        tok = tokens[pos]
+        if isinstance(tok, int):
+            return (None, tok), pos + 1
+        if tok == '(':
+            val, pos = self.expr(tokens, pos + 1, 1, pass1, depth)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise Unsupported('parentheses')
+            return val, pos + 1
+        if tok in ('-', '~', '+'):
+            (sec, val), pos = self.operand(tokens, pos + 1, pass1, depth)
+            if sec is not None:
+                raise Unsupported('unary %s of a label' % tok)
+            return (None, {'-': -val, '~': ~val, '+': val}[tok]), pos
+        if tok in BINARY_OPS or tok == ')':
+            raise Unsupported('operator %s' % tok)
+        return self.symbol(tok, pass1, depth), pos + 1
+
+    def symbol(self, name, pass1, depth):
+        if name in REGS or name in CTL_REGS or name == '.':
+            raise Unsupported('register %s in expression' % name)
+        if name in self.equs:
+            if depth > 32:
+                raise Unsupported('.equ %s refers to itself' % name)
+            val = self.evaluate(self.equs[name], pass1, depth + 1)
+            if val[0] is not None:
+                raise Unsupported('.equ %s of a label' % name)
+            return val
+        if name in self.labels and not pass1:
+            sec, off = self.labels[name]
+            if sec.addr is None:
+                raise Unsupported('%s is in a discarded section' % name)
+            if self.now is not None and self.order[name] >= self.now:
+                self.forward = True
+                # gas would use where the label was before it moved
+                if self.moved.get(name, 0) >= self.now:
+                    raise Unsupported('%s moved after being used' % name)
+            return (sec, off)
+        raise Unsupported('symbol %s' % name)
+
+    # The final value of an expression: an address for a label
+    def value(self, text):
+        sec, val = self.evaluate(text)
+        return val if sec is None else sec.addr + val
+
+    def is_label(self, text):
+        return self.evaluate(text)[0] is not None
+
+    ###################################################################
+    # Linking: place the sections like de10.ld, then encode
+
+    def link(self):
+        for name, sec in self.sections.items():
+            if name not in dict(LAYOUT):
+                raise Unsupported('section %s' % name)
+            if sec.code:
+                sec.size += -sec.size % sec.align
+        # ld keeps global labels of empty sections, somewhere
+        for name in self.globals:
+            if name in self.labels and self.labels[name][0].size == 0:
+                raise Unsupported('global %s in an empty section' % name)
+
+        placed = []
+        dot = 0
+        for name, addr in LAYOUT:
+            sec = self.sections.get(name)
+            if sec is None or sec.size == 0:
+                continue
+            if addr is None:
+                addr = dot + (-dot % sec.align)
+            elif addr < dot or addr % sec.align:
+                raise Unsupported('%s overlaps' % name)
+            sec.addr = addr
+            dot = addr + sec.size
+            placed.append(sec)
+
+        # Every .equ goes in the symbol table (unless there's nothing to
+        # load, then ld leaves the table out), so they all have to evaluate
+        symtab = {}
+        for name in self.equs:
+            symtab[name] = [self.value(name) & 0xffffffff, 0, 'notype', None]
+        for name, (sec, off) in self.labels.items():
+            if sec.addr is not None:
+                symtab[name] = [sec.addr + off, 0, 'notype', sec.name]
+        if not placed:
+            return image.Image([], {})
+        image.section_labels(symtab, [(sec.name, sec.addr) for sec in placed])
+
+        # ld puts it all in one segment
+        start = placed[0].addr
+        out = bytearray(dot - start)
+        flags = image.PF_R
+        for sec in placed:
+            flags |= image.PF_X if sec.code else image.PF_W
+            for off, kind, args in sec.items:
+                self.now = args[-1] if kind != 'bytes' else None
+                data = self.emit(sec, off, kind, args)
+                out[sec.addr - start + off:sec.addr - start + off + len(data)] = data
+        return image.Image(image.sections(start, dot - start, flags, bytes(out)), symtab)
+
+    def emit(self, sec, off, kind, args):
+        if kind == 'bytes':
+            return args
+        if kind == 'insn':
+            mn, ops, _ = args
+            words = self.encode(mn, ops, sec.addr + off)
+            return struct.pack('<%dI' % len(words), *words)
+        out = b''
+        for op in args[0]:
+            if kind == '.word':
+                v = self.value(op)
+                check_range(v, -(1 << 31), (1 << 32) - 1)
+                out += struct.pack('<I', v & 0xffffffff)
+            elif self.is_label(op):
+                raise Unsupported('%s of a label' % kind)
+            elif kind == '.hword':
+                v = self.value(op)
+                check_range(v, -(1 << 15), (1 << 16) - 1)
+                out += struct.pack('<H', v & 0xffff)
+            else:
+                v = self.value(op)
+                check_range(v, -(1 << 7), (1 << 8) - 1)
+                out += struct.pack('<B', v & 0xff)
+        return out
+
+    ###################################################################
+    # Instructions
+
+    def encode(self, mn, ops, pc):
+        form, code, extra = INSNS[mn]
+        if form == 'rrr':
+            c, a, b = self.regs(ops, 3)
+            if extra:
+                a, b = b, a
+            return [r_type(code, a, b, c)]
+        if form == 'shift':
+            self.arity(ops, 3)
+            return [r_type(code, self.reg(ops[1]), 0, self.reg(ops[0]), self.imm5(ops[2]))]
+        if form == 'imm':
+            kind, plus = extra
+            self.arity(ops, 3)
+            imm = self.imm16(ops[2], kind, plus)
+            return [i_type(code, self.reg(ops[1]), self.reg(ops[0]), imm)]
+        if form == 'mem':
+            self.arity(ops, 2)
+            m = MEM_RE.match(ops[1])
+            if m is None:
+                raise Unsupported('memory operand %s' % ops[1])
+            imm = self.imm16(m.group(1), 's16') if m.group(1).strip() else 0
+            return [i_type(code, self.reg(m.group(2)), self.reg(ops[0]), imm)]
+        if form == 'branch':
+            self.arity(ops, 3)
+            a, b = self.reg(ops[0]), self.reg(ops[1])
+            if extra:
+                a, b = b, a
+            return [i_type(code, a, b, self.branch(ops[2], pc))]
+        if form == 'br':
+            self.arity(ops, 1)
+            return [i_type(code, 0, 0, self.branch(ops[0], pc))]
+        if form == 'call':
+            self.arity(ops, 1)
+            if not self.is_label(ops[0]):
+                raise Unsupported('call to an address')
+            target = self.value(ops[0])
+            if target % 4 or (target ^ (pc + 4)) & 0xf0000000:
+                raise Unsupported('call target')
+            return [j_type(code, target >> 2)]
+        if form == 'jump':
+            self.arity(ops, 1)
+            a = self.reg(ops[0])
+            if mn == 'jmp' and a == 31:
+                raise Unsupported('jmp r31')
+            return [r_type(code, a, 0, extra)]
+        if form == 'fixed':
+            self.arity(ops, 0)
+            return [code]
+        if form == 'trap':
+            if len(ops) > 1:
+                raise Unsupported('operands')
+            return [r_type(code, 0, 0, extra, self.imm5(ops[0]) if ops else 0)]
+        if form == 'nextpc':
+            self.arity(ops, 1)
+            return [r_type(code, 0, 0, self.reg(ops[0]))]
+        if form == 'rdctl':
+            self.arity(ops, 2)
+            return [r_type(code, 0, 0, self.reg(ops[0]), self.ctl(ops[1]))]
+        if form == 'wrctl':
+            self.arity(ops, 2)
+            return [r_type(code, self.reg(ops[1]), 0, 0, self.ctl(ops[0]))]
+        if form == 'mov':
+            c, a = self.regs(ops, 2)
+            return [r_type(code, a, 0, c)]
+        if form == 'movi':
+            self.arity(ops, 2)
+            return [i_type(code, 0, self.reg(ops[0]), self.imm16(ops[1], extra))]
+        if form == 'subi':
+            self.arity(ops, 3)
+            if self.is_label(ops[2]):
+                raise Unsupported('subi of a label')
+            imm = -self.value(ops[2])
+            check_range(imm, -(1 << 15), (1 << 15) - 1)
+            return [i_type(code, self.reg(ops[1]), self.reg(ops[0]), imm)]
+        if form == 'movia':
+            self.arity(ops, 2)
+            b = self.reg(ops[0])
+            v = self.value(ops[1])
+            check_range(v, -(1 << 31), (1 << 32) - 1)
+            return [i_type(0x34, 0, b, hiadj(v)), i_type(0x04, b, b, v)]
+        raise Unsupported(mn)
+
+    def arity(self, ops, n):
+        if len(ops) != n:
+            raise Unsupported('operands')
+
+    def regs(self, ops, n):
+        self.arity(ops, n)
+        return [self.reg(op) for op in ops]
+
+    def reg(self, text):
+        text = text.strip()
+        if text not in REGS:
+            raise Unsupported('register %s' % text)
+        return REGS[text]
+
+    def ctl(self, text):
+        text = text.strip()
+        if text not in CTL_REGS:
+            raise Unsupported('control register %s' % text)
+        return CTL_REGS[text]
+
+    def imm5(self, text):
+        if self.is_label(text):
+            raise Unsupported('label as a 5-bit immediate')
+        v = self.value(text)
+        check_range(v, 0, 31)
+        return v
+
+    # A 16-bit immediate, range checked like gas (or ld, for a label)
+    # unless it's a %lo(), %hi() or %hiadj()
+    def imm16(self, text, kind, plus=0):
+        m = RELOC_RE.match(text)
+        if m is not None:
+            if plus:
+                raise Unsupported('relocation in a pseudo-instruction')
+            v = self.value(m.group(2))
+            return {'lo': v, 'hi': v >> 16, 'hiadj': hiadj(v)}[m.group(1)] & 0xffff
+        if plus and self.is_label(text):
+            raise Unsupported('label in a pseudo-instruction')
+        v = self.value(text) + plus
+        if kind == 's16':
+            check_range(v, -(1 << 15), (1 << 15) - 1)
+        else:
+            check_range(v, 0, (1 << 16) - 1)
+        return v
+
+    def branch(self, text, pc):
+        if not self.is_label(text):
+            raise Unsupported('branch to an address')
+        off = self.value(text) - (pc + 4)
+        if off % 4:
+            raise Unsupported('unaligned branch target')
+        # gas would relax branches it can't reach
+        check_range(off, -(1 << 15), (1 << 15) - 1)
+        return off
+
+
+def hiadj(v):
+    return ((v >> 16) + ((v >> 15) & 1)) & 0xffff
+
+def check_range(v, lo, hi):
+    if not lo <= v <= hi:
+        raise Unsupported('%d out of range' % v)
+
+def binary(op, lhs, rhs):
+    (ls, lv), (rs, rv) = lhs, rhs
+    if op == '+' and (ls is None or rs is None):
+        return (ls or rs, lv + rv)
+    if op == '-' and rs is None:
+        return (ls, lv - rv)
+    if op == '-' and ls is rs:
+        return (None, lv - rv)
+    if ls is not None or rs is not None:
+        raise Unsupported('%s of a label' % op)
+    if op in ('/', '%', '>>') and (lv < 0 or rv < 0 or (op != '>>' and rv == 0)):
+        raise Unsupported('%s of a negative number' % op)
+    if op == '<<' and not 0 <= rv < 64:
+        raise Unsupported('shift by %d' % rv)
+    v = {'*': lambda: lv*rv, '/': lambda: lv // rv, '%': lambda: lv % rv,
+         '<<': lambda: lv << rv, '>>': lambda: lv >> rv, '|': lambda: lv | rv,
+         '&': lambda: lv & rv, '^': lambda: lv ^ rv, '+': lambda: lv + rv,
+         '-': lambda: lv - rv}[op]()
+    # gas computes in 64 bits
+    if not -(1 << 63) <= v < (1 << 63):
+        raise Unsupported('overflow')
+    return (None, v)
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if m is None:
+            raise Unsupported('expression %s' % text)
+        num, sym, op = m.groups()
+        if num is not None:
+            if num[:2] in ('0x', '0X'):
+                tokens.append(int(num[2:], 16))
+            elif num[:2] in ('0b', '0B'):
+                tokens.append(int(num[2:], 2))
+            elif num[0] == '0' and len(num) > 1:
+                if '8' in num or '9' in num:
+                    raise Unsupported('octal %s' % num)
+                tokens.append(int(num, 8))
+            else:
+                tokens.append(int(num))
+        else:
+            tokens.append(sym or op)
+        pos = m.end()
+    if not tokens:
+        raise Unsupported('empty expression')
+    return tokens
+
+# Splits operands at commas outside parentheses and strings
+def split_operands(text):
+    if not text.strip():
+        return []
+    ops = []
+    depth = 0
+    start = 0
+    in_string = escape = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            ops.append(text[start:i].strip())
+            start = i + 1
+    ops.append(text[start:].strip())
+    if '' in ops:
+        raise Unsupported('empty operand')
+    return ops
+
+def parse_strings(text, nul):
+    out = bytearray()
+    pos = 0
+    while True:
+        m = STRING_RE.match(text, pos)
+        if m is None:
+            raise Unsupported('string %s' % text)
+        s = m.group(1)
+        i = 0
+        while i < len(s):
+            c = s[i]
+            i += 1
+            if c != '\\':
+                out.append(ord(c))
+            elif s[i] in ESCAPES:
+                out.append(ESCAPES[s[i]])
+                i += 1
+            elif s[i] in '01234567':
+                j = i
+                while j < len(s) and j < i + 3 and s[j] in '01234567':
+                    j += 1
+                v = int(s[i:j], 8)
+                if v > 0xff:
+                    raise Unsupported('escape')
+                out.append(v)
+                i = j
+            else:
+                raise Unsupported('escape \\%s' % s[i])
+        if nul:
+            out.append(0)
+        pos = m.end()
+        if m.group(2) != ',':
+            return bytes(out)
+
+
+def decode(asm):
+    try:
+        return asm.decode('utf-8')
+    except UnicodeDecodeError:
+        raise Unsupported('not UTF-8')
+
+# Assembles and links asm (bytes, as given to util.nios2_as()), raising
+# Unsupported for anything that should go to binutils
+def assemble(asm):
+    return Assembler().run(decode(asm).split('\n'))
+
+
+# Source that goes in front of others (a checker's harness), read once:
+# Prefix(a).assemble(b) returns assemble(a + b), but only reads b.
+class Prefix(object):
+    def __init__(self, asm, state=None):
+        lines = decode(asm).split('\n')
+        # The last line isn't finished until we know what follows
+        self.tail = lines.pop()
+        self.state = state or Assembler()
+        self.state.feed(lines)
+
+    def assemble(self, asm):
+        state = self.state.copy()
+        state.feed((self.tail + decode(asm)).split('\n'))
+        return state.link()
+
+
+# What util.hotpatch() assembles in front of new code: a program's image as
+# .word lines in .text, with its word-aligned labels except _start
+def image_prefix(img):
+    state = Assembler()
+    sec = state.section
+    data = img.flat()
+    for name, addr in img.symbols.items():
+        if name != '_start' and addr % 4 == 0 and addr < len(data):
+            state.define(name)
+            state.labels[name] = (sec, addr)
+            state.order[name] = 0
+    if data:
+        sec.need_align(4)
+        sec.add('bytes', data, len(data))
+    return Prefix(b'', state)
+
+
+# Checks assemble() against binutils on the files given, e.g.
+#   python3 assembler.py tests/*.s
+if __name__ == '__main__':
+    import sys
+    import util
+
+    status = 0
+    for fn in sys.argv[1:]:
+        with open(fn, 'rb') as f:
+            asm = f.read()
+        try:
+            obj = assemble(asm)
+        except Unsupported as e:
+            print('%s: left to binutils (%s)' % (fn, e))
+            continue
+        ref = util.binutils_as(asm)
+        if obj == ref:
+            print('%s: same' % fn)
+            continue
+        status = 1
+        print('%s: DIFFERENT' % fn)
+        if not isinstance(ref, image.Image):
+            print('  binutils: %s' % ref)
+            continue
+        flags = [[sec.flags for sec in img.sections] for img in (obj, ref)]
+        if flags[0] != flags[1]:
+            print('  flags:\n    assembler.py %s\n    binutils     %s' % tuple(flags))
+        obj, ref = obj.to_json(), ref.to_json()
+        for k in ref:
+            if obj[k] != ref[k]:
+                print('  %s:\n    assembler.py %s\n    binutils     %s' % (k, obj[k], ref[k]))
+    sys.exit(status)
@@ -1,14 +1,80 @@
 
 import pynios2
-import numpy as np
 import struct
-from sim import flip_word_endian
-
-
-class Nios2(object):
+from timing import timed
+
+
+# struct formats (little-endian, like the guest) of the kinds of arrays
+# Nios2.write_array()/read_array() know, besides 'bytes'
+array_kinds = {
+    'int32': 'i', 'uint32': 'I',
+    'int16': 'h', 'uint16': 'H',
+    'int8': 'b', 'uint8': 'B',
+}
+
+word = struct.Struct('<I')
+RAM_SIZE = 64*1024*1024     # as in lib/nios2.c
+
+def array_size(kind):
+    if kind == 'bytes':
+        return 1
+    return struct.calcsize(array_kinds[kind])
+
+# Values are truncated to the element size, so signed and unsigned values
+# can both be given
+def pack_array(vals, kind='int32'):
+    if kind == 'bytes':
+        return bytes(vals)
+    fmt = array_kinds[kind].upper()
+    mask = (1 << (8*struct.calcsize(fmt))) - 1
+    return struct.pack('<%d%s' % (len(vals), fmt), *[int(v) & mask for v in vals])
+
+def unpack_array(data, n, kind='int32'):
+    if kind == 'bytes':
+        return bytes(data[:n])
+    return list(struct.unpack_from('<%d%s' % (n, array_kinds[kind]), data))
+
+
+# Results of Nios2.run_batch(), one of each per input set
+class BatchResult(object):
+    def __init__(self, reads, instrs, pcs, regs, errors, mem):
+        self.reads = reads          # [(where, addr, n, kind, word)]
+        self.instrs = instrs        # array of instructions run
+        self.pcs = pcs
+        self.regs = regs            # array, 32 registers per input set
+        self.errors = errors        # '' if none
+        self.mem = mem
+        self.stride = sum([n*array_size(kind) for _, _, n, kind, _ in reads])
+
+    def __len__(self):
+        return len(self.instrs)
+
+    def get_reg(self, i, reg):
+        return self.regs[i*32 + reg]
+
+    def get_pc(self, i):
+        return self.pcs[i]
+
+    def get_error(self, i):
+        return self.errors[i]
+
+    # What input set i left at where, one of the reads given to
+    # run_batch(): an int for a single word, else a list (or bytes)
+    def read(self, i, where):
+        off = i*self.stride
+        for w, addr, n, kind, word in self.reads:
+            size = n*array_size(kind)
+            if w == where:
+                vals = unpack_array(self.mem[off:off + size], n, kind)
+                return vals[0] if word else vals
+            off += size
+        raise KeyError(where)
+
+
+class Nios2(pynios2.CPU):
 
     class MMIO_Reg(object):
-        def __init__(self, init_val=np.uint32(0)):
+        def __init__(self, init_val=0):
             self.val = init_val
         def store(self, val):
             self.val = val
@@ -19,53 +85,38 @@ class Nios2(object):
                 return self.load()
             self.store(val)
 
+    # Native devices, see pynios2.Device
+    Device = pynios2.Device
+    JtagUart = pynios2.JtagUart
+
 
+    # obj is a program image (image.Image), as nios2_as() returns
     def __init__(self, init_mem=b'', start_pc=0, obj=None):
         if obj is not None:
             self.obj = obj
-            self.symbols = obj['symbols']
-            init_mem = flip_word_endian(bytes.fromhex(obj['prog']))
-            start_pc = obj['symbols']['_start']
+            self.symbols = obj.symbols
+            start_pc = obj.symbols['_start']
 
         self.init_mem = init_mem
         self.init_pc = start_pc
 
-        self.c_obj = 0
-        self.reset()
-
-    def __del__(self):
-        pynios2.py_del_nios2(self.c_obj)
-
-    def reset(self):
-        if (self.c_obj != 0):
-            pynios2.py_del_nios2(self.c_obj)
-        self.c_obj = pynios2.py_new_nios2(self.init_mem)
-        self.set_pc(self.init_pc)
+        # Each section goes where it was linked, gaps aren't loaded
+        super().__init__(init_mem, obj.segments() if obj is not None else ())
+        self.breakpoints = set()
+        self.set_pc(start_pc)
 
-    def halt(self):
-        pynios2.py_halt_cpu(self.c_obj)
-
-    def interrupt(self):
-        pynios2.py_interrupt(self.c_obj)
-
-    def get_clobbered(self):
-        return pynios2.py_get_clobbered(self.c_obj)
-
-
-    def get_reg(self, reg):
-        return pynios2.py_get_reg(self.c_obj, reg)
-    def set_reg(self, reg, val):
-        pynios2.py_set_reg(self.c_obj, reg, val)
+    @timed('simulate')
+    def run_until_halted(self, limit=-1):
+        return super().run_until_halted(limit)
 
-    def get_ctl_reg(self, reg):
-        return pynios2.py_get_ctl_reg(self.c_obj, reg)
-    def set_ctl_reg(self, reg, val):
-        pynios2.py_set_ctl_reg(self.c_obj, reg, val)
+    @timed('simulate')
+    def run(self, limit=-1):
+        return super().run(limit)
 
-    def get_pc(self):
-        return pynios2.py_get_pc(self.c_obj)
-    def set_pc(self, val):
-        pynios2.py_set_pc(self.c_obj, val)
+    # Restores the cpu in place
+    def reset(self, clear_mmio=False):
+        super().reset(clear_mmio)
+        self.set_pc(self.init_pc)
 
     def print_regs(self, n_regs=32):
         print(' pc = 0x%08x' % self.get_pc())
@@ -74,17 +125,23 @@ class Nios2(object):
 
 
 
-    # TODO: do this with loadwords...
-    def print_mem(self):
-        pynios2.py_print_mem(self.c_obj)
-
     def dump_mem(self, min_addr, num_bytes):
+        if num_bytes <= 0:
+            return ''
         s = min_addr & 0xfffffffc
+        n_words = (num_bytes + 3) // 4
+        # What's in RAM in one read, anything past it (MMIO...) a word at a
+        # time
+        n_ram = max(0, min(n_words, (RAM_SIZE - s) // 4))
+        words = list(struct.unpack('<%dI' % n_ram, self.read_mem(s, n_ram*4)))
+        for i in range(n_ram, n_words):
+            words.append(self.loadword((s + i*4) & 0xffffffff))
         out = ''
-        for addr in range(s, s+num_bytes, 4):
+        for i, w in enumerate(words):
+            addr = (s + i*4) & 0xffffffff
             if (addr & 0xf) == 0:
                 out += '\n0x%08x: ' % addr
-            out += '%08x  ' % self.loadword(addr)
+            out += '%08x  ' % w
         out += '\n'
         return out
 
@@ -98,33 +155,151 @@ class Nios2(object):
 
 
 
-    def loadword(self, addr):
-        return pynios2.py_loadword(self.c_obj, np.uint32(addr))
-
-    def storeword(self, addr, val):
-        pynios2.py_storeword(self.c_obj, np.uint32(addr), np.uint32(val))
-
     def get_symbol_word(self, symbol, offset=0):
         return self.loadword(self.symbols[symbol] + offset)
 
     def write_symbol_word(self, symbol, val, offset=0):
         self.storeword(self.symbols[symbol] + offset, val)
 
-    def add_mmio(self, addr, cb):
-        pynios2.py_add_mmio(self.c_obj, np.uint32(addr), cb)
-
-    def one_step(self):
-        pynios2.py_one_step(self.c_obj)
-
-    def run_until_halted(self, limit=-1):
-        return pynios2.py_run_until_halted(self.c_obj, limit)
-
-    def get_error(self):
-        err = pynios2.py_get_error(self.c_obj)
-        if err is None:
-            return ''
-        return err
-
+    # Writes a whole array of kind (see array_kinds, or 'bytes') at where,
+    # a symbol or an address, in one call
+    def write_array(self, where, vals, kind='int32', offset=0):
+        self.write_mem(self.addr_of(where) + offset, pack_array(vals, kind))
+
+    # Reads n elements of kind at where back as a list (bytes for 'bytes')
+    def read_array(self, where, n, kind='int32', offset=0):
+        addr = self.addr_of(where) + offset
+        return unpack_array(self.read_mem(addr, n*array_size(kind)), n, kind)
+
+    # Lays out a linked list of vals (int32) at where, one node every
+    # node_size bytes, each node holding a pointer to the next at
+    # next_offset and its value at value_offset. The last next pointer is
+    # 0 (NULL). Other bytes of the nodes are left alone. Returns the
+    # address of the first node.
+    def write_list(self, where, vals, next_offset=0, value_offset=4, node_size=8):
+        addr = self.addr_of(where)
+        if not vals:
+            return addr
+        nodes = bytearray(self.read_mem(addr, len(vals)*node_size))
+        for i, v in enumerate(vals):
+            next_ptr = addr + (i+1)*node_size if i < len(vals)-1 else 0
+            struct.pack_into('<I', nodes, i*node_size + next_offset, next_ptr)
+            struct.pack_into('<I', nodes, i*node_size + value_offset, int(v) & 0xffffffff)
+        self.write_mem(addr, nodes)
+        return addr
+
+    # Follows the list starting at the node at where until a NULL next
+    # pointer (or limit nodes), and returns its values (int32). A pointer
+    # outside of RAM raises ValueError.
+    def read_list(self, where, next_offset=0, value_offset=4, limit=10000):
+        addr = self.addr_of(where)
+        size = max(next_offset, value_offset) + 4
+        vals = []
+        while addr != 0 and len(vals) < limit:
+            node = self.read_mem(addr, size)
+            next_ptr, = struct.unpack_from('<I', node, next_offset)
+            val, = struct.unpack_from('<i', node, value_offset)
+            vals.append(val)
+            addr = next_ptr
+        return vals
+
+    # Breakpoints, by address or symbol. The cpu stops before running the
+    # instruction there (see run_until()).
+    def add_breakpoint(self, where):
+        addr = self.addr_of(where)
+        if not self.set_breakpoint(addr):
+            raise ValueError('Can\'t set a breakpoint at %s' % where)
+        self.breakpoints.add(addr)
+
+    def remove_breakpoint(self, where):
+        addr = self.addr_of(where)
+        self.set_breakpoint(addr, False)
+        self.breakpoints.discard(addr)
+
+    def clear_breakpoints(self):
+        super().clear_breakpoints()
+        self.breakpoints = set()
+
+    def addr_of(self, where):
+        if isinstance(where, str):
+            return self.symbols[where]
+        return where
+
+    # Runs until a breakpoint (including target, an address/symbol or a list
+    # of them), the cpu halts, or limit instructions have run. Unlike
+    # run_until_halted(), reaching the limit isn't an error and the cpu can
+    # be run again from where it stopped. If cond is given, breakpoints
+    # where cond(cpu) is false are run through.
+    #
+    # Returns (reason, instructions run), where reason is one of
+    # 'breakpoint', 'halt', 'limit' or 'error'.
+    @timed('simulate')
+    def run_until(self, target=None, limit=-1, cond=None):
+        if target is None:
+            targets = []
+        elif isinstance(target, (list, tuple)):
+            targets = [self.addr_of(t) for t in target]
+        else:
+            targets = [self.addr_of(target)]
+        targets = [t for t in targets if t not in self.breakpoints]
+        for t in targets:
+            self.set_breakpoint(t)
+
+        total = 0
+        try:
+            while True:
+                reason, n = self.run(-1 if limit == -1 else limit - total)
+                total += n
+                if reason != 'breakpoint' or cond is None or cond(self):
+                    return (reason, total)
+        finally:
+            for t in targets:
+                self.set_breakpoint(t, False)
+
+    # Runs the program over many input sets in one call (see
+    # pynios2.CPU.run_batch()), for the cost of one run each, without
+    # going back to Python in between. inputs is a list of input sets,
+    # each a dict of where (symbol or address) to an int (one word), a list
+    # of int32s, or bytes. reads lists what to read back after each run:
+    # where for one int32 word, or (where, n[, kind]) for an array (see
+    # read_array()). Each run starts from a reset, with MMIO callbacks
+    # left as they are. Returns a BatchResult.
+    @timed('simulate')
+    def run_batch(self, inputs, reads=(), limit=-1):
+        addrs = {}
+        writes = []
+        for inp in inputs:
+            ws = []
+            for where, val in inp.items():
+                if where not in addrs:
+                    addrs[where] = self.addr_of(where)
+                if isinstance(val, int):
+                    val = word.pack(val & 0xffffffff)
+                elif not isinstance(val, (bytes, bytearray, memoryview)):
+                    val = pack_array(val)
+                ws.append((addrs[where], val))
+            writes.append(ws)
+
+        specs = []
+        for r in reads:
+            if isinstance(r, tuple):
+                where, n, kind = (r + ('int32',))[:3]
+                specs.append((where, self.addr_of(where), n, kind, False))
+            else:
+                specs.append((r, self.addr_of(r), 1, 'int32', True))
+
+        instrs, pcs, regs, errors, mem = super().run_batch(self.init_pc, writes,
+                [(addr, n*array_size(kind)) for _, addr, n, kind, _ in specs], limit)
+        return BatchResult(specs, instrs, pcs, regs, errors, mem)
+
+
+
+# Runs independent cpus (e.g. different submissions) to a halt at the same
+# time on threads OS threads, all the cores by default. Returns how many
+# instructions each ran, like run_until_halted().
+@timed('simulate')
+def run_parallel(cpus, limit=-1, threads=0):
+    return pynios2.run_parallel(cpus, limit, threads)
 
 
 def my_cb(arg=None):
@@ -157,11 +332,9 @@ def scope():
 if __name__ == '__main__':
     import sys
     if len(sys.argv) > 1:
-        import json
+        import image
 
-        test_prog = sys.argv[1]
-        obj = json.loads(test_prog)
-        cpu = Nios2(obj=obj)
+        cpu = Nios2(obj=image.load(sys.argv[1]))
         print(cpu.dump_mem(0x00, 0x100))
         n = cpu.run_until_halted(10000)
         print('Ran %d instructions' % n)
@@ -0,0 +1,105 @@
+
+import struct
+from collections import namedtuple
+import image
+
+# Reads the ELF32 executables nios2-elf-ld makes: their loadable segments
+# and symbol table, without going through objdump.
+
+class ElfError(Exception):
+    pass
+
+Segment = namedtuple('Segment', ['addr', 'memsz', 'flags', 'data'])
+Section = namedtuple('Section', ['name', 'type', 'addr', 'offset', 'size', 'link', 'entsize'])
+Symbol = namedtuple('Symbol', ['name', 'addr', 'size', 'type', 'bind', 'section'])
+
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHN_UNDEF = 0
+SHN_ABS = 0xfff1
+
+SYM_TYPES = {0: 'notype', 1: 'object', 2: 'func', 3: 'section', 4: 'file'}
+SYM_BINDS = {0: 'local', 1: 'global', 2: 'weak'}
+
+
+class Elf(object):
+    def __init__(self, data):
+        self.data = data
+        if data[:4] != b'\x7fELF':
+            raise ElfError('Not an ELF file')
+        if data[4] != 1 or data[5] != 1:
+            raise ElfError('Not a little-endian ELF32 file')
+
+        (self.type, self.machine, _, self.entry, phoff, shoff, _, _,
+         phentsize, phnum, shentsize, shnum, shstrndx) = self.unpack('<HHIIIIIHHHHHH', 16)
+
+        self.segments = []
+        for i in range(phnum):
+            p_type, offset, vaddr, paddr, filesz, memsz, flags, align = \
+                    self.unpack('<8I', phoff + i*phentsize)
+            if p_type == PT_LOAD:
+                self.segments.append(Segment(vaddr, memsz, flags,
+                                             bytes(data[offset:offset + filesz])))
+
+        raw = [self.unpack('<10I', shoff + i*shentsize) for i in range(shnum)]
+        names = raw[shstrndx] if shstrndx < shnum else None
+        self.sections = []
+        for name, sh_type, flags, addr, offset, size, link, info, align, entsize in raw:
+            if names is not None:
+                name = self.string(names[4], name)
+            self.sections.append(Section(name, sh_type, addr, offset, size, link, entsize))
+
+        self.symbols = []
+        for sec in self.sections:
+            if sec.type == SHT_SYMTAB:
+                self.read_symbols(sec)
+
+    def unpack(self, fmt, offset):
+        try:
+            return struct.unpack_from(fmt, self.data, offset)
+        except struct.error:
+            raise ElfError('Truncated ELF file')
+
+    # NUL-terminated string at offset in a string table section
+    def string(self, table_offset, offset):
+        start = table_offset + offset
+        end = self.data.find(b'\x00', start)
+        if end < 0:
+            raise ElfError('Bad string table')
+        return self.data[start:end].decode('utf-8', 'replace')
+
+    def read_symbols(self, sec):
+        strtab = self.sections[sec.link].offset
+        for off in range(sec.offset, sec.offset + sec.size, sec.entsize or 16):
+            name, value, size, info, other, shndx = self.unpack('<IIIBBH', off)
+            if shndx == SHN_UNDEF:
+                continue
+            if shndx == SHN_ABS:
+                section = None
+            elif shndx < len(self.sections):
+                section = self.sections[shndx].name
+            else:
+                continue
+            self.symbols.append(Symbol(self.string(strtab, name), value, size,
+                                       SYM_TYPES.get(info & 0xf, info & 0xf),
+                                       SYM_BINDS.get(info >> 4, info >> 4), section))
+
+
+def read_elf(path):
+    with open(path, 'rb') as f:
+        return Elf(f.read())
+
+
+# The program image (see image.Image) of an executable: its loadable
+# segments, and every defined symbol but file ones. Sections are only
+# labelled where nothing else is (see image.section_labels()).
+def elf_to_image(elf):
+    sizes = dict([(sec.name, sec.size) for sec in elf.sections])
+    symtab = {s.name: [s.addr, s.size, s.type, s.section] for s in elf.symbols
+              if s.type not in ('section', 'file')}
+    starts = [(s.section, s.addr) for s in elf.symbols
+              if s.type == 'section' and sizes.get(s.section)]
+    return image.Image([sec for s in elf.segments
+                        for sec in image.sections(s.addr, s.memsz, s.flags, s.data)],
+                       image.section_labels(symtab, starts))
@@ -2,11 +2,8 @@
 from exercises import *
 import struct
 
-##########
-# caller-saved
-def check_caller_saved(asm):
-    # Need to insert a _start symbol
-    new_start = '''.text
+# Assembled once, each submission is linked after it
+harness = Harness('''.text
     test_A:  .word 12
     test_B:  .word 42
     test_C:  .word 3
@@ -57,9 +54,14 @@ def check_caller_saved(asm):
         call    op_four
 
         break
-    '''
-    hp = new_start + asm    # asm.replace('roll:', '_roll:') hmm..
-    nobj = nios2_as(hp.encode('utf-8'))
+    ''')
+
+
+##########
+# caller-saved
+def check_caller_saved(asm):
+    # Need to insert a _start symbol
+    nobj = harness.assemble(asm)
     r = require_symbols(nobj, ['op_four', '_start'])
     if r is not None:
         return (False, r)
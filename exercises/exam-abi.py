@@ -4,11 +4,8 @@ import numpy as np
 import struct
 import math
 
-##########
-# callee-saved
-def check_exam_abi(asm):
-    # Need to insert a _start symbol
-    new_start = '''.text
+# Assembled once, each submission is linked after it
+harness = Harness('''.text
     sqrt:
         # check that they didn't save too much to the stack...
         #movia   r2, 0x04000000 - 4 - 12     # ra, r16, r18
@@ -46,9 +43,14 @@ def check_exam_abi(asm):
         call    dist
 
         break
-    '''
-    hp = new_start + asm
-    nobj = nios2_as(hp.encode('utf-8'))
+    ''')
+
+
+##########
+# callee-saved
+def check_exam_abi(asm):
+    # Need to insert a _start symbol
+    nobj = harness.assemble(asm)
     r = require_symbols(nobj, ['dist', '_start'])
     if r is not None:
         return (False, r)
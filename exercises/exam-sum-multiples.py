@@ -17,8 +17,7 @@ def check_multiples(asm, test_cases, test_start_idx=1):
 
         # Reset and initialize
         cpu.reset()
-        for i, val in enumerate(arr):
-            cpu.write_symbol_word('ARR', np.uint32(val), offset=i*4)
+        cpu.write_array('ARR', arr)
         cpu.write_symbol_word('N', len(arr))
 
         # Run
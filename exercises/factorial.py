@@ -1,10 +1,8 @@
 
 from exercises import *
 
-############
-# Fib
-def check_factorial(asm):
-    new_start = '''.text
+# Assembled once, each submission is linked after it
+harness = Harness('''.text
     TEST_N: .word 3
     _start:
         movia   sp, 0x04000000
@@ -24,9 +22,13 @@ def check_factorial(asm):
         ldw     r4, 0(r4)
         call    factorial
         break
-    '''
-    hp = new_start + asm    # asm.replace('roll:', '_roll:') hmm..
-    nobj = nios2_as(hp.encode('utf-8'))
+    ''')
+
+
+############
+# Fib
+def check_factorial(asm):
+    nobj = harness.assemble(asm)
     cpu = Nios2(obj=nobj)
 
     tests = [(3, 6), (5, 120), (10, 3628800), (12, 479001600)]
@@ -2,10 +2,8 @@
 #from exercises import Exercises
 from exercises import *
 
-##########
-# Set the LEDs to all on
-def check_interrupt_setup(asm):
-    new_asm = '''
+# Assembled once, each submission is linked after it
+harness = Harness('''
     .section .reset, "ax"
         br      _start
 
@@ -27,11 +25,13 @@ def check_interrupt_setup(asm):
         ldw     r4, 0(sp)
         addi    sp, sp, 16
         eret
-    '''
+    ''')
 
 
-    hp = new_asm + asm    # asm.replace('roll:', '_roll:') hmm..
-    nobj = nios2_as(hp.encode('utf-8'))
+##########
+# Set the LEDs to all on
+def check_interrupt_setup(asm):
+    nobj = harness.assemble(asm)
     r = require_symbols(nobj, ['_start'])
     if r is not None:
         return (False, r)
@@ -49,7 +49,6 @@ def check_interrupt_setup(asm):
                 self.imask = val
             return 0
         def nop(self, val=None):
-            cpu.halt()
             return 0
 
         def data(self, val=None):
@@ -67,16 +66,15 @@ def check_interrupt_setup(asm):
     cpu.add_mmio(0xFF20110c, device.nop)
     cpu.add_mmio(0x13371337, device.winner)
 
-    # Run for a bit
-    for i in range(1000):
-        cpu.one_step()
-
-    # setup an interrupt
-    if device.imask == 1:
-        cpu.set_ctl_reg(4, 1<<3)    # ipending = enable IRQ3
+    # Run for a bit, then setup an interrupt
+    def raise_irq():
+        if device.imask == 1:
+            cpu.set_ctl_reg(4, 1<<3)    # ipending = enable IRQ3
+    cpu.schedule(1000, raise_irq)
 
-    for i in range(1000):
-        cpu.one_step()
+    # Running out of instructions is expected (it ends in a busy loop), not
+    # an error to report
+    cpu.run(2000)
 
     if not(device.passed) or len(cpu.get_clobbered())>0:
         feedback = 'Interrupt did not occur<br/>\n<br/>\n' 
@@ -16,21 +16,12 @@ def check_list_sum(asm):
              ([1, 0, 4], 5),
              ([-1, 2, 15, 8, 6], 30)]
 
-    head_addr = obj['symbols']['HEAD']
-
     feedback = ''
 
     cur_test = 1
     for tc,ans in tests:
         cpu.reset()
-        for ii,n in enumerate(tc):
-
-            next_ptr = head_addr + (ii+1)*8
-            if ii == len(tc)-1:
-                # Last element, write null for pointer
-                next_ptr = 0
-            cpu.storeword(head_addr+ii*8, next_ptr)
-            cpu.storeword(head_addr+ii*8+4, np.uint32(n))
+        cpu.write_list('HEAD', tc)
 
         instrs = cpu.run_until_halted(1000000)
 
@@ -7,43 +7,6 @@ def check_proj1(asm):
     obj = nios2_as(asm.encode('utf-8'))
     cpu = Nios2(obj=obj)
 
-    class p1grader(object):
-        def __init__(self, test_cases=[]):
-            # Array of (sw_val, expected_led_val)
-            self.test_cases = test_cases
-            self.cur_test = 0
-            self.feedback = ''
-            self.num_passed = 0
-
-        def write_led(self, val):
-            # Assert correct answer
-            sw, expected = self.test_cases[self.cur_test]
-            if val != expected: # Check that they wrote to LEDs exactly
-                if (val&0x3ff) != expected: # only warn if the LEDs would have masked for them..
-
-                    self.feedback += 'Failed test case %d: ' % (self.cur_test+1)
-                    self.feedback += 'LEDs set to %s (should be %s) for SW %s' % \
-                                (bin(val&0x3ff), bin(expected), bin(sw))
-                    self.feedback += get_debug(cpu)
-                    cpu.halt()
-                    return
-                self.feedback += 'Test case %d: ' %(self.cur_test+1)
-                self.feedback += 'Warning: wrote 0x%08x (instead of 0x%08x) to LEDs for SW %s;' %\
-                                (val, expected, bin(sw))
-                self.feedback += ' upper bits ignored.\n'
-            self.feedback += 'Passed test case %d<br/>\n' % (self.cur_test+1)
-            self.cur_test += 1
-            self.num_passed += 1
-            if self.cur_test >= len(self.test_cases):
-                cpu.halt()
-
-        def read_sw(self):
-            if self.cur_test > len(self.test_cases):
-                print('Error: read_sw after we should have halted?')
-                return 0    # ??
-            sw, led = self.test_cases[self.cur_test]
-            return sw
-
     tests = [(0, 0),
             (0b0000100001, 2),
             (0b0001100010, 5),
@@ -52,20 +15,51 @@ def check_proj1(asm):
             (0b1111011111, 61),
             (0b0000111111, 32)]
 
-    p1 = p1grader(tests)
-
-    cpu.add_mmio(0xFF200000, p1.write_led)
-    cpu.add_mmio(0xFF200040, p1.read_sw)
-
-    #cpu.mmios[0xFF200000] = p1.write_led
-    #cpu.mmios[0xFF200040] = p1.read_sw
-
-    instrs = cpu.run_until_halted(10000)
-
-    print('Passed %d of %d' % (p1.num_passed, len(tests)))
+    # Switches and LEDs are simulated in C, so the polling loop runs without
+    # calling back into Python. The LEDs halt the cpu after every write, so
+    # we can check it and set the switches for the next test case.
+    sw = cpu.add_const(0xFF200040, 0)
+    leds = cpu.add_log_reg(0xFF200000, halt_after=1)
+
+    # One instruction budget for all the test cases, as a single run had
+    limit = 10000
+    feedback = ''
+    num_passed = 0
+    instrs = 0
+    for i, (sw_val, expected) in enumerate(tests):
+        sw.store(sw_val)
+        cpu.resume()
+        reason, n = cpu.run(limit - instrs)
+        instrs += n
+
+        writes = leds.log()
+        if len(writes) <= i:
+            # Halted for some other reason (error, instruction limit)
+            break
+
+        # Assert correct answer
+        val = writes[i]
+        if val != expected: # Check that they wrote to LEDs exactly
+            if (val&0x3ff) != expected: # only warn if the LEDs would have masked for them..
+
+                feedback += 'Failed test case %d: ' % (i+1)
+                feedback += 'LEDs set to %s (should be %s) for SW %s' % \
+                            (bin(val&0x3ff), bin(expected), bin(sw_val))
+                feedback += get_debug(cpu)
+                break
+            feedback += 'Test case %d: ' %(i+1)
+            feedback += 'Warning: wrote 0x%08x (instead of 0x%08x) to LEDs for SW %s;' %\
+                            (val, expected, bin(sw_val))
+            feedback += ' upper bits ignored.\n'
+        feedback += 'Passed test case %d<br/>\n' % (i+1)
+        num_passed += 1
+
+    print('Passed %d of %d' % (num_passed, len(tests)))
     err = cpu.get_error()
+    if reason == 'limit':
+        err += 'Instruction limit reached: %d\n' % limit
     del cpu
-    return (p1.num_passed==len(tests), err + p1.feedback)
+    return (num_passed==len(tests), err + feedback)
 
 Exercises.addExercise('proj1',
     {
@@ -1,7 +1,7 @@
 from exercises import *
 
-def check_roll_dice(asm):
-    new_start = '''.text
+# Assembled once, each submission is linked after it
+harness = Harness('''.text
     .equ    ROLL_MMIO, 0x13370000
     TEST_N: .word 3
     roll:
@@ -40,10 +40,11 @@ def check_roll_dice(asm):
         ldw     r4, 0(r4)
         call    sum_dice
         break
-    '''
-    #nobj = hotpatch(obj, new_start)
-    hp = new_start + asm    # asm.replace('roll:', '_roll:') hmm..
-    nobj = nios2_as(hp.encode('utf-8'))
+    ''')
+
+
+def check_roll_dice(asm):
+    nobj = harness.assemble(asm)
     r = require_symbols(nobj, ['TEST_N', '_start'])
     if r is not None:
         return (False, r)
@@ -1,5 +1,4 @@
 from exercises import *
-import numpy as np
 
 def check_sort(asm):
     obj = nios2_as(asm.encode('utf-8'))
@@ -21,14 +20,13 @@ def check_sort(asm):
         cpu.reset()
         ans = sorted(tc)
         cpu.write_symbol_word('N', len(tc))
-        for i,t in enumerate(tc):
-            cpu.write_symbol_word('SORT', t, offset=i*4)
+        cpu.write_array('SORT', tc)
 
         instrs = cpu.run_until_halted(100000000)
         tot_instr += instrs
 
         # Read back out SORT
-        their_ans = [np.int32(cpu.get_symbol_word('SORT', offset=i*4)) for i in range(len(tc))]
+        their_ans = cpu.read_array('SORT', len(tc))
 
         if their_ans != ans:
             feedback += 'Failed test case %d: ' % cur_test
@@ -23,8 +23,7 @@ def check_array_sum(asm):
 
         # Reset and initialize
         cpu.reset()
-        for i, val in enumerate(arr):
-            cpu.write_symbol_word('ARR', np.uint32(val), offset=i*4)
+        cpu.write_array('ARR', arr)
         cpu.write_symbol_word('N', len(arr))
 
         # Run
@@ -0,0 +1,460 @@
+
+import os
+import re
+import sys
+import time
+import queue
+import hashlib
+import json
+import resource
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import Future
+import util
+import timing
+
+# Runs exercise checkers away from the web server: jobs go in a bounded
+# queue and are graded by a pool of worker processes, forked from a server
+# process that already has the exercises imported. A job that runs past
+# its time limit gets its worker killed (and replaced); each worker also
+# has a memory limit, on top of what it uses when idle.
+#
+# grade() is what the web handlers call. With NIOS2_GRADE_WORKERS=0
+# checkers run in the calling thread instead, as they used to. Either way,
+# results are cached (see GradeCache), so the same source submitted again
+# for the same exercise isn't graded again.
+
+WORKERS = int(os.environ.get('NIOS2_GRADE_WORKERS', os.cpu_count() or 1))
+QUEUE_SIZE = int(os.environ.get('NIOS2_GRADE_QUEUE', 64))
+TIMEOUT = float(os.environ.get('NIOS2_GRADE_TIMEOUT', 60))     # seconds, per job
+MEM_LIMIT = int(os.environ.get('NIOS2_GRADE_MEM', 1024))        # MiB, per worker
+
+TIMEOUT_FEEDBACK = 'Grading took longer than %g seconds, stopped'
+MEMORY_FEEDBACK = 'Grading ran out of memory, stopped'
+ERROR_FEEDBACK = 'Internal error while grading, please report it'
+
+
+class Busy(Exception):
+    pass
+
+
+# What grading depends on besides the exercise's own module: changing any
+# of these regrades everything
+GRADING_FILES = ['util.py', 'csim.py', 'image.py', 'elf.py', 'exercises/__init__.py']
+
+# Grading results, (success, feedback, extra_info), keyed by a hash of the
+# exercise id, the checker's version and the normalized source. Checkers
+# are deterministic, so a hit is as good as grading again.
+class GradeCache(util.Cache):
+    def __init__(self, size=4096, path=None):
+        super().__init__(size, path)
+        self.versions = {}
+
+    # A hash of the checker's module, what it runs on (the assembler
+    # toolchain, the simulator) and the exercise's 'version' if it has one
+    def checker_version(self, eid, ex):
+        if eid not in self.versions:
+            import pynios2
+            h = hashlib.sha256(util.as_cache.toolchain_id().encode())
+            st = os.stat(pynios2.__file__)
+            h.update(('%d %d\n' % (st.st_size, st.st_mtime_ns)).encode())
+            for fn in GRADING_FILES + [ex['checker'].__code__.co_filename]:
+                with open(fn, 'rb') as f:
+                    h.update(f.read())
+            h.update(str(ex.get('version', '')).encode())
+            self.versions[eid] = h.hexdigest()
+        return self.versions[eid]
+
+    def key(self, eid, ex, asm):
+        h = hashlib.sha256(eid.encode() + b'\0' + self.checker_version(eid, ex).encode() + b'\0')
+        h.update(normalize(asm).encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def get(self, key):
+        found, val = super().get(key)
+        return (found, tuple(val) if found else None)
+
+grade_cache = GradeCache(size=int(os.environ.get('NIOS2_GRADE_CACHE_SIZE', 4096)),
+                         path=os.environ.get('NIOS2_GRADE_CACHE_DIR'))
+
+# grade_cache's key for asm graded by eid's checker (None if there's no
+# such exercise)
+def cache_key(eid, asm):
+    from exercises import Exercises
+    ex = Exercises.getExercise(eid)
+    if ex is None:
+        return None
+    return grade_cache.key(eid, ex, asm)
+
+# Trailing spaces and tabs make no difference to the assembler (or its
+# messages), so resubmitting with them still hits
+def normalize(asm):
+    return re.sub(r'[ \t]+(?=\n|$)', '', asm)
+
+
+# Runs eid's checker on asm and returns (success, feedback, extra_info)
+def run_checker(eid, asm):
+    from exercises import Exercises
+    ex = Exercises.getExercise(eid)
+    if ex is None:
+        return (False, 'Exercise ID not found', '')
+
+    # retry
+    for retry in range(5):
+        try:
+            res = ex['checker'](asm)
+            break
+        except OSError as e:
+            if retry == 4:
+                raise
+            print('Retrying, got exception: %s' % e)
+
+    extra_info = ''
+    if len(res) == 2:
+        success, feedback = res
+    else:
+        success, feedback, extra_info = res
+    if extra_info is None:
+        extra_info = ''
+    return (success, feedback, extra_info)
+
+
+# Virtual memory the process uses now, in bytes (None if we can't tell)
+def vm_size():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+# A worker process: grades the (eid, asm) jobs it gets on conn, and sends
+# back (result, restart, error, stats): restart is set when it shouldn't
+# be given another job, error when the checker raised. stats has the time
+# spent assembling, simulating and in the rest of the checker (rendering
+# the feedback, mostly).
+def worker_main(conn, mem_limit):
+    used = vm_size()
+    if used is not None and mem_limit:
+        limit = used + mem_limit*1024*1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    while True:
+        try:
+            eid, asm = conn.recv()
+        except EOFError:
+            return
+        timing.start()
+        t = time.perf_counter()
+        restart = False
+        error = False
+        try:
+            res = run_checker(eid, asm)
+        except MemoryError:
+            res = (False, MEMORY_FEEDBACK, '')
+            restart = True
+        except Exception:
+            traceback.print_exc()
+            res = (False, ERROR_FEEDBACK, '')
+            error = True
+        stats = timing.stop()
+        stats['total'] = time.perf_counter() - t
+        stats['render'] = max(0, stats['total'] - stats.get('assemble', 0) - stats.get('simulate', 0))
+        conn.send((res, restart, error, stats))
+        sys.stdout.flush()
+
+
+class Worker(object):
+    def __init__(self, ctx, mem_limit):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=worker_main, args=(child, mem_limit), daemon=True)
+        self.proc.start()
+        child.close()
+
+    def stop(self):
+        self.proc.kill()
+        self.proc.join()
+        self.conn.close()
+
+
+class Job(object):
+    def __init__(self, eid, asm, timeout, key, stats):
+        self.eid = eid
+        self.asm = asm
+        self.timeout = timeout
+        self.key = key          # in the cache, None to leave it out
+        self.stats = stats      # return them with the result
+        self.future = Future()
+
+
+# The queue and the workers. Each worker has a thread here feeding it jobs
+# and watching the clock.
+class Grader(object):
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, timeout=TIMEOUT,
+                 mem_limit=MEM_LIMIT, cache=grade_cache):
+        self.n_workers = workers
+        self.cache = cache
+        self.timeout = timeout
+        self.mem_limit = mem_limit
+        self.jobs = queue.Queue(queue_size)
+        self.ctx = multiprocessing.get_context('forkserver')
+        self.ctx.set_forkserver_preload(['exercises'])
+        self.threads = []
+        self.lock = threading.Lock()
+        self.done = 0
+        self.killed = 0
+
+    def start(self):
+        for i in range(self.n_workers):
+            # Started here so that they are all up before the first job
+            t = threading.Thread(target=self.serve, args=(Worker(self.ctx, self.mem_limit),),
+                                 daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    # Stops the workers once the jobs already queued are done
+    def stop(self):
+        for t in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    # Queues a job and returns its Future, whose result is (success,
+    # feedback, extra_info), or (that, stats) if stats is set: seconds
+    # spent in each stage of grading ('cached' for a cache hit). Raises
+    # Busy if the queue is full. Results already in the cache are returned
+    # as a done Future.
+    def submit(self, eid, asm, timeout=None, stats=False):
+        key = cache_key(eid, asm) if self.cache is not None else None
+        if key is not None:
+            found, res = self.cache.get(key)
+            if found:
+                future = Future()
+                future.set_result((res, {'cached': True}) if stats else res)
+                return future
+
+        job = Job(eid, asm, self.timeout if timeout is None else timeout, key, stats)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            raise Busy('%d submissions are already waiting' % self.jobs.qsize())
+        return job.future
+
+    def serve(self, worker):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                worker.stop()
+                return
+            if not job.future.set_running_or_notify_cancel():
+                continue
+
+            restart = False
+            error = False
+            t = time.perf_counter()
+            try:
+                worker.conn.send((job.eid, job.asm))
+                if worker.conn.poll(job.timeout):
+                    res, restart, error, stats = worker.conn.recv()
+                else:
+                    res = (False, TIMEOUT_FEEDBACK % job.timeout, '')
+                    restart = True
+            except (EOFError, OSError):
+                # Died, most likely from running out of memory
+                res = (False, MEMORY_FEEDBACK, '')
+                restart = True
+            if restart:
+                stats = {'total': time.perf_counter() - t}
+
+            # Running out of time or memory might not happen next time, and
+            # a checker failing is for us to fix
+            if job.key is not None and not restart and not error:
+                self.cache.put(job.key, res)
+            job.future.set_result((res, stats) if job.stats else res)
+            with self.lock:
+                self.done += 1
+                self.killed += restart
+            if restart:
+                worker.stop()
+                worker = Worker(self.ctx, self.mem_limit)
+
+
+grader = None
+grader_lock = threading.Lock()
+
+# The process's Grader, started the first time it's needed (so that e.g.
+# bottle's reloader doesn't start workers of its own)
+def get_grader():
+    global grader
+    with grader_lock:
+        if grader is None:
+            grader = Grader()
+            grader.start()
+        return grader
+
+# Grades asm for exercise eid: (success, feedback, extra_info). Waits for a
+# worker if all are busy; raises Busy if too many jobs are waiting already.
+def grade(eid, asm, timeout=None):
+    if WORKERS == 0:
+        key = cache_key(eid, asm)
+        if key is not None:
+            found, res = grade_cache.get(key)
+            if found:
+                return res
+        res = run_checker(eid, asm)
+        if key is not None:
+            grade_cache.put(key, res)
+        return res
+    return get_grader().submit(eid, asm, timeout).result()
+
+
+###################################################################
+# Bulk grading: python3 grader.py [options] input...
+
+# The submissions in path, as dicts with 'uid', 'eid', 'asm' and maybe
+# 'id': a directory of <uid>/<eid>.s files, a CSV file with those columns
+# (and a header), or JSONL
+def read_submissions(path):
+    if os.path.isdir(path):
+        for uid in sorted(os.listdir(path)):
+            d = os.path.join(path, uid)
+            if not os.path.isdir(d):
+                continue
+            for fn in sorted(os.listdir(d)):
+                if fn.endswith('.s'):
+                    with open(os.path.join(d, fn), encoding='utf-8', errors='replace') as f:
+                        yield {'uid': uid, 'eid': fn[:-2], 'asm': f.read()}
+    elif path.endswith('.csv'):
+        import csv
+        csv.field_size_limit(1 << 24)
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                yield row
+    else:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+# Gives each submission an id, unless it has one: uid/eid, with #2, #3...
+# added for later submissions of the same. Resuming relies on these being
+# the same from one run to the next.
+def number(subs):
+    seen = {}
+    for sub in subs:
+        if not sub.get('id'):
+            base = '%s/%s' % (sub['uid'], sub['eid'])
+            seen[base] = seen.get(base, 0) + 1
+            sub['id'] = base if seen[base] == 1 else '%s#%d' % (base, seen[base])
+        yield sub
+
+# The ids already in an output file, which is cut back to its last whole
+# line (a run that was stopped can leave half of one)
+def done_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].decode('utf-8', 'replace').split('\n'):
+        try:
+            done.add(json.loads(line)['id'])
+        except (ValueError, KeyError, TypeError):
+            pass
+    return done
+
+def main(argv):
+    import argparse
+    import itertools
+    from concurrent.futures import wait, as_completed, FIRST_COMPLETED
+    p = argparse.ArgumentParser(prog='grader.py',
+            description='Grades submissions offline, printing one JSON result per line '
+                        'as they complete.')
+    p.add_argument('inputs', nargs='+', metavar='input',
+                   help='directory of <uid>/<eid>.s files, or CSV/JSONL of uid, eid, asm')
+    p.add_argument('-o', '--output', help='append results here instead of printing them, '
+                   'skipping submissions already in it (to resume a run)')
+    p.add_argument('-j', '--jobs', type=int, default=WORKERS or os.cpu_count() or 1,
+                   help='worker processes (default: %(default)s)')
+    p.add_argument('--timeout', type=float, default=TIMEOUT,
+                   help='seconds per submission (default: %(default)s)')
+    p.add_argument('--no-cache', action='store_true', help='grade everything again')
+    args = p.parse_args(argv)
+
+    # The toolchain, linker script and exercises are found relative to
+    # here, as in app.py. Paths given are relative to where we were run.
+    args.inputs = [os.path.abspath(fn) for fn in args.inputs]
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    done = set()
+    if args.output:
+        done = done_ids(args.output)
+        out = open(args.output, 'a', encoding='utf-8')
+    else:
+        # Results get the real stdout to themselves, what checkers (and
+        # the exercises, when imported) print goes to stderr
+        sys.stdout.flush()
+        out = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+        os.dup2(2, 1)
+
+    g = Grader(workers=args.jobs, queue_size=3*args.jobs, timeout=args.timeout,
+               cache=None if args.no_cache else grade_cache)
+    g.start()
+    totals = {}
+    counts = {'graded': 0, 'passed': 0, 'cached': 0, 'skipped': 0}
+    start = time.perf_counter()
+
+    def write(sub, future):
+        (success, feedback, extra_info), stats = future.result()
+        out.write(json.dumps({'id': sub['id'], 'uid': sub['uid'], 'eid': sub['eid'],
+                              'success': bool(success), 'feedback': feedback,
+                              'extra_info': extra_info, 'time': stats}) + '\n')
+        out.flush()
+        counts['graded'] += 1
+        counts['passed'] += bool(success)
+        counts['cached'] += stats.get('cached', False)
+        for stage, t in stats.items():
+            if stage != 'cached':
+                totals[stage] = totals.get(stage, 0) + t
+
+    pending = {}
+    try:
+        subs = itertools.chain(*[read_submissions(path) for path in args.inputs])
+        for sub in number(subs):
+            if sub['id'] in done:
+                counts['skipped'] += 1
+                continue
+            # Keep the workers fed, without reading everything in first
+            while len(pending) >= 3*args.jobs:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    write(pending.pop(f), f)
+            pending[g.submit(sub['eid'], sub['asm'], stats=True)] = sub
+        for f in as_completed(list(pending)):
+            write(pending.pop(f), f)
+        g.stop()
+    except KeyboardInterrupt:
+        sys.stderr.write('Interrupted, run again with the same -o to resume\n')
+        return 130
+    finally:
+        # Everything written so far is kept, for -o to resume
+        out.close()
+
+    sys.stderr.write('%(graded)d graded (%(cached)d cached), %(passed)d passed, '
+                     '%(skipped)d already done\n' % counts)
+    sys.stderr.write('%.1fs: %s\n' % (time.perf_counter() - start,
+                     ', '.join(['%s %.1fs' % (k, totals.get(k, 0))
+                                for k in ('assemble', 'simulate', 'render')])))
+    return 0
+
+
+# The workers need this module under its own name
+if __name__ == '__main__':
+    import grader
+    sys.exit(grader.main(sys.argv[1:]))
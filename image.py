@@ -0,0 +1,227 @@
+
+import re
+import struct
+import json
+from collections import namedtuple
+
+# Program images: what nios2_as() returns and the simulators load, in a
+# compact binary form that is cached and passed around as is.
+#
+#   header      magic, version, number of sections and symbols, size of
+#               the string table
+#   sections    addr, offset of its data in the file, size of the data,
+#               size in memory, flags. Past its data, a section's memory
+#               reads as zeros with SF_ZERO, else as uninitialized (.bss).
+#   symbols     name, addr, size, section name (NO_SECTION for .equ
+#               constants), type
+#   strings     NUL-terminated UTF-8 names, padded to a word
+#   payload     each section's data, little-endian like the guest, each
+#               padded to a word
+#
+# Everything is little-endian.
+
+class ImageError(Exception):
+    pass
+
+MAGIC = b'N2IM'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIII')
+SECTION = struct.Struct('<IIIII')
+SYMBOL = struct.Struct('<IIIIB3x')
+NO_SECTION = 0xffffffff
+
+# Section flags, as in ELF program headers
+PF_X = 1
+PF_W = 2
+PF_R = 4
+SF_ZERO = 0x100     # zero-filled past its data
+
+# Runs of zeros at least this long in a segment aren't stored, the segment
+# is split around them instead (see sections())
+ZERO_RUN = 4096
+
+# Symbol types, as in ELF
+SYM_TYPES = {0: 'notype', 1: 'object', 2: 'func', 3: 'section', 4: 'file'}
+SYM_CODES = dict([(name, code) for code, name in SYM_TYPES.items()])
+
+Section = namedtuple('Section', ['addr', 'memsz', 'flags', 'data'])
+
+
+def pad4(n):
+    return -n % 4
+
+# The sections of a loadable segment: data at addr, memsz bytes long in
+# memory (reading as uninitialized past the data). Long runs of zeros in
+# the data are left out, so a program with a large gap, e.g. .data placed
+# far after .text, costs nothing to store or load.
+def sections(addr, memsz, flags, data):
+    out = []
+    start = 0
+    for m in re.finditer(b'\0{%d,}' % ZERO_RUN, data):
+        out.append(Section(addr + start, m.end() - start, flags | SF_ZERO,
+                           data[start:m.start()]))
+        start = m.end()
+    if memsz > start or not out:
+        out.append(Section(addr + start, memsz - start, flags, data[start:]))
+    return out
+
+# Adds a label named after each section that has no other label at its
+# start, as objdump shows them (e.g. .reset). sections are the (name,
+# addr) of the non-empty ones.
+def section_labels(symtab, sections):
+    starts = set([(s[3], s[0]) for s in symtab.values()])
+    for name, addr in sections:
+        if (name, addr) not in starts and name not in symtab:
+            symtab[name] = [addr, 0, 'section', name]
+    return symtab
+
+
+class Image(object):
+    # sections is a list of Section, symtab maps every defined symbol to
+    # [addr, size, type, section] (section None for .equ constants)
+    def __init__(self, sections, symtab):
+        self.sections = sections
+        self.symtab = symtab
+        # The labels in the program, by name (see section_labels())
+        self.symbols = dict([(name, s[0]) for name, s in symtab.items()
+                             if s[3] is not None and s[2] in ('notype', 'object', 'func', 'section')])
+
+    def __eq__(self, other):
+        return (isinstance(other, Image) and self.sections == other.sections
+                and self.symtab == other.symtab)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Image(%r, %r)' % (self.sections, self.symtab)
+
+    # The loadable contents as one image from address 0, gaps zero-filled
+    # and padded out to a whole word. Space only reserved in memory
+    # (.bss) isn't included, so it reads as uninitialized. Loading the
+    # sections (see segments()) is cheaper when they are far apart.
+    def flat(self):
+        end = max([s.addr + self.loaded_size(s) for s in self.sections] + [0])
+        size = end + pad4(end)
+        if len(self.sections) == 1 and self.sections[0].addr == 0 and len(self.sections[0].data) == size:
+            return self.sections[0].data
+        out = bytearray(size)
+        for s in self.sections:
+            out[s.addr:s.addr + len(s.data)] = s.data
+        return bytes(out)
+
+    # How much of a section is loaded: its data, and the zeros after it
+    # when they were split off (SF_ZERO)
+    @staticmethod
+    def loaded_size(s):
+        return s.memsz if s.flags & SF_ZERO else len(s.data)
+
+    # What to load, for pynios2.CPU: (addr, data, zeros after it)
+    def segments(self):
+        return [(s.addr, s.data, s.memsz - len(s.data) if s.flags & SF_ZERO else 0)
+                for s in self.sections]
+
+    def to_bytes(self):
+        strings = bytearray()
+        offsets = {}
+        def string(s):
+            if s not in offsets:
+                offsets[s] = len(strings)
+                strings.extend(s.encode('utf-8') + b'\0')
+            return offsets[s]
+
+        syms = b''
+        for name, (addr, size, typ, section) in self.symtab.items():
+            syms += SYMBOL.pack(string(name), addr, size,
+                                NO_SECTION if section is None else string(section),
+                                SYM_CODES.get(typ, typ))
+        strings.extend(bytes(pad4(len(strings))))
+
+        offset = HEADER.size + SECTION.size*len(self.sections) + len(syms) + len(strings)
+        table = b''
+        payload = []
+        for s in self.sections:
+            table += SECTION.pack(s.addr, offset, len(s.data), s.memsz, s.flags)
+            payload.append(s.data + bytes(pad4(len(s.data))))
+            offset += len(payload[-1])
+
+        return b''.join([HEADER.pack(MAGIC, VERSION, 0, len(self.sections), len(self.symtab), len(strings)),
+                         table, syms, bytes(strings)] + payload)
+
+    # The object nios2_as() used to return, for showing on the /nios2/as
+    # page: 'prog' is the flat image as hex words (most significant byte
+    # first, as objdump prints them), 'symbols' maps labels to addresses,
+    # 'symtab' has every defined symbol and 'segments' the loadable ranges
+    # ([addr, memsz]).
+    def to_json(self):
+        image = self.flat()
+        words = struct.unpack('<%dI' % (len(image) // 4), image)
+        # Sections split off the same segment go back together
+        segments = []
+        prev = None
+        for s in self.sections:
+            if prev is not None and prev.flags & SF_ZERO and prev.addr + prev.memsz == s.addr:
+                segments[-1][1] += s.memsz
+            else:
+                segments.append([s.addr, s.memsz])
+            prev = s
+        return {'prog': ''.join(['%08x' % w for w in words]),
+                'symbols': self.symbols,
+                'symtab': self.symtab,
+                'segments': segments}
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+
+def unpack(fmt, data, offset):
+    try:
+        return fmt.unpack_from(data, offset)
+    except struct.error:
+        raise ImageError('Truncated image')
+
+def from_bytes(data):
+    magic, version, _, n_sections, n_symbols, strings_len = unpack(HEADER, data, 0)
+    if magic != MAGIC:
+        raise ImageError('Not a program image')
+    if version != VERSION:
+        raise ImageError('Unknown image version %d' % version)
+
+    sections = []
+    off = HEADER.size
+    for i in range(n_sections):
+        addr, offset, size, memsz, flags = unpack(SECTION, data, off)
+        if offset + size > len(data):
+            raise ImageError('Truncated image')
+        sections.append(Section(addr, memsz, flags, bytes(data[offset:offset + size])))
+        off += SECTION.size
+
+    strings = off + SYMBOL.size*n_symbols
+    if strings + strings_len > len(data):
+        raise ImageError('Truncated image')
+    def string(offset):
+        start = strings + offset
+        end = data.find(b'\0', start, strings + strings_len)
+        if end < 0:
+            raise ImageError('Bad string table')
+        return bytes(data[start:end]).decode('utf-8', 'replace')
+
+    symtab = {}
+    for i in range(n_symbols):
+        name, addr, size, section, typ = unpack(SYMBOL, data, off)
+        symtab[string(name)] = [addr, size, SYM_TYPES.get(typ, typ),
+                                None if section == NO_SECTION else string(section)]
+        off += SYMBOL.size
+    return Image(sections, symtab)
+
+def load(path):
+    with open(path, 'rb') as f:
+        return from_bytes(f.read())
+
+
+# Shows an image file as the JSON the /nios2/as page shows
+if __name__ == '__main__':
+    import sys
+    for fn in sys.argv[1:]:
+        print(json.dumps(load(fn).to_json()))
@@ -0,0 +1,543 @@
+#include <stdlib.h>
+#include <string.h>
+#include "nios2.h"
+
+// MMIO devices simulated in C. Accessing them never calls into Python (or
+// needs the GIL), so programs that poll them run at full speed. Python
+// attaches them with _add_device() and reads their state back after a run.
+
+//////////////////////
+// Byte FIFOs
+static int fifo_init(struct fifo *f, uint32_t depth)
+{
+    f->buf = malloc(depth > 0 ? depth : 1);
+    f->depth = depth;
+    f->head = 0;
+    f->count = 0;
+    return f->buf != NULL;
+}
+
+int fifo_put(struct fifo *f, uint8_t c)
+{
+    if (f->count >= f->depth) {
+        return 0;
+    }
+    f->buf[(f->head + f->count) % f->depth] = c;
+    f->count++;
+    return 1;
+}
+
+int fifo_get(struct fifo *f)
+{
+    if (f->count == 0) {
+        return -1;
+    }
+    uint8_t c = f->buf[f->head];
+    f->head = (f->head + 1) % f->depth;
+    f->count--;
+    return c;
+}
+
+// Contents, oldest first, without taking them out
+static PyObject *fifo_bytes(struct fifo *f)
+{
+    PyObject *ret = PyBytes_FromStringAndSize(NULL, f->count);
+    if (ret == NULL) {
+        return NULL;
+    }
+    char *out = PyBytes_AS_STRING(ret);
+    uint32_t i;
+    for (i=0; i<f->count; i++) {
+        out[i] = f->buf[(f->head + i) % f->depth];
+    }
+    return ret;
+}
+
+static int bytebuf_put(struct bytebuf *b, const uint8_t *data, size_t len)
+{
+    if (b->len + len > b->cap) {
+        size_t cap = b->cap ? b->cap : 64;
+        while (cap < b->len + len) {
+            cap *= 2;
+        }
+        uint8_t *buf = realloc(b->buf, cap);
+        if (buf == NULL) {
+            return 0;
+        }
+        b->buf = buf;
+        b->cap = cap;
+    }
+    memcpy(b->buf + b->len, data, len);
+    b->len += len;
+    return 1;
+}
+
+
+//////////////////////
+// JTAG UART
+//
+// data (+0): loads pop a byte of rx as byte | RVALID (bit 15) | bytes left
+//            << 16; stores push a byte to tx (dropped when full)
+// control (+4): loads read the space left in tx (WSPACE) << 16
+static void uart_step(struct device *dev)
+{
+    if (++dev->tx_step >= dev->tx_roll) {
+        dev->tx_step = 0;
+        int c = fifo_get(&dev->tx);
+        if (c >= 0) {
+            uint8_t b = c;
+            bytebuf_put(&dev->tx_data, &b, 1);
+        }
+    }
+    if (++dev->rx_step >= dev->rx_roll) {
+        dev->rx_step = 0;
+        if (dev->rx_idx < dev->rx_data.len &&
+            fifo_put(&dev->fifo, dev->rx_data.buf[dev->rx_idx])) {
+            dev->rx_idx++;
+        }
+    }
+}
+
+static uint32_t uart_access(struct device *dev, uint32_t offset, uint32_t val,
+                            int is_store)
+{
+    uart_step(dev);
+
+    if (offset == 0) {
+        if (is_store) {
+            uint8_t c = val & 0xff;
+            if (!fifo_put(&dev->tx, c)) {
+                bytebuf_put(&dev->dropped, &c, 1);
+            }
+            return 0;
+        }
+        int c = fifo_get(&dev->fifo);
+        if (c < 0) {
+            return 0x41;    // RVALID clear, data is junk
+        }
+        return (dev->fifo.count << 16) | 0x8000 | c;
+    }
+    if (!is_store) {
+        return (dev->tx.depth - dev->tx.count) << 16;
+    }
+    return 0;
+}
+
+long _add_jtag_uart(long obj, uint32_t addr, uint32_t rx_depth,
+                    uint32_t tx_depth, uint32_t tx_roll, uint32_t rx_roll)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    struct device *dev = calloc(1, sizeof(struct device));
+    if (dev == NULL) {
+        return 0;
+    }
+    dev->kind = DEV_JTAG_UART;
+    if (!fifo_init(&dev->fifo, rx_depth) || !fifo_init(&dev->tx, tx_depth)) {
+        free_device(dev);
+        return 0;
+    }
+    dev->tx_roll = tx_roll;
+    dev->rx_roll = rx_roll;
+    return attach_device(cpu, addr, dev);
+}
+
+
+//////////////////////
+// Interval timer
+//
+// Counts instructions instead of clock cycles. Registers are 16 bits wide:
+// status (+0x0), control (+0x4), periodl/h (+0x8/+0xc), snapl/h (+0x10/+0x14)
+#define TIMER_TO    0x1     // status
+#define TIMER_RUN   0x2
+#define TIMER_ITO   0x1     // control
+#define TIMER_CONT  0x2
+#define TIMER_START 0x4
+#define TIMER_STOP  0x8
+
+static uint32_t timer_counter(struct device *dev)
+{
+    if (dev->ev == NULL) {
+        return dev->counter;
+    }
+    return dev->ev->when - dev->cpu->icount - 1;
+}
+
+static void timer_start(struct device *dev)
+{
+    if (dev->ev != NULL) {
+        return;
+    }
+    // Times out when the counter goes past 0
+    uint64_t period = (dev->control & TIMER_CONT) ? (uint64_t)dev->period + 1 : 0;
+    dev->ev = schedule_event(dev->cpu, EV_TIMER,
+                             dev->cpu->icount + (uint64_t)dev->counter + 1, period);
+    if (dev->ev != NULL) {
+        dev->ev->dev = dev;
+        dev->status |= TIMER_RUN;
+    }
+}
+
+static void timer_stop(struct device *dev)
+{
+    if (dev->ev != NULL) {
+        dev->counter = timer_counter(dev);
+        cancel_event(dev->cpu, dev->ev);
+    }
+    dev->status &= ~TIMER_RUN;
+}
+
+// Called by the event scheduler. In continuous mode the event stays
+// scheduled (every period+1 instructions), otherwise it is freed after this.
+void timer_timeout(struct device *dev)
+{
+    dev->status |= TIMER_TO;
+    dev->counter = dev->period;
+    if (!(dev->control & TIMER_CONT)) {
+        dev->status &= ~TIMER_RUN;
+    }
+    set_irq_line(dev->cpu, dev->irq, dev->control & TIMER_ITO);
+}
+
+static uint32_t timer_access(struct device *dev, uint32_t offset, uint32_t val,
+                             int is_store)
+{
+    switch (offset >> 2) {
+    case 0:
+        if (is_store) {
+            // Any write clears TO
+            dev->status &= ~TIMER_TO;
+            set_irq_line(dev->cpu, dev->irq, 0);
+        }
+        return dev->status;
+    case 1:
+        if (is_store) {
+            dev->control = val & (TIMER_ITO | TIMER_CONT);
+            if (dev->ev != NULL) {
+                dev->ev->period = (dev->control & TIMER_CONT) ? (uint64_t)dev->period + 1 : 0;
+            }
+            if (val & TIMER_STOP) {
+                timer_stop(dev);
+            } else if (val & TIMER_START) {
+                timer_start(dev);
+            }
+            set_irq_line(dev->cpu, dev->irq,
+                         (dev->status & TIMER_TO) && (dev->control & TIMER_ITO));
+        }
+        return dev->control;
+    case 2:
+    case 3:
+        if (is_store) {
+            // Writing the period stops the timer and reloads the counter
+            int shift = (offset >> 2) == 2 ? 0 : 16;
+            dev->period = (dev->period & ~(0xffffu << shift)) | ((val & 0xffff) << shift);
+            timer_stop(dev);
+            dev->counter = dev->period;
+        }
+        return (offset >> 2) == 2 ? dev->period & 0xffff : dev->period >> 16;
+    case 4:
+    case 5:
+        if (is_store) {
+            dev->snap = timer_counter(dev);
+        }
+        return (offset >> 2) == 4 ? dev->snap & 0xffff : dev->snap >> 16;
+    }
+    return 0;
+}
+
+long _add_timer(long obj, uint32_t addr, int irq, uint32_t period)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    struct device *dev = calloc(1, sizeof(struct device));
+    if (dev == NULL) {
+        return 0;
+    }
+    dev->kind = DEV_TIMER;
+    dev->cpu = cpu;
+    dev->irq = irq & 0x1f;
+    dev->init_val = period;
+    dev->period = period;
+    dev->counter = period;
+    return attach_device(cpu, addr, dev);
+}
+
+
+//////////////////////
+// Devices
+struct device *new_device(int kind, uint32_t val, uint32_t n)
+{
+    struct device *dev = calloc(1, sizeof(struct device));
+    if (dev == NULL) {
+        return NULL;
+    }
+    dev->kind = kind;
+    dev->init_val = val;
+    dev->val = val;
+
+    switch (kind) {
+    case DEV_REG:
+    case DEV_CONST:
+        break;
+    case DEV_LOG:
+        dev->halt_after = n;
+        break;
+    case DEV_FIFO:
+        if (!fifo_init(&dev->fifo, n)) {
+            free(dev);
+            return NULL;
+        }
+        break;
+    default:
+        free(dev);
+        return NULL;
+    }
+    return dev;
+}
+
+// Bytes of MMIO address space the device's registers take
+uint32_t device_size(struct device *dev)
+{
+    if (dev->kind == DEV_JTAG_UART) {
+        return 8;
+    }
+    if (dev->kind == DEV_TIMER) {
+        return 0x20;
+    }
+    return 4;
+}
+
+// Whether a load or store at offset reaches a register. The JTAG UART's
+// are only at word addresses, like the single-address MMIOs it replaced.
+int device_has_reg(struct device *dev, uint32_t offset)
+{
+    if (dev->kind == DEV_JTAG_UART) {
+        return (offset & 3) == 0;
+    }
+    return 1;
+}
+
+uint32_t device_access(struct nios2 *cpu, struct device *dev, uint32_t offset,
+                       uint32_t val, int is_store)
+{
+    switch (dev->kind) {
+    case DEV_REG:
+        if (is_store) {
+            dev->val = val;
+        }
+        return dev->val;
+
+    case DEV_CONST:
+        return dev->val;
+
+    case DEV_LOG:
+        if (is_store) {
+            dev->val = val;
+            if (dev->log_len == dev->log_cap) {
+                size_t cap = dev->log_cap ? 2*dev->log_cap : 64;
+                uint32_t *log = realloc(dev->log, cap*sizeof(uint32_t));
+                if (log == NULL) {
+                    return dev->val;
+                }
+                dev->log = log;
+                dev->log_cap = cap;
+            }
+            dev->log[dev->log_len++] = val;
+            if (dev->halt_after && dev->log_len % dev->halt_after == 0) {
+                cpu->halted = 1;
+                cpu->block_exit = 1;
+            }
+        }
+        return dev->val;
+
+    case DEV_FIFO:
+        // Stores push the low byte (dropped when full). Loads pop a byte,
+        // read as the byte | valid (bit 15) | bytes left << 16, or 0 when
+        // the FIFO is empty.
+        if (is_store) {
+            fifo_put(&dev->fifo, val & 0xff);
+            return 0;
+        } else {
+            int c = fifo_get(&dev->fifo);
+            if (c < 0) {
+                return 0;
+            }
+            return (dev->fifo.count << 16) | 0x8000 | c;
+        }
+
+    case DEV_JTAG_UART:
+        return uart_access(dev, offset, val, is_store);
+
+    case DEV_TIMER:
+        return timer_access(dev, offset, val, is_store);
+    }
+    return 0;
+}
+
+// Back to the state it was attached in (on cpu reset)
+void reset_device(struct device *dev)
+{
+    dev->val = dev->init_val;
+    dev->log_len = 0;
+    dev->fifo.head = 0;
+    dev->fifo.count = 0;
+
+    dev->tx.head = 0;
+    dev->tx.count = 0;
+    dev->rx_idx = 0;
+    dev->tx_data.len = 0;
+    dev->dropped.len = 0;
+    dev->tx_step = 0;
+    dev->rx_step = 0;
+
+    // The cpu has dropped its events (and irq lines) by now
+    dev->ev = NULL;
+    dev->status = 0;
+    dev->control = 0;
+    dev->period = dev->init_val;
+    dev->counter = dev->init_val;
+    dev->snap = 0;
+}
+
+static void release_device(struct device *dev)
+{
+    free(dev->log);
+    free(dev->fifo.buf);
+    free(dev->tx.buf);
+    free(dev->rx_data.buf);
+    free(dev->tx_data.buf);
+    free(dev->dropped.buf);
+    free(dev);
+}
+
+// The cpu is done with dev (it was mapped over, or MMIOs were cleared).
+// It's freed once no Python handle refers to it either.
+void free_device(struct device *dev)
+{
+    if (dev->ev != NULL) {
+        cancel_event(dev->cpu, dev->ev);
+    }
+    if (dev->kind == DEV_TIMER && (dev->status & TIMER_TO)) {
+        set_irq_line(dev->cpu, dev->irq, 0);
+    }
+    dev->detached = 1;
+    if (dev->refs == 0) {
+        release_device(dev);
+    }
+}
+
+
+//////////////////////
+// Reading state back from Python. Handles keep their device alive, but
+// it's only theirs to use while it's still attached.
+void _device_ref(long obj)
+{
+    struct device *dev = (struct device *)obj;
+    dev->refs++;
+}
+
+void _device_unref(long obj)
+{
+    struct device *dev = (struct device *)obj;
+    if (--dev->refs == 0 && dev->detached) {
+        release_device(dev);
+    }
+}
+
+int _device_attached(long obj)
+{
+    struct device *dev = (struct device *)obj;
+    return !dev->detached;
+}
+
+uint32_t _device_get(long obj)
+{
+    struct device *dev = (struct device *)obj;
+    return dev->val;
+}
+
+void _device_set(long obj, uint32_t val)
+{
+    struct device *dev = (struct device *)obj;
+    dev->val = val;
+}
+
+// Every value stored to a DEV_LOG, oldest first
+PyObject *_device_log(long obj)
+{
+    struct device *dev = (struct device *)obj;
+    PyObject *list = PyList_New(dev->log_len);
+    if (list == NULL) {
+        return NULL;
+    }
+    size_t i;
+    for (i=0; i<dev->log_len; i++) {
+        PyObject *elt = PyLong_FromUnsignedLong(dev->log[i]);
+        if (elt == NULL) {
+            Py_DECREF(list);
+            return NULL;
+        }
+        PyList_SET_ITEM(list, i, elt);
+    }
+    return list;
+}
+
+// Queues data for the program to read, returns how much fit
+size_t _fifo_push(long obj, const char *data, size_t len)
+{
+    struct device *dev = (struct device *)obj;
+    size_t i;
+    for (i=0; i<len; i++) {
+        if (!fifo_put(&dev->fifo, data[i])) {
+            break;
+        }
+    }
+    return i;
+}
+
+// Drains everything the program queued, as bytes
+PyObject *_fifo_read(long obj)
+{
+    struct device *dev = (struct device *)obj;
+    PyObject *ret = PyBytes_FromStringAndSize(NULL, dev->fifo.count);
+    if (ret == NULL) {
+        return NULL;
+    }
+    char *out = PyBytes_AS_STRING(ret);
+    int c;
+    while ((c = fifo_get(&dev->fifo)) >= 0) {
+        *out++ = c;
+    }
+    return ret;
+}
+
+// Queues data for the host side of a JTAG UART to send to the program
+void _uart_send(long obj, const char *data, size_t len)
+{
+    struct device *dev = (struct device *)obj;
+    bytebuf_put(&dev->rx_data, (const uint8_t *)data, len);
+}
+
+// Everything the program sent, optionally taking what is still in the tx
+// FIFO as sent too
+PyObject *_uart_received(long obj, int flush)
+{
+    struct device *dev = (struct device *)obj;
+    int c;
+    while (flush && (c = fifo_get(&dev->tx)) >= 0) {
+        uint8_t b = c;
+        bytebuf_put(&dev->tx_data, &b, 1);
+    }
+    return PyBytes_FromStringAndSize((char *)dev->tx_data.buf, dev->tx_data.len);
+}
+
+PyObject *_uart_fifo(long obj, int tx)
+{
+    struct device *dev = (struct device *)obj;
+    return fifo_bytes(tx ? &dev->tx : &dev->fifo);
+}
+
+// Bytes the program wrote while the tx FIFO was full
+PyObject *_uart_dropped(long obj)
+{
+    struct device *dev = (struct device *)obj;
+    return PyBytes_FromStringAndSize((char *)dev->dropped.buf, dev->dropped.len);
+}
@@ -3,10 +3,64 @@
 #include "nios2.h"
 #include <stdint.h>
 #include <string.h>
+#include <sys/mman.h>
+#include <pthread.h>
 
 #define NIOS_RAM_SIZE (64*1024*1024)
+#define MEM_FILL      0xaa  // what uninitialized memory reads as
 
-long _new_nios2(const char *mem, size_t mem_len)
+// The n bytes at addr of the initial image, into out: the MEM_FILL pattern,
+// plus whatever parts of the image's segments they cover
+static void init_bytes(struct nios2 *cpu, uint32_t addr, unsigned char *out, size_t n)
+{
+    uint64_t end = (uint64_t)addr + n;
+    int i;
+
+    memset(out, MEM_FILL, n);
+    for (i=0; i<cpu->n_init_segs; i++) {
+        struct init_seg *seg = &cpu->init_segs[i];
+        uint64_t data_end = (uint64_t)seg->addr + seg->len;
+        uint64_t zero_end = data_end + seg->zero_len;
+        uint64_t lo, hi;
+
+        lo = seg->addr > addr ? seg->addr : addr;
+        hi = data_end < end ? data_end : end;
+        if (lo < hi) {
+            memcpy(out + (lo - addr), seg->data + (lo - seg->addr), hi - lo);
+        }
+        lo = data_end > addr ? data_end : addr;
+        hi = zero_end < end ? zero_end : end;
+        if (lo < hi) {
+            memset(out + (lo - addr), 0, hi - lo);
+        }
+    }
+}
+
+// Fills in the page holding addr the first time it is written (or read in
+// place) with its initial contents
+unsigned char *touch_page(struct nios2 *cpu, uint32_t addr)
+{
+    uint32_t base = addr & ~(MEM_PAGE_SIZE - 1);
+    unsigned char *page = cpu->mem + base;
+
+    init_bytes(cpu, base, page, MEM_PAGE_SIZE);
+    cpu->page_state[addr >> MEM_PAGE_SHIFT] |= PAGE_PRESENT;
+    return page;
+}
+
+// Called on the first store to a page since the last reset. Remembers the
+// page so that reset only has to restore what the program wrote.
+void dirty_page(struct nios2 *cpu, uint32_t addr)
+{
+    uint32_t pn = addr >> MEM_PAGE_SHIFT;
+    if (!(cpu->page_state[pn] & PAGE_PRESENT)) {
+        touch_page(cpu, addr);
+    }
+    cpu->page_state[pn] |= PAGE_DIRTY;
+    cpu->dirty_pages[cpu->n_dirty++] = pn;
+}
+
+long _new_nios2(void)
 {
     struct nios2 *cpu = malloc(sizeof(struct nios2));
     if (cpu == NULL) {
@@ -14,16 +68,41 @@ long _new_nios2(const char *mem, size_t mem_len)
     }
     cpu->halted = 0;
     cpu->error = NULL;
+    cpu->n_errors = 0;
 
 
-    // Init memory
-    cpu->mem = malloc(NIOS_RAM_SIZE);
-    if (cpu->mem == NULL) {
+    // Init memory: RAM is only reserved here. The OS backs it lazily and
+    // page_state tracks which pages we have filled in; the rest read as
+    // MEM_FILL without ever being touched.
+    cpu->mem = mmap(NULL, NIOS_RAM_SIZE, PROT_READ | PROT_WRITE,
+                    MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+    if (cpu->mem == MAP_FAILED) {
         return 0;
     }
-    memset(cpu->mem, 0xaa, NIOS_RAM_SIZE);
     cpu->mem_len = NIOS_RAM_SIZE;
-    memcpy(cpu->mem, mem, mem_len);
+    cpu->page_state = calloc(NIOS_RAM_SIZE >> MEM_PAGE_SHIFT, 1);
+    if (cpu->page_state == NULL) {
+        return 0;
+    }
+    cpu->dirty_pages = malloc((NIOS_RAM_SIZE >> MEM_PAGE_SHIFT) * sizeof(uint32_t));
+    if (cpu->dirty_pages == NULL) {
+        return 0;
+    }
+    cpu->n_dirty = 0;
+
+    // Filled in by _load_nios2()
+    cpu->init_segs = NULL;
+    cpu->n_init_segs = 0;
+
+    // Decoded instructions are filled in lazily, one page at a time
+    cpu->icache = calloc(NIOS_RAM_SIZE >> ICACHE_PAGE_SHIFT, sizeof(struct code_page *));
+    if (cpu->icache == NULL) {
+        return 0;
+    }
+    cpu->blocks = NULL;
+    cpu->dead_blocks = NULL;
+    cpu->block_exit = 0;
+    cpu->n_breakpoints = 0;
 
 
     // Init registers
@@ -31,26 +110,80 @@ long _new_nios2(const char *mem, size_t mem_len)
     memset(cpu->regs, 0, sizeof(uint32_t)*32);
 
     memset(cpu->ctl, 0, sizeof(uint32_t)*32);
+    cpu->irq_pending = 0;
+    cpu->irq_lines = 0;
+
+    cpu->icount = 0;
+    cpu->next_event = UINT64_MAX;
+    cpu->events = NULL;
 
 
     // Init internal tracking
     memset(cpu->clobbered_history, 0, sizeof(struct clobbered)*MAX_CLOBBERED);
     cpu->clobbered_idx = 0;
     cpu->callee_stack_head = NULL;
+    cpu->callee_free = NULL;
 
 
     // setup mmio
-    int i;
-    for (i=0; i<MAX_MMIOS; i++) {
-        cpu->mmios[i].addr = 0;
-        cpu->mmios[i].callback = NULL;
-        cpu->mmios[i].arg = NULL;
-    }
+    memset(cpu->mmio_pages, 0, sizeof(cpu->mmio_pages));
+    cpu->mmio_last = NULL;
+    cpu->mmio_list = NULL;
 
     return (long )cpu;
 }
 
 
+// Adds a segment to the initial image (see struct init_seg) before the cpu
+// runs: its pages are filled in now. Whatever lies outside of RAM is left
+// out. Pages that only hold zeros aren't written to, a fresh mapping
+// already reads as zero, so gaps and large zeroed areas cost nothing.
+// Returns 0 when out of memory.
+int _load_nios2(long obj, uint32_t addr, const char *data, size_t len, size_t zero_len)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    struct init_seg *seg;
+    uint64_t data_end, end, a;
+
+    if (addr >= cpu->mem_len) {
+        return 1;
+    }
+    if (len > cpu->mem_len - addr) {
+        len = cpu->mem_len - addr;
+    }
+    if (zero_len > cpu->mem_len - addr - len) {
+        zero_len = cpu->mem_len - addr - len;
+    }
+
+    seg = realloc(cpu->init_segs, (cpu->n_init_segs + 1) * sizeof(struct init_seg));
+    if (seg == NULL) {
+        return 0;
+    }
+    cpu->init_segs = seg;
+    seg = &cpu->init_segs[cpu->n_init_segs];
+    seg->data = malloc(len);
+    if (seg->data == NULL && len > 0) {
+        return 0;
+    }
+    memcpy(seg->data, data, len);
+    seg->addr = addr;
+    seg->len = len;
+    seg->zero_len = zero_len;
+    cpu->n_init_segs++;
+
+    data_end = (uint64_t)addr + len;
+    end = data_end + zero_len;
+    for (a=addr & ~(MEM_PAGE_SIZE - 1); a<end; a+=MEM_PAGE_SIZE) {
+        if (!(cpu->page_state[a >> MEM_PAGE_SHIFT] & PAGE_PRESENT) &&
+                a >= data_end && a + MEM_PAGE_SIZE <= end) {
+            cpu->page_state[a >> MEM_PAGE_SHIFT] |= PAGE_PRESENT;
+        } else {
+            touch_page(cpu, a);
+        }
+    }
+    return 1;
+}
+
 PyObject *_get_error(long obj)
 {
     struct nios2 *cpu = (struct nios2 *)obj;
@@ -69,12 +202,12 @@ void _set_pc(long obj, uint32_t pc)
     cpu->pc = pc;
 }
 
-uint32_t get_reg(struct nios2 *cpu, int reg)
+static inline uint32_t get_reg(struct nios2 *cpu, int reg)
 {
     return cpu->regs[reg & 0x1f];
 }
 
-void set_reg(struct nios2 *cpu, int reg, uint32_t val)
+static inline void set_reg(struct nios2 *cpu, int reg, uint32_t val)
 {
     reg &= 0x1f;
     if (reg != 0) {
@@ -84,12 +217,37 @@ void set_reg(struct nios2 *cpu, int reg, uint32_t val)
 
 uint32_t get_ctl_reg(struct nios2 *cpu, int reg)
 {
-    return cpu->ctl[reg & 0x1f];
+    reg &= 0x1f;
+    if (reg == 4) {
+        // ipending: what was written to it, plus enabled device lines
+        return cpu->ctl[4] | (cpu->irq_lines & cpu->ctl[3]);
+    }
+    return cpu->ctl[reg];
+}
+
+static inline void update_irq_pending(struct nios2 *cpu)
+{
+    // status.PIE && (ipending & ienable), so the run loop only tests one flag
+    cpu->irq_pending = (cpu->ctl[0] & 1) &&
+                       (cpu->ctl[3] & (cpu->ctl[4] | cpu->irq_lines));
 }
 
 void set_ctl_reg(struct nios2 *cpu, int reg, uint32_t val)
 {
     cpu->ctl[reg & 0x1f] = val;
+    update_irq_pending(cpu);
+}
+
+// Devices assert/deassert their interrupt line with this
+void set_irq_line(struct nios2 *cpu, int irq, int level)
+{
+    if (level) {
+        cpu->irq_lines |= 1u << irq;
+    } else {
+        cpu->irq_lines &= ~(1u << irq);
+    }
+    update_irq_pending(cpu);
+    cpu->block_exit = 1;
 }
 
 uint32_t _get_ctl_reg(long obj, long reg)
@@ -104,16 +262,76 @@ void _set_ctl_reg(long obj, long reg, uint32_t val)
     set_ctl_reg(cpu, reg, val);
 }
 
+// Throw away every basic block (the code they were built from changed).
+// The block currently executing may be among them, so they are only moved
+// to dead_blocks here and freed by the run loop once that block is done.
+void flush_blocks(struct nios2 *cpu)
+{
+    struct block *b = cpu->blocks;
+    while (b != NULL) {
+        struct block *next = b->all_next;
+        cpu->icache[b->pc >> ICACHE_PAGE_SHIFT]->blocks[(b->pc >> 2) & (ICACHE_PAGE_WORDS - 1)] = NULL;
+        b->all_next = cpu->dead_blocks;
+        cpu->dead_blocks = b;
+        b = next;
+    }
+    cpu->blocks = NULL;
+    cpu->block_exit = 1;
+}
+
+void free_dead_blocks(struct nios2 *cpu)
+{
+    while (cpu->dead_blocks != NULL) {
+        struct block *next = cpu->dead_blocks->all_next;
+        free(cpu->dead_blocks);
+        cpu->dead_blocks = next;
+    }
+}
+
+static void free_callees(struct callee_saved *head)
+{
+    while (head != NULL) {
+        struct callee_saved *prev = head->prev;
+        free(head);
+        head = prev;
+    }
+}
+
 void _del_nios2(long obj)
 {
     struct nios2 *cpu = (struct nios2 *)obj;
+    int seg;
 
     if (cpu == NULL) {
         return;
     }
 
-    if (cpu->mem != NULL) {
-        free(cpu->mem);
+    if (cpu->mem != NULL && cpu->mem != MAP_FAILED) {
+        munmap(cpu->mem, cpu->mem_len);
+    }
+    free(cpu->page_state);
+    free(cpu->dirty_pages);
+    for (seg=0; seg<cpu->n_init_segs; seg++) {
+        free(cpu->init_segs[seg].data);
+    }
+    free(cpu->init_segs);
+    free(cpu->error);
+
+    free_callees(cpu->callee_stack_head);
+    free_callees(cpu->callee_free);
+
+    free_events(cpu);
+    free_mmios(cpu);
+
+    flush_blocks(cpu);
+    free_dead_blocks(cpu);
+
+    if (cpu->icache != NULL) {
+        size_t i;
+        for (i=0; i<(cpu->mem_len >> ICACHE_PAGE_SHIFT); i++) {
+            free(cpu->icache[i]);
+        }
+        free(cpu->icache);
     }
 
     free(cpu);
@@ -148,14 +366,12 @@ void _print_regs(long obj)
 // Don't use, just call loadword a bunch
 void _print_mem(long obj)
 {
-    struct nios2 *cpu = (struct nios2*)obj;
     int i;
-    uint32_t *p = (uint32_t*)cpu->mem;
     for (i=0; i<0x100; i+=4) {
         if ((i % 16)==0) {
             printf("\n0x%08x:", i);
         }
-        printf("  %08x", p[i/4]);
+        printf("  %08x", _loadword(obj, i));
     }
     printf("\n");
     _print_regs(obj);
@@ -167,6 +383,8 @@ void error_printf(struct nios2 *cpu, const char *fmt, ...)
     va_list ap;
     int size = 0;
 
+    cpu->n_errors++;
+
     va_start(ap, fmt);
     size = vsnprintf(NULL, size, fmt, ap);
     va_end(ap);
@@ -200,61 +418,131 @@ void error_printf(struct nios2 *cpu, const char *fmt, ...)
 
 //////////////////////
 // Memory Access
+static inline struct mmio_page *find_mmio_page(struct nios2 *cpu, uint32_t page)
+{
+    struct mmio_page *p = cpu->mmio_last;
+    if (p != NULL && p->page == page) {
+        return p;
+    }
+    for (p=cpu->mmio_pages[page & (MMIO_HASH_SIZE - 1)]; p!=NULL; p=p->next) {
+        if (p->page == page) {
+            cpu->mmio_last = p;
+            return p;
+        }
+    }
+    return NULL;
+}
+
+static inline struct mmio *find_mmio(struct nios2 *cpu, uint32_t addr)
+{
+    struct mmio_page *p = find_mmio_page(cpu, addr >> MMIO_PAGE_SHIFT);
+    if (p == NULL) {
+        return NULL;
+    }
+    struct mmio *m = p->regs[(addr >> 2) & (MMIO_PAGE_WORDS - 1)];
+    if (m == NULL || addr - m->addr >= m->size) {
+        return NULL;
+    }
+    return m;
+}
+
 uint32_t access_mmio(struct nios2 *cpu, uint32_t addr, uint32_t val, int is_store)
 {
-    int i;
-    for (i=0; i<MAX_MMIOS; i++) {
-        if (cpu->mmios[i].addr == addr) {
-            //printf("Found at %d, callback %p\n", i, cpu->mmios[i].callback);
+    struct mmio *m = find_mmio(cpu, addr);
+    if (m != NULL && m->dev != NULL) {
+        if (device_has_reg(m->dev, addr - m->addr)) {
+            return device_access(cpu, m->dev, addr - m->addr, val, is_store);
+        }
+        m = NULL;   // between its registers, as out of bounds as unmapped
+    }
+    if (m != NULL) {
+        // The callback may halt us, raise an interrupt, etc.
+        cpu->block_exit = 1;
 
-            uint32_t ret = 0;
-            PyObject *args;
+        // The run loop doesn't hold the GIL, take it just for the call
+        PyGILState_STATE gil = PyGILState_Ensure();
+
+        uint32_t ret = 0;
+        PyObject *args;
+        if (m->ranged) {
             if (is_store) {
-               args = Py_BuildValue("(l)", val);
+                args = Py_BuildValue("(kl)", (unsigned long)(addr - m->addr), val);
             } else {
-                //Py_INCREF(Py_None);
-                args = Py_BuildValue("()");
-            }
-            PyObject *result = PyEval_CallObject(cpu->mmios[i].callback, args);
-            if (result && PyLong_Check(result)) {
-                ret = PyLong_AsLong(result);
+                args = Py_BuildValue("(k)", (unsigned long)(addr - m->addr));
             }
-            Py_XDECREF(result);
-            Py_DECREF(args);
-            return ret;
+        } else if (is_store) {
+           args = Py_BuildValue("(l)", val);
+        } else {
+            //Py_INCREF(Py_None);
+            args = Py_BuildValue("()");
         }
+        PyObject *result = PyObject_CallObject(m->callback, args);
+        if (result && PyLong_Check(result)) {
+            ret = PyLong_AsLong(result);
+        }
+        Py_XDECREF(result);
+        Py_DECREF(args);
+
+        PyGILState_Release(gil);
+        return ret;
     }
     // MMIO not found...halt cpu
     cpu->halted = 1;
+    cpu->block_exit = 1;
 
     error_printf(cpu, "ERROR: access out of bound memory: 0x%08x\n", addr);
     return 0;
 }
 
-uint32_t loadword(struct nios2 *cpu, uint32_t addr)
+// Drop the cached decoding of the word containing addr (after a store to it).
+// Stores to plain data never decoded stay cheap; overwriting code also
+// flushes all basic blocks.
+static inline void invalidate_decoded(struct nios2 *cpu, uint32_t addr)
 {
+    struct code_page *page = cpu->icache[addr >> ICACHE_PAGE_SHIFT];
+    if (page != NULL) {
+        struct decoded *d = &page->instrs[(addr >> 2) & (ICACHE_PAGE_WORDS - 1)];
+        if (d->handler != OP_DECODE) {
+            d->handler = OP_DECODE;
+            flush_blocks(cpu);
+        }
+    }
+}
+
+static inline int page_present(struct nios2 *cpu, uint32_t addr)
+{
+    return cpu->page_state[addr >> MEM_PAGE_SHIFT] & PAGE_PRESENT;
+}
 
-    uint32_t *p = (uint32_t *)cpu->mem;
-    uint32_t off = addr/4;
+static inline int page_dirty(struct nios2 *cpu, uint32_t addr)
+{
+    return cpu->page_state[addr >> MEM_PAGE_SHIFT] & PAGE_DIRTY;
+}
 
-    if (addr > cpu->mem_len) {
+static inline uint32_t loadword(struct nios2 *cpu, uint32_t addr)
+{
+    if (addr >= cpu->mem_len) {
         // lookup mmio
         return access_mmio(cpu, addr, 0, 0);
     }
-    return p[off];
+    if (!page_present(cpu, addr)) {
+        return MEM_FILL * 0x01010101u;
+    }
+    return *(uint32_t *)(cpu->mem + (addr & ~3));
 }
 
-void storeword(struct nios2 *cpu, uint32_t addr, uint32_t val)
+static inline void storeword(struct nios2 *cpu, uint32_t addr, uint32_t val)
 {
-    uint32_t *p = (uint32_t *)cpu->mem;
-    uint32_t off = addr/4;
-
-    if (addr > cpu->mem_len) {
+    if (addr >= cpu->mem_len) {
         // lookup mmi
         access_mmio(cpu, addr, val, 1);
         return;
     }
-    p[off] = val;
+    if (!page_dirty(cpu, addr)) {
+        dirty_page(cpu, addr);
+    }
+    invalidate_decoded(cpu, addr);
+    *(uint32_t *)(cpu->mem + (addr & ~3)) = val;
 }
 
 uint32_t _loadword(long obj, uint32_t addr)
@@ -269,71 +557,360 @@ void _storeword(long obj, uint32_t addr, uint32_t val)
     storeword(cpu, addr, val);
 }
 
+// Drop the cached decodings of every word in [addr, addr+len)
+static void invalidate_range(struct nios2 *cpu, uint32_t addr, size_t len)
+{
+    uint32_t a;
+    for (a=addr & ~3; a<addr+len; a+=4) {
+        if (cpu->icache[a >> ICACHE_PAGE_SHIFT] == NULL) {
+            a |= (1 << ICACHE_PAGE_SHIFT) - 4;
+            continue;
+        }
+        invalidate_decoded(cpu, a);
+    }
+}
+
+// Bulk copies between RAM and buf, a page at a time, so a whole array costs
+// one call rather than one per word. Only RAM is copied: both return 0 if
+// [addr, addr+len) doesn't fit in it.
+size_t _read_mem(long obj, uint32_t addr, char *buf, size_t len)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    size_t done = 0;
 
-void _add_mmio(long obj, uint32_t addr, PyObject *callback)
+    if (addr > cpu->mem_len || len > cpu->mem_len - addr) {
+        return 0;
+    }
+    while (done < len) {
+        uint32_t a = addr + done;
+        size_t n = MEM_PAGE_SIZE - (a & (MEM_PAGE_SIZE - 1));
+        if (n > len - done) {
+            n = len - done;
+        }
+        if (page_present(cpu, a)) {
+            memcpy(buf + done, cpu->mem + a, n);
+        } else {
+            memset(buf + done, MEM_FILL, n);
+        }
+        done += n;
+    }
+    return done;
+}
+
+size_t _write_mem(long obj, uint32_t addr, const char *buf, size_t len)
 {
     struct nios2 *cpu = (struct nios2 *)obj;
-    int i;
-    for (i=0; i<MAX_MMIOS; i++) {
-        if ((cpu->mmios[i].addr == addr) || cpu->mmios[i].addr == 0) {
-            //printf("Adding MMIO 0x%08x to mmios[%d], callback %p\n", addr, i, callback);
-            if (cpu->mmios[i].callback != NULL) {
-                Py_XDECREF(cpu->mmios[i].callback);
+    size_t done = 0;
+
+    if (addr > cpu->mem_len || len > cpu->mem_len - addr) {
+        return 0;
+    }
+    while (done < len) {
+        uint32_t a = addr + done;
+        size_t n = MEM_PAGE_SIZE - (a & (MEM_PAGE_SIZE - 1));
+        if (n > len - done) {
+            n = len - done;
+        }
+        if (!page_dirty(cpu, a)) {
+            dirty_page(cpu, a);
+        }
+        memcpy(cpu->mem + a, buf + done, n);
+        done += n;
+    }
+    invalidate_range(cpu, addr, len);
+    return done;
+}
+
+// Fills in the pages of [addr, addr+len) and returns where they are, for
+// reading RAM in place. Filled-in pages stay valid across resets (see
+// restore_page()), so the pointer does too. NULL if it doesn't fit in RAM.
+const unsigned char *_map_mem(long obj, uint32_t addr, size_t len)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    uint32_t a;
+
+    if (addr > cpu->mem_len || len > cpu->mem_len - addr) {
+        return NULL;
+    }
+    for (a=addr & ~(MEM_PAGE_SIZE - 1); a<addr+len; a+=MEM_PAGE_SIZE) {
+        if (!page_present(cpu, a)) {
+            touch_page(cpu, a);
+        }
+    }
+    return cpu->mem + addr;
+}
+
+
+static void free_mmio(struct mmio *m)
+{
+    Py_XDECREF(m->callback);
+    if (m->dev != NULL) {
+        free_device(m->dev);
+    }
+    free(m);
+}
+
+// Drops one word's reference to m, freeing it once nothing maps to it
+static void unref_mmio(struct nios2 *cpu, struct mmio *m)
+{
+    if (--m->nwords > 0) {
+        return;
+    }
+    struct mmio **pm = &cpu->mmio_list;
+    while (*pm != m) {
+        pm = &(*pm)->all_next;
+    }
+    *pm = m->all_next;
+    free_mmio(m);
+}
+
+// Points every word of addr..addr+size-1 at m, replacing whatever was
+// registered there before
+static void map_mmio(struct nios2 *cpu, struct mmio *m)
+{
+    uint64_t addr = m->addr & ~3;
+    uint64_t end = (uint64_t)m->addr + m->size;
+    for (; addr<end; addr+=4) {
+        uint32_t page = addr >> MMIO_PAGE_SHIFT;
+        struct mmio_page *p = find_mmio_page(cpu, page);
+        if (p == NULL) {
+            p = calloc(1, sizeof(struct mmio_page));
+            if (p == NULL) {
+                return;
             }
-            Py_XINCREF(callback);
-            cpu->mmios[i].addr = addr;
-            cpu->mmios[i].callback = callback;
-            return;
+            p->page = page;
+            p->next = cpu->mmio_pages[page & (MMIO_HASH_SIZE - 1)];
+            cpu->mmio_pages[page & (MMIO_HASH_SIZE - 1)] = p;
+        }
+        struct mmio **reg = &p->regs[(addr >> 2) & (MMIO_PAGE_WORDS - 1)];
+        if (*reg != NULL) {
+            unref_mmio(cpu, *reg);
         }
+        *reg = m;
+        m->nwords++;
     }
 }
 
-uint16_t loadhalfword(struct nios2 *cpu, uint32_t addr)
+static struct mmio *add_mmio(struct nios2 *cpu, uint32_t addr, uint32_t size,
+                             int ranged, PyObject *callback, struct device *dev)
 {
-    uint16_t *p = (uint16_t *)cpu->mem;
-    uint32_t off = addr/2;
+    if (size == 0) {
+        return NULL;
+    }
+    if ((uint64_t)addr + size > 0x100000000ULL) {
+        size = 0 - addr;
+    }
 
-    if (addr > cpu->mem_len) {
-        return (uint16_t)access_mmio(cpu, addr, 0, 0);
+    struct mmio *m = malloc(sizeof(struct mmio));
+    if (m == NULL) {
+        return NULL;
+    }
+    Py_XINCREF(callback);
+    m->addr = addr;
+    m->size = size;
+    m->ranged = ranged;
+    m->callback = callback;
+    m->dev = dev;
+    m->nwords = 0;
+    m->all_next = cpu->mmio_list;
+    cpu->mmio_list = m;
+    map_mmio(cpu, m);
+    return m;
+}
+
+void _add_mmio(long obj, uint32_t addr, PyObject *callback)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    //printf("Adding MMIO 0x%08x, callback %p\n", addr, callback);
+    add_mmio(cpu, addr, 1, 0, callback, NULL);
+}
+
+// One callback for a whole device, called with the offset into the range
+void _add_mmio_range(long obj, uint32_t addr, uint32_t size, PyObject *callback)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    add_mmio(cpu, addr, size, 1, callback, NULL);
+}
+
+// Maps a device simulated in C at addr (the cpu owns it from now on).
+// Returns a handle for reading its state back, or 0.
+long attach_device(struct nios2 *cpu, uint32_t addr, struct device *dev)
+{
+    if (dev == NULL) {
+        return 0;
+    }
+    if (add_mmio(cpu, addr, device_size(dev), 1, NULL, dev) == NULL) {
+        free_device(dev);
+        return 0;
+    }
+    return (long)dev;
+}
+
+long _add_device(long obj, uint32_t addr, int kind, uint32_t val, uint32_t n)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    return attach_device(cpu, addr, new_device(kind, val, n));
+}
+
+void free_mmios(struct nios2 *cpu)
+{
+    int i;
+    for (i=0; i<MMIO_HASH_SIZE; i++) {
+        while (cpu->mmio_pages[i] != NULL) {
+            struct mmio_page *next = cpu->mmio_pages[i]->next;
+            free(cpu->mmio_pages[i]);
+            cpu->mmio_pages[i] = next;
+        }
+    }
+    cpu->mmio_last = NULL;
+
+    while (cpu->mmio_list != NULL) {
+        struct mmio *next = cpu->mmio_list->all_next;
+        free_mmio(cpu->mmio_list);
+        cpu->mmio_list = next;
     }
-    return p[off];
 }
 
-void storehalfword(struct nios2 *cpu, uint32_t addr, uint16_t val)
+static inline uint16_t loadhalfword(struct nios2 *cpu, uint32_t addr)
 {
-    uint16_t *p = (uint16_t *)cpu->mem;
-    uint32_t off = addr/2;
+    if (addr >= cpu->mem_len) {
+        return (uint16_t)access_mmio(cpu, addr, 0, 0);
+    }
+    if (!page_present(cpu, addr)) {
+        return MEM_FILL * 0x0101u;
+    }
+    return *(uint16_t *)(cpu->mem + (addr & ~1));
+}
 
-    if (addr > cpu->mem_len) {
+static inline void storehalfword(struct nios2 *cpu, uint32_t addr, uint16_t val)
+{
+    if (addr >= cpu->mem_len) {
         access_mmio(cpu, addr, val, 1);
         return;
     }
-    p[off] = val;
+    if (!page_dirty(cpu, addr)) {
+        dirty_page(cpu, addr);
+    }
+    invalidate_decoded(cpu, addr);
+    *(uint16_t *)(cpu->mem + (addr & ~1)) = val;
 }
 
-uint8_t loadbyte(struct nios2 *cpu, uint32_t addr)
+static inline uint8_t loadbyte(struct nios2 *cpu, uint32_t addr)
 {
-    uint8_t *p = (uint8_t *)cpu->mem;
-    uint32_t off = addr;
-
-    if (addr > cpu->mem_len) {
+    if (addr >= cpu->mem_len) {
         return (uint8_t)access_mmio(cpu, addr, 0, 0);
     }
-    return p[off];
+    if (!page_present(cpu, addr)) {
+        return MEM_FILL;
+    }
+    return cpu->mem[addr];
 }
 
-void storebyte(struct nios2 *cpu, uint32_t addr, uint8_t val)
+static inline void storebyte(struct nios2 *cpu, uint32_t addr, uint8_t val)
 {
-    uint8_t *p = (uint8_t *)cpu->mem;
-    uint32_t off = addr/2;
-
-    if (addr > cpu->mem_len) {
+    if (addr >= cpu->mem_len) {
         access_mmio(cpu, addr, val, 1);
         return;
     }
-    p[off] = val;
+    if (!page_dirty(cpu, addr)) {
+        dirty_page(cpu, addr);
+    }
+    invalidate_decoded(cpu, addr);
+    cpu->mem[addr] = val;
+}
+
+
+// The word at addr of the initial image
+static inline uint32_t init_word(struct nios2 *cpu, uint32_t addr)
+{
+    uint32_t w;
+    init_bytes(cpu, addr, (unsigned char *)&w, 4);
+    return w;
+}
+
+// Puts a page written since the last reset back to its initial contents.
+// It stays filled in, so views of it from _map_mem() see the restored data.
+static void restore_page(struct nios2 *cpu, uint32_t pn)
+{
+    uint32_t base = pn << MEM_PAGE_SHIFT;
+    uint32_t addr;
+    int stale = 0;
+
+    // Words decoded from something the program wrote over the image are
+    // stale once it is restored. Decodings always match what is in memory
+    // (stores drop them), so comparing the words is enough.
+    for (addr=base; addr<base+MEM_PAGE_SIZE; addr+=4) {
+        struct code_page *page = cpu->icache[addr >> ICACHE_PAGE_SHIFT];
+        if (page == NULL) {
+            addr |= (1 << ICACHE_PAGE_SHIFT) - 4;
+            continue;
+        }
+        struct decoded *d = &page->instrs[(addr >> 2) & (ICACHE_PAGE_WORDS - 1)];
+        if (d->handler != OP_DECODE &&
+                *(uint32_t *)(cpu->mem + addr) != init_word(cpu, addr)) {
+            d->handler = OP_DECODE;
+            stale = 1;
+        }
+    }
+    if (stale) {
+        flush_blocks(cpu);
+    }
+
+    touch_page(cpu, base);
+    cpu->page_state[pn] &= ~PAGE_DIRTY;
 }
 
+// Puts the cpu back in its initial state, in place. Only the pages written
+// since the last reset are restored, so this costs what the test touched
+// rather than what RAM is. MMIOs stay registered (native devices go
+// back to their initial state) unless clear_mmio is set. Scheduled events
+// are dropped.
+void _reset_nios2(long obj, int clear_mmio)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+
+    size_t i;
+    for (i=0; i<cpu->n_dirty; i++) {
+        restore_page(cpu, cpu->dirty_pages[i]);
+    }
+    cpu->n_dirty = 0;
+    free_dead_blocks(cpu);
+    cpu->block_exit = 0;
+
+    cpu->halted = 0;
+    free(cpu->error);
+    cpu->error = NULL;
+
+    cpu->pc = 0;
+    memset(cpu->regs, 0, sizeof(uint32_t)*32);
+    memset(cpu->ctl, 0, sizeof(uint32_t)*32);
+    cpu->irq_pending = 0;
+    cpu->irq_lines = 0;
+
+    cpu->icount = 0;
+    free_events(cpu);
+
+    // Keep the popped frames around for reuse
+    while (cpu->callee_stack_head != NULL) {
+        struct callee_saved *prev = cpu->callee_stack_head->prev;
+        cpu->callee_stack_head->prev = cpu->callee_free;
+        cpu->callee_free = cpu->callee_stack_head;
+        cpu->callee_stack_head = prev;
+    }
+    memset(cpu->clobbered_history, 0, sizeof(struct clobbered)*MAX_CLOBBERED);
+    cpu->clobbered_idx = 0;
+
+    if (clear_mmio) {
+        free_mmios(cpu);
+    } else {
+        struct mmio *m;
+        for (m=cpu->mmio_list; m!=NULL; m=m->all_next) {
+            if (m->dev != NULL) {
+                reset_device(m->dev);
+            }
+        }
+    }
+}
 
 ///////////////
 // Helpers
@@ -354,7 +931,17 @@ uint32_t rotate_r32(uint32_t n, int m)
 void push_callees(struct nios2 *cpu)
 {
     struct callee_saved *head = cpu->callee_stack_head;
-    struct callee_saved *new = malloc(sizeof(struct callee_saved));
+    struct callee_saved *new = cpu->callee_free;
+
+    // Reuse a popped frame if we have one, calls are frequent
+    if (new != NULL) {
+        cpu->callee_free = new->prev;
+    } else {
+        new = malloc(sizeof(struct callee_saved));
+        if (new == NULL) {
+            return;
+        }
+    }
 
     // Just copy all the registers, only check the ones
     // we care about. This costs us 128+4(+4) bytes per frame....
@@ -442,7 +1029,8 @@ void check_callees(struct nios2 *cpu, int interrupt)
 
     // Pop this stack frame
     cpu->callee_stack_head = head->prev;
-    free(head);
+    head->prev = cpu->callee_free;
+    cpu->callee_free = head;
 }
 
 void do_interrupt(struct nios2 *cpu)
@@ -471,11 +1059,7 @@ void _interrupt_cpu(long obj)
 // or 0 otherwise
 int check_interrupt(struct nios2 *cpu)
 {
-    int PIE = get_ctl_reg(cpu, 0) & 1;
-    uint32_t ienable = get_ctl_reg(cpu, 3);
-    uint32_t ipending = get_ctl_reg(cpu, 4);
-
-    if (PIE && (ipending&ienable)) {
+    if (cpu->irq_pending) {
         do_interrupt(cpu);
         return 1;
     }
@@ -483,382 +1067,814 @@ int check_interrupt(struct nios2 *cpu)
 }
 
 ////////////////
-// R-types
-void handle_r_type(struct nios2 *cpu, uint32_t opx, uint32_t rA, uint32_t rB, uint32_t rC, int imm5)
+// Events
+//
+// Scheduled by instruction count (cpu->icount), kept in a list sorted by
+// when they are due. The run loop stops blocks at cpu->next_event, so an
+// event due at k fires after exactly k instructions, before the next one
+// is fetched.
+static void insert_event(struct nios2 *cpu, struct event *ev)
 {
-    switch (opx) {
-        case 0x01: // eret
-            check_callees(cpu, 1);
-            set_ctl_reg(cpu, 0, get_ctl_reg(cpu, 1));   // status = estatus
-            cpu->pc = get_reg(cpu, 29); // PC = ea
-            break;
-        case 0x02: // roli,
-            set_reg(cpu, rC, rotate_l32(get_reg(cpu, rA), imm5));
-            break;
-        case 0x03: // rol,
-            set_reg(cpu, rC, rotate_l32(get_reg(cpu, rA), get_reg(cpu, rB) & 0x1f));
-            break;
-        case 0x04: // flushp,
-            break;
-        case 0x05: // ret,
-            check_callees(cpu, 0);
-            cpu->pc = get_reg(cpu, 31);
-            break;
-        case 0x06: // nor,
-            set_reg(cpu, rC, ~(get_reg(cpu, rA) | get_reg(cpu, rB)));
-            break;
-        case 0x07: // mulxuu,
-            set_reg(cpu, rC, (((uint64_t)get_reg(cpu, rA)) * ((uint64_t)get_reg(cpu, rB))) >> 32);
-            break;
-        case 0x08: // cmpge,
-            if (((int32_t)get_reg(cpu, rA)) >= ((int32_t)get_reg(cpu, rB))) {
-                set_reg(cpu, rC, 1);
-            } else {
-                set_reg(cpu, rC, 0);
-            }
-            break;
-        case 0x09: // _bret,
-            break;  // unimplemented
-        case 0x0b: // ror,
-            set_reg(cpu, rC, rotate_r32(get_reg(cpu, rA), get_reg(cpu, rB) & 0x1f));
-            break;
-        case 0x0c: // flushi,
-            break;  // no cache
-        case 0x0d: // jmp,
-            cpu->pc = get_reg(cpu, rA);
+    struct event **pe = &cpu->events;
+    while (*pe != NULL && (*pe)->when <= ev->when) {
+        pe = &(*pe)->next;
+    }
+    ev->next = *pe;
+    *pe = ev;
+    cpu->next_event = cpu->events->when;
+}
+
+struct event *schedule_event(struct nios2 *cpu, int kind, uint64_t when, uint64_t period)
+{
+    struct event *ev = calloc(1, sizeof(struct event));
+    if (ev == NULL) {
+        return NULL;
+    }
+    ev->kind = kind;
+    ev->when = when;
+    ev->period = period;
+    insert_event(cpu, ev);
+    cpu->block_exit = 1;
+    return ev;
+}
+
+static void unlink_event(struct nios2 *cpu, struct event *ev)
+{
+    struct event **pe = &cpu->events;
+    while (*pe != NULL && *pe != ev) {
+        pe = &(*pe)->next;
+    }
+    if (*pe != NULL) {
+        *pe = ev->next;
+    }
+    cpu->next_event = cpu->events ? cpu->events->when : UINT64_MAX;
+}
+
+// Needs the GIL if ev has a callback
+static void free_event(struct event *ev)
+{
+    Py_XDECREF(ev->callback);
+    if (ev->dev != NULL) {
+        ev->dev->ev = NULL;
+    }
+    free(ev);
+}
+
+void cancel_event(struct nios2 *cpu, struct event *ev)
+{
+    unlink_event(cpu, ev);
+    free_event(ev);
+}
+
+void free_events(struct nios2 *cpu)
+{
+    if (cpu->events != NULL) {
+        // Callbacks may be released here
+        PyGILState_STATE gil = PyGILState_Ensure();
+        while (cpu->events != NULL) {
+            struct event *next = cpu->events->next;
+            free_event(cpu->events);
+            cpu->events = next;
+        }
+        PyGILState_Release(gil);
+    }
+    cpu->next_event = UINT64_MAX;
+}
+
+// Runs (and reschedules or frees) every event that is due
+void fire_events(struct nios2 *cpu)
+{
+    while (cpu->events != NULL && cpu->events->when <= cpu->icount) {
+        struct event *ev = cpu->events;
+        unlink_event(cpu, ev);
+
+        switch (ev->kind) {
+        case EV_IRQ:
+            set_ctl_reg(cpu, 4, cpu->ctl[4] | (1u << ev->irq));
             break;
-        case 0x0e: // _and,
-			set_reg(cpu, rC, get_reg(cpu, rA) & get_reg(cpu, rB));
-			break;
-        case 0x10: // cmplt,
-            if (((int32_t)get_reg(cpu, rA)) < ((int32_t)get_reg(cpu, rB))) {
-                set_reg(cpu, rC, 1);
-            } else {
-                set_reg(cpu, rC, 0);
-            }
+        case EV_CALL: {
+            PyGILState_STATE gil = PyGILState_Ensure();
+            PyObject *result = PyObject_CallObject(ev->callback, NULL);
+            Py_XDECREF(result);
+            PyGILState_Release(gil);
+            break;
+        }
+        case EV_TIMER:
+            timer_timeout(ev->dev);
+            break;
+        }
+
+        if (ev->period != 0) {
+            ev->when += ev->period;
+            insert_event(cpu, ev);
+        } else if (ev->callback != NULL) {
+            PyGILState_STATE gil = PyGILState_Ensure();
+            free_event(ev);
+            PyGILState_Release(gil);
+        } else {
+            free_event(ev);
+        }
+    }
+}
+
+// Sets bit irq of ipending once icount reaches when, and then every period
+// instructions if period isn't 0
+void _schedule_irq(long obj, int irq, uint64_t when, uint64_t period)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    struct event *ev = schedule_event(cpu, EV_IRQ, when, period);
+    if (ev != NULL) {
+        ev->irq = irq & 0x1f;
+    }
+}
+
+void _schedule_call(long obj, uint64_t when, uint64_t period, PyObject *callback)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    struct event *ev = schedule_event(cpu, EV_CALL, when, period);
+    if (ev != NULL) {
+        Py_XINCREF(callback);
+        ev->callback = callback;
+    }
+}
+
+uint64_t _get_icount(long obj)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    return cpu->icount;
+}
+
+////////////////
+// Decoder
+//
+// Each instruction word is decoded once into a struct decoded (see nios2.h)
+// and kept in a per-page table, so the hot loop only has to switch on a
+// dense handler index instead of re-extracting fields from the raw word.
+
+// R-type opx => handler
+static const uint8_t r_type_ops[64] = {
+    [0x01] = OP_ERET,
+    [0x02] = OP_ROLI,
+    [0x03] = OP_ROL,
+    [0x05] = OP_RET,
+    [0x06] = OP_NOR,
+    [0x07] = OP_MULXUU,
+    [0x08] = OP_CMPGE,
+    [0x0b] = OP_ROR,
+    [0x0d] = OP_JMP,
+    [0x0e] = OP_AND,
+    [0x10] = OP_CMPLT,
+    [0x12] = OP_SLLI,
+    [0x13] = OP_SLL,
+    [0x16] = OP_OR,
+    [0x17] = OP_MULXSU,
+    [0x18] = OP_CMPNE,
+    [0x1a] = OP_SRLI,
+    [0x1b] = OP_SRL,
+    [0x1c] = OP_NEXTPC,
+    [0x1d] = OP_CALLR,
+    [0x1e] = OP_XOR,
+    [0x1f] = OP_MULXSS,
+    [0x20] = OP_CMPEQ,
+    [0x24] = OP_DIVU,
+    [0x25] = OP_DIV,
+    [0x26] = OP_RDCTL,
+    [0x27] = OP_MUL,
+    [0x28] = OP_CMPGEU,
+    [0x2d] = OP_TRAP,
+    [0x2e] = OP_WRCTL,
+    [0x30] = OP_CMPLTU,
+    [0x31] = OP_ADD,
+    [0x34] = OP_BREAK,
+    [0x39] = OP_SUB,
+    [0x3a] = OP_SRAI,
+    [0x3b] = OP_SRA,
+    // flushp, bret, flushi, wrprs, initi, sync: no-ops
+};
+
+// I-type/J-type op => handler (the io variants share the normal handler)
+static const uint8_t i_type_ops[64] = {
+    [0x00] = OP_CALL,
+    [0x01] = OP_JMPI,
+    [0x03] = OP_LDBU,
+    [0x04] = OP_ADDI,
+    [0x05] = OP_STB,
+    [0x06] = OP_BR,
+    [0x07] = OP_LDB,
+    [0x08] = OP_CMPGEI,
+    [0x0b] = OP_LDHU,
+    [0x0c] = OP_ANDI,
+    [0x0d] = OP_STH,
+    [0x0e] = OP_BGE,
+    [0x0f] = OP_LDH,
+    [0x10] = OP_CMPLTI,
+    [0x14] = OP_ORI,
+    [0x15] = OP_STW,
+    [0x16] = OP_BLT,
+    [0x17] = OP_LDW,
+    [0x18] = OP_CMPNEI,
+    [0x1c] = OP_XORI,
+    [0x1e] = OP_BNE,
+    [0x20] = OP_CMPEQI,
+    [0x23] = OP_LDBU,   // ldbuio
+    [0x24] = OP_MULI,
+    [0x25] = OP_STB,    // stbio
+    [0x26] = OP_BEQ,
+    [0x27] = OP_LDB,    // ldbio
+    [0x28] = OP_CMPGEUI,
+    [0x2b] = OP_LDHU,   // ldhuio
+    [0x2c] = OP_ANDHI,
+    [0x2d] = OP_STH,    // sthio
+    [0x2e] = OP_BGEU,
+    [0x2f] = OP_LDH,    // ldhio
+    [0x30] = OP_CMPLTUI,
+    [0x34] = OP_ORHI,
+    [0x35] = OP_STW,    // stwio
+    [0x36] = OP_BLTU,
+    [0x37] = OP_LDW,    // ldwio
+    [0x3c] = OP_XORHI,
+    // rdprs, initda, flushda, initd, flushd: no-ops
+};
+
+void decode_instr(uint32_t instr, struct decoded *d)
+{
+    int op = instr & 0x3f;
+
+    d->rA = (instr >> 27);
+    d->rB = (instr >> 22) & 0x1f;
+    d->rC = (instr >> 17) & 0x1f;
+
+    if (op == 0x3a) {
+        uint32_t opx = (instr >> 11) & 0x3f;
+        d->handler = r_type_ops[opx];
+        d->imm = (instr >> 6) & 0x1f;
+    } else {
+        d->handler = i_type_ops[op];
+        switch (d->handler) {
+            case OP_CALL:
+            case OP_JMPI:
+                d->imm = ((instr >> 6) & 0x3ffffff) << 2;
+                break;
+            case OP_ANDI:
+            case OP_ORI:
+            case OP_XORI:
+            case OP_CMPGEUI:
+            case OP_CMPLTUI:
+                d->imm = (instr >> 6) & 0xffff;
+                break;
+            case OP_ANDHI:
+            case OP_ORHI:
+            case OP_XORHI:
+                d->imm = ((instr >> 6) & 0xffff) << 16;
+                break;
+            default:
+                d->imm = (int16_t)((instr >> 6) & 0xffff);
+                break;
+        }
+    }
+    if (d->handler == OP_DECODE) {
+        d->handler = OP_NOP;
+    }
+}
+
+static inline struct code_page *get_code_page(struct nios2 *cpu, uint32_t addr)
+{
+    struct code_page *page = cpu->icache[addr >> ICACHE_PAGE_SHIFT];
+    if (page == NULL) {
+        page = calloc(1, sizeof(struct code_page));
+        cpu->icache[addr >> ICACHE_PAGE_SHIFT] = page;
+    }
+    return page;
+}
+
+// Returns the cached decoding of the word at addr, decoding it on a miss.
+// Words outside of RAM are not cached, and are decoded into *tmp instead.
+static inline struct decoded *fetch_decoded(struct nios2 *cpu, uint32_t addr,
+                                            struct decoded *tmp)
+{
+    if (addr < cpu->mem_len) {
+        struct code_page *page = get_code_page(cpu, addr);
+        if (page == NULL) {
+            decode_instr(loadword(cpu, addr), tmp);
+            return tmp;
+        }
+        struct decoded *d = &page->instrs[(addr >> 2) & (ICACHE_PAGE_WORDS - 1)];
+        if (d->handler == OP_DECODE) {
+            decode_instr(loadword(cpu, addr), d);
+        }
+        return d;
+    }
+    decode_instr(loadword(cpu, addr), tmp);
+    return tmp;
+}
+
+////////////////
+// Execute
+static inline __attribute__((always_inline)) void execute(struct nios2 *cpu, struct decoded d)
+{
+    uint32_t rA = d.rA;
+    uint32_t rB = d.rB;
+    uint32_t rC = d.rC;
+    int32_t  imm = d.imm;
+    uint32_t ea;
+
+    switch (d.handler) {
+        case OP_NOP:
+            break;
+
+        /////////////////
+        // J-types:
+        case OP_CALL:
+            set_reg(cpu, 31, cpu->pc);
+            push_callees(cpu);
+            cpu->pc = (cpu->pc & 0xf0000000) | imm;
+            break;
+        case OP_JMPI:
+            cpu->pc = (cpu->pc & 0xf0000000) | imm;
+            break;
+
+        /////////////////
+        // R-types:
+        case OP_ERET:
+            check_callees(cpu, 1);
+            set_ctl_reg(cpu, 0, get_ctl_reg(cpu, 1));   // status = estatus
+            cpu->pc = get_reg(cpu, 29); // PC = ea
+            break;
+        case OP_ROLI:
+            set_reg(cpu, rC, rotate_l32(get_reg(cpu, rA), imm));
+            break;
+        case OP_ROL:
+            set_reg(cpu, rC, rotate_l32(get_reg(cpu, rA), get_reg(cpu, rB) & 0x1f));
+            break;
+        case OP_RET:
+            check_callees(cpu, 0);
+            cpu->pc = get_reg(cpu, 31);
+            break;
+        case OP_NOR:
+            set_reg(cpu, rC, ~(get_reg(cpu, rA) | get_reg(cpu, rB)));
+            break;
+        case OP_MULXUU:
+            set_reg(cpu, rC, (((uint64_t)get_reg(cpu, rA)) * ((uint64_t)get_reg(cpu, rB))) >> 32);
+            break;
+        case OP_CMPGE:
+            set_reg(cpu, rC, ((int32_t)get_reg(cpu, rA)) >= ((int32_t)get_reg(cpu, rB)));
+            break;
+        case OP_ROR:
+            set_reg(cpu, rC, rotate_r32(get_reg(cpu, rA), get_reg(cpu, rB) & 0x1f));
+            break;
+        case OP_JMP:
+            cpu->pc = get_reg(cpu, rA);
+            break;
+        case OP_AND:
+            set_reg(cpu, rC, get_reg(cpu, rA) & get_reg(cpu, rB));
+            break;
+        case OP_CMPLT:
+            set_reg(cpu, rC, ((int32_t)get_reg(cpu, rA)) < ((int32_t)get_reg(cpu, rB)));
             break;
-        case 0x12: // slli,
-            set_reg(cpu, rC, get_reg(cpu, rA) << imm5);
+        case OP_SLLI:
+            set_reg(cpu, rC, get_reg(cpu, rA) << imm);
             break;
-        case 0x13: // sll,
+        case OP_SLL:
             set_reg(cpu, rC, get_reg(cpu, rA) << (get_reg(cpu, rB) & 0x1f));
             break;
-        case 0x14: // wrprs,
-            break;  //unimplemented
-        case 0x16: // _or,
+        case OP_OR:
             set_reg(cpu, rC, get_reg(cpu, rA) | get_reg(cpu, rB));
             break;
-        case 0x17: // mulxsu,
+        case OP_MULXSU:
             set_reg(cpu, rC, (((int64_t)get_reg(cpu, rA)) * ((uint64_t)get_reg(cpu, rB))) >> 32);
             break;
-        case 0x18: // cmpne,
-            if (get_reg(cpu, rA) != get_reg(cpu, rB)) {
-                set_reg(cpu, rC, 1);
-            } else {
-                set_reg(cpu, rC, 0);
-            }
+        case OP_CMPNE:
+            set_reg(cpu, rC, get_reg(cpu, rA) != get_reg(cpu, rB));
             break;
-        case 0x1a: // srli,
-            set_reg(cpu, rC, get_reg(cpu, rA) >> imm5);
+        case OP_SRLI:
+            set_reg(cpu, rC, get_reg(cpu, rA) >> imm);
             break;
-        case 0x1b: // srl,
+        case OP_SRL:
             set_reg(cpu, rC, get_reg(cpu, rA) >> (get_reg(cpu, rB) & 0x1f));
             break;
-        case 0x1c: // nextpc,
+        case OP_NEXTPC:
             set_reg(cpu, rC, cpu->pc);
             break;
-        case 0x1d: // callr,
+        case OP_CALLR:
             set_reg(cpu, 31, cpu->pc);
             push_callees(cpu);
             cpu->pc = get_reg(cpu, rA);
             break;
-        case 0x1e: // xor,
+        case OP_XOR:
             set_reg(cpu, rC, get_reg(cpu, rA) ^ get_reg(cpu, rB));
             break;
-        case 0x1f: // mulxss,
+        case OP_MULXSS:
             set_reg(cpu, rC, (((int64_t)get_reg(cpu, rA)) * ((int64_t)get_reg(cpu, rB))) >> 32);
             break;
-        case 0x20: // cmpeq,
-            if (get_reg(cpu, rA) == get_reg(cpu, rB)) {
-                set_reg(cpu, rC, 1);
-            } else {
-                set_reg(cpu, rC, 0);
-            }
+        case OP_CMPEQ:
+            set_reg(cpu, rC, get_reg(cpu, rA) == get_reg(cpu, rB));
             break;
-        case 0x24: // divu,
+        case OP_DIVU:
             if (get_reg(cpu, rB) != 0) {
                 set_reg(cpu, rC, get_reg(cpu, rA) / get_reg(cpu, rB));
             }
             break;
-        case 0x25: // div,
+        case OP_DIV:
             if (get_reg(cpu, rB) != 0) {
                 set_reg(cpu, rC, (uint32_t)((int32_t)get_reg(cpu, rA) / ((int32_t)get_reg(cpu, rB))));
             }
             break;
-        case 0x26: // rdctl
-            set_reg(cpu, rC, get_ctl_reg(cpu, imm5));
+        case OP_RDCTL:
+            set_reg(cpu, rC, get_ctl_reg(cpu, imm));
             break;
-        case 0x27: // mul,
+        case OP_MUL:
             set_reg(cpu, rC, get_reg(cpu, rA) * get_reg(cpu, rB));
             break;
-        case 0x28: // cmpgeu,
-            if (get_reg(cpu, rA) >= get_reg(cpu, rB)) {
-                set_reg(cpu, rC, 1);
-            } else {
-                set_reg(cpu, rC, 0);
-            }
-            break;
-        case 0x29: // initi,
+        case OP_CMPGEU:
+            set_reg(cpu, rC, get_reg(cpu, rA) >= get_reg(cpu, rB));
             break;
-        case 0x2d: // trap,
+        case OP_TRAP:
             do_interrupt(cpu);
             break;
-        case 0x2e: // wrctl,
-            set_ctl_reg(cpu, imm5, get_reg(cpu, rA));
+        case OP_WRCTL:
+            set_ctl_reg(cpu, imm, get_reg(cpu, rA));
             break;
-        case 0x30: // cmpltu,
-            if (get_reg(cpu, rA) < get_reg(cpu, rB)) {
-                set_reg(cpu, rC, 1);
-            } else {
-                set_reg(cpu, rC, 0);
-            }
+        case OP_CMPLTU:
+            set_reg(cpu, rC, get_reg(cpu, rA) < get_reg(cpu, rB));
+            break;
+        case OP_ADD:
+            set_reg(cpu, rC, get_reg(cpu, rA) + get_reg(cpu, rB));
             break;
-        case 0x31: // add,
-			set_reg(cpu, rC, get_reg(cpu, rA) + get_reg(cpu, rB));
-			break;
-        case 0x34: // _break,
-			cpu->halted = 1;
-			break;
-        case 0x36: // sync,
+        case OP_BREAK:
+            cpu->halted = 1;
             break;
-        case 0x39: // sub,
+        case OP_SUB:
             set_reg(cpu, rC, get_reg(cpu, rA) - get_reg(cpu, rB));
             break;
-        case 0x3a: // srai,
-            set_reg(cpu, rC, ((int32_t)get_reg(cpu, rA)) >> imm5);
+        case OP_SRAI:
+            set_reg(cpu, rC, ((int32_t)get_reg(cpu, rA)) >> imm);
             break;
-        case 0x3b: // sra,
+        case OP_SRA:
             set_reg(cpu, rC, ((int32_t)get_reg(cpu, rA)) >> (get_reg(cpu, rB) & 0x1f));
             break;
-    }
-}
-
-void one_instr(struct nios2 *cpu)
-{
-    uint32_t instr = loadword(cpu, cpu->pc);
-    int op = instr & 0x3f;
-
-    uint32_t imm26   = (instr >> 6) & 0x3ffffff;
-    uint32_t rA      = (instr >> 27);
-    uint32_t rB      = (instr >> 22) & 0x1f;
-    uint32_t rC      = (instr >> 17) & 0x1f;
-    uint32_t opx     = (instr >> 11) & 0x3f;
-    uint32_t imm5    = (instr >> 6) & 0x1f;
-    int16_t  imm16   = (instr >> 6) & 0xffff;
-    uint32_t ea      = get_reg(cpu, rA) + imm16;
-
-    // Increment PC
-    cpu->pc += 4;
-
-    // Maybe interrupt here...
-    if (check_interrupt(cpu) == 1) {
-        return;
-    }
-
-    switch (op) {
-        /////////////////
-        // J-types:
-        case 0x00:  // call
-            set_reg(cpu, 31, cpu->pc);
-            push_callees(cpu);
-            cpu->pc = (cpu->pc & 0xf0000000) | (imm26 << 2);
-            break;
-        case 0x01:  // jmpi
-            cpu->pc = (cpu->pc & 0xf0000000) | (imm26 << 2);
-            break;
-        case 0x38:  // rdprs
-            // Unimplemented
-            break;
-
-        /////////////////
-        // R-types:
-        case 0x3a:
-            handle_r_type(cpu, opx, rA, rB, rC, imm5);
-            break;
 
         ////////////////
         // I-types:
-        case 0x03: //ldbu,
+        case OP_LDBU:
+            ea = get_reg(cpu, rA) + imm;
             set_reg(cpu, rB, loadbyte(cpu, ea));
             break;
-        case 0x04: //addi,
-			set_reg(cpu, rB, get_reg(cpu, rA) + (int32_t)imm16);
-			break;
-        case 0x05: //stb,
+        case OP_ADDI:
+            set_reg(cpu, rB, get_reg(cpu, rA) + imm);
+            break;
+        case OP_STB:
+            ea = get_reg(cpu, rA) + imm;
             storebyte(cpu, ea, get_reg(cpu, rB) & 0xff);
             break;
-        case 0x06: //br,
-            cpu->pc += imm16;
+        case OP_BR:
+            cpu->pc += imm;
             break;
-        case 0x07: //ldb,
+        case OP_LDB:
+            ea = get_reg(cpu, rA) + imm;
             set_reg(cpu, rB, (int8_t)loadbyte(cpu, ea));
             break;
-        case 0x08: //cmpgei,
-            if (((int32_t)get_reg(cpu, rA)) >= imm16) {
-                set_reg(cpu, rB, 1);
-            } else {
-                set_reg(cpu, rB, 0);
-            }
+        case OP_CMPGEI:
+            set_reg(cpu, rB, ((int32_t)get_reg(cpu, rA)) >= imm);
             break;
-        case 0x0b: //ldhu,
+        case OP_LDHU:
+            ea = get_reg(cpu, rA) + imm;
             set_reg(cpu, rB, loadhalfword(cpu, ea));
             break;
-        case 0x0c: //andi,
-            set_reg(cpu, rB, get_reg(cpu, rA) & (uint32_t)imm16);
+        case OP_ANDI:
+        case OP_ANDHI:
+            set_reg(cpu, rB, get_reg(cpu, rA) & (uint32_t)imm);
             break;
-        case 0x0d: //sth,
+        case OP_STH:
+            ea = get_reg(cpu, rA) + imm;
             storehalfword(cpu, ea, get_reg(cpu, rB) & 0xffff);
             break;
-        case 0x0e: //bge,
+        case OP_BGE:
             if (((int32_t)get_reg(cpu, rA)) >= ((int32_t)get_reg(cpu, rB))) {
-                cpu->pc += imm16;
+                cpu->pc += imm;
             }
             break;
-        case 0x0f: //ldh,
+        case OP_LDH:
+            ea = get_reg(cpu, rA) + imm;
             set_reg(cpu, rB, (int16_t)loadhalfword(cpu, ea));
             break;
-        case 0x10: //cmplti,
-            if (((int32_t)get_reg(cpu, rA)) < imm16) {
-                set_reg(cpu, rB, 1);
-            } else {
-                set_reg(cpu, rB, 0);
-            }
-            break;
-        case 0x13: //initda,
+        case OP_CMPLTI:
+            set_reg(cpu, rB, ((int32_t)get_reg(cpu, rA)) < imm);
             break;
-        case 0x14: //ori,
-            set_reg(cpu, rB, get_reg(cpu, rA) | ((uint32_t)imm16));
+        case OP_ORI:
+        case OP_ORHI:
+            set_reg(cpu, rB, get_reg(cpu, rA) | (uint32_t)imm);
             break;
-        case 0x15: //stw,
+        case OP_STW:
+            ea = get_reg(cpu, rA) + imm;
             storeword(cpu, ea, get_reg(cpu, rB));
             break;
-        case 0x16: //blt,
+        case OP_BLT:
             if (((int32_t)get_reg(cpu, rA)) < ((int32_t)get_reg(cpu, rB))) {
-                cpu->pc += imm16;
+                cpu->pc += imm;
             }
             break;
-        case 0x17: //ldw,
+        case OP_LDW:
+            ea = get_reg(cpu, rA) + imm;
             set_reg(cpu, rB, loadword(cpu, ea));
             break;
-        case 0x18: //cmpnei,
-            if (get_reg(cpu, rA) != imm16) {
-                set_reg(cpu, rB, 1);
-            } else {
-                set_reg(cpu, rB, 0);
-            }
-            break;
-        case 0x1b: //flushda,
+        case OP_CMPNEI:
+            set_reg(cpu, rB, get_reg(cpu, rA) != (uint32_t)imm);
             break;
-        case 0x1c: //xori,
-            set_reg(cpu, rB, get_reg(cpu, rA) ^ (uint32_t)imm16);
+        case OP_XORI:
+        case OP_XORHI:
+            set_reg(cpu, rB, get_reg(cpu, rA) ^ (uint32_t)imm);
             break;
-        case 0x1e: //bne,
+        case OP_BNE:
             if (get_reg(cpu, rA) != get_reg(cpu, rB)) {
-                cpu->pc += imm16;
+                cpu->pc += imm;
             }
             break;
-        case 0x20: //cmpeqi,
-            if (get_reg(cpu, rA) == imm16) {
-                set_reg(cpu, rB, 1);
-            } else {
-                set_reg(cpu, rB, 0);
-            }
+        case OP_CMPEQI:
+            set_reg(cpu, rB, get_reg(cpu, rA) == (uint32_t)imm);
             break;
-        case 0x23: //ldbu,   # ldbuio
-            set_reg(cpu, rB, (uint8_t)loadbyte(cpu, ea));
+        case OP_MULI:
+            set_reg(cpu, rB, get_reg(cpu, rA) * imm);
             break;
-        case 0x24: //muli,
-            set_reg(cpu, rB, get_reg(cpu, rA) * (int32_t)imm16);
-            break;
-        case 0x25: //stb,    # stbio
-            storebyte(cpu, ea, get_reg(cpu, rB) & 0xff);
-            break;
-        case 0x26: //beq,
+        case OP_BEQ:
             if (get_reg(cpu, rA) == get_reg(cpu, rB)) {
-                cpu->pc += imm16;
-            }
-            break;
-        case 0x27: //ldb,    # ldbio
-            set_reg(cpu, rB, (int8_t)loadbyte(cpu, ea));
-            break;
-        case 0x28: //cmpgeui,
-            if (get_reg(cpu, rA) >= (uint32_t)imm16) {
-                set_reg(cpu, rB, 1);
-            } else {
-                set_reg(cpu, rB, 0);
+                cpu->pc += imm;
             }
             break;
-        case 0x2b: //ldhu,   # ldhuio
-            set_reg(cpu, rB, loadhalfword(cpu, ea));
-            break;
-        case 0x2c: //andhi,
-            set_reg(cpu, rB, get_reg(cpu, rA) & (((uint32_t)imm16) << 16));
+        case OP_CMPGEUI:
+            set_reg(cpu, rB, get_reg(cpu, rA) >= (uint32_t)imm);
             break;
-        case 0x2d: //sth,    # sthio
-            storehalfword(cpu, ea, get_reg(cpu, rB) & 0xffff);
-            break;
-        case 0x2e: //bgeu,
+        case OP_BGEU:
             if (get_reg(cpu, rA) >= get_reg(cpu, rB)) {
-                cpu->pc += imm16;
-            }
-            break;
-        case 0x2f: //ldh,    # ldhio
-            set_reg(cpu, rB, (int16_t)loadhalfword(cpu, ea));
-            break;
-        case 0x30: //cmpltui,
-            if (get_reg(cpu, rA) < (uint32_t)imm16) {
-                set_reg(cpu, rB, 1);
-            } else {
-                set_reg(cpu, rB, 0);
+                cpu->pc += imm;
             }
             break;
-        case 0x33: //initd,
-            break;
-        case 0x34: //orhi,
-            set_reg(cpu, rB, get_reg(cpu, rA) | (((uint32_t)imm16) << 16));
+        case OP_CMPLTUI:
+            set_reg(cpu, rB, get_reg(cpu, rA) < (uint32_t)imm);
             break;
-        case 0x35: //stw,    # stwio
-            storeword(cpu, ea, get_reg(cpu, rB));
-        case 0x36: //bltu,
+        case OP_BLTU:
             if (get_reg(cpu, rA) < get_reg(cpu, rB)) {
-                cpu->pc += imm16;
+                cpu->pc += imm;
             }
             break;
-        case 0x37: //ldw,    # ldwio
-            set_reg(cpu, rB, loadword(cpu, ea));
-            break;
-        case 0x3b: //flushd,
+    }
+}
+
+static inline void step(struct nios2 *cpu)
+{
+    if (cpu->icount >= cpu->next_event) {
+        fire_events(cpu);
+    }
+    cpu->icount++;
+
+    struct decoded tmp;
+    struct decoded d = *fetch_decoded(cpu, cpu->pc, &tmp);
+
+    // Increment PC
+    cpu->pc += 4;
+
+    // Maybe interrupt here...
+    if (check_interrupt(cpu) == 1) {
+        return;
+    }
+
+    execute(cpu, d);
+}
+
+void one_instr(struct nios2 *cpu)
+{
+    step(cpu);
+}
+
+////////////////
+// Basic blocks
+//
+// The run loop executes a whole block per dispatch and follows the
+// successor links cached in each block. A block only ends early if an
+// instruction sets cpu->block_exit (MMIO access, code overwritten), so
+// interrupts only need to be checked when entering a block: everything that
+// can raise one (wrctl, eret, MMIO callbacks) ends the block it is in.
+
+static inline int ends_block(int handler)
+{
+    switch (handler) {
+        case OP_CALL: case OP_JMPI: case OP_ERET: case OP_RET: case OP_JMP:
+        case OP_CALLR: case OP_TRAP: case OP_WRCTL: case OP_BREAK: case OP_BR:
+        case OP_BGE: case OP_BLT: case OP_BNE: case OP_BEQ: case OP_BGEU:
+        case OP_BLTU:
+            return 1;
+    }
+    return 0;
+}
+
+// Returns the block starting at pc (which must be word aligned and in RAM),
+// building it on a miss.
+////////////////
+// Breakpoints
+//
+// A bit per word in the code pages. Blocks are built to end before every
+// breakpoint, so the run loop only has to check at the start of each block,
+// and not at all when there are none.
+static inline int is_breakpoint(struct nios2 *cpu, uint32_t pc)
+{
+    if (pc >= cpu->mem_len) {
+        return 0;
+    }
+    struct code_page *page = cpu->icache[pc >> ICACHE_PAGE_SHIFT];
+    uint32_t w = (pc >> 2) & (ICACHE_PAGE_WORDS - 1);
+    return page != NULL && ((page->breakpoints[w >> 5] >> (w & 31)) & 1);
+}
+
+// Sets (on) or clears a breakpoint at addr. Returns 0 if addr isn't in RAM.
+int _set_breakpoint(long obj, uint32_t addr, int on)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    if (addr >= cpu->mem_len) {
+        return 0;
+    }
+    struct code_page *page = get_code_page(cpu, addr);
+    if (page == NULL) {
+        return 0;
+    }
+    uint32_t w = (addr >> 2) & (ICACHE_PAGE_WORDS - 1);
+    uint32_t bit = 1u << (w & 31);
+    if (on && !(page->breakpoints[w >> 5] & bit)) {
+        page->breakpoints[w >> 5] |= bit;
+        cpu->n_breakpoints++;
+    } else if (!on && (page->breakpoints[w >> 5] & bit)) {
+        page->breakpoints[w >> 5] &= ~bit;
+        cpu->n_breakpoints--;
+    }
+    // Blocks built so far may run through it
+    flush_blocks(cpu);
+    free_dead_blocks(cpu);
+    return 1;
+}
+
+void _clear_breakpoints(long obj)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    size_t i;
+    for (i=0; i<(cpu->mem_len >> ICACHE_PAGE_SHIFT); i++) {
+        if (cpu->icache[i] != NULL) {
+            memset(cpu->icache[i]->breakpoints, 0, sizeof(cpu->icache[i]->breakpoints));
+        }
+    }
+    cpu->n_breakpoints = 0;
+    flush_blocks(cpu);
+    free_dead_blocks(cpu);
+}
+
+struct block *get_block(struct nios2 *cpu, uint32_t pc)
+{
+    struct code_page *page = get_code_page(cpu, pc);
+    if (page == NULL) {
+        return NULL;
+    }
+    struct block **slot = &page->blocks[(pc >> 2) & (ICACHE_PAGE_WORDS - 1)];
+    if (*slot != NULL) {
+        return *slot;
+    }
+
+    struct decoded instrs[MAX_BLOCK_LEN];
+    struct decoded tmp;
+    uint32_t addr = pc;
+    int len = 0;
+    while (len < MAX_BLOCK_LEN && addr < cpu->mem_len) {
+        // Breakpoints have to start a block, so the run loop sees them
+        if (len > 0 && cpu->n_breakpoints && is_breakpoint(cpu, addr)) {
             break;
-        case 0x3c: //xorhi,
-            set_reg(cpu, rB, get_reg(cpu, rA) ^ (((uint32_t)imm16) << 16));
+        }
+        instrs[len] = *fetch_decoded(cpu, addr, &tmp);
+        len++;
+        addr += 4;
+        if (ends_block(instrs[len-1].handler)) {
             break;
+        }
     }
+
+    struct block *b = malloc(sizeof(struct block) + len*sizeof(struct decoded));
+    if (b == NULL) {
+        return NULL;
+    }
+    b->pc = pc;
+    b->len = len;
+    b->next[0] = b->next[1] = NULL;
+    b->next_pc[0] = b->next_pc[1] = 0;
+    memcpy(b->instrs, instrs, len*sizeof(struct decoded));
+
+    b->all_next = cpu->blocks;
+    cpu->blocks = b;
+    *slot = b;
+    return b;
 }
 
+// Runs up to count instructions of b, returns how many were run
+static inline int run_block(struct nios2 *cpu, struct block *b, int count)
+{
+    int i;
+    for (i=0; i<count; i++) {
+        cpu->pc += 4;
+        cpu->icount++;
+        execute(cpu, b->instrs[i]);
+        if (cpu->block_exit) {
+            return i+1;
+        }
+    }
+    return count;
+}
+
+// Finds the block for cpu->pc, through prev's links if we can
+static inline struct block *next_block(struct nios2 *cpu, struct block *prev)
+{
+    uint32_t pc = cpu->pc;
+    struct block *b;
+
+    if (prev != NULL) {
+        if (prev->next[0] != NULL && prev->next_pc[0] == pc) {
+            return prev->next[0];
+        }
+        if (prev->next[1] != NULL && prev->next_pc[1] == pc) {
+            return prev->next[1];
+        }
+    }
+
+    b = get_block(cpu, pc);
+    if (prev != NULL && b != NULL) {
+        // Chain prev => b (the second slot gets replaced on indirect jumps)
+        int i = (prev->next[0] == NULL) ? 0 : 1;
+        prev->next[i] = b;
+        prev->next_pc[i] = pc;
+    }
+    return b;
+}
+
+// Runs until halted or instr_limit instructions (-1 for no limit),
+// returns the number of instructions run
+int run_blocks(struct nios2 *cpu, int instr_limit, int *at_breakpoint)
+{
+    int n = 0;
+    struct block *b = NULL;
+
+    *at_breakpoint = 0;
+    while (cpu->halted==0 && (instr_limit==-1 || n<instr_limit)) {
+        if (cpu->icount >= cpu->next_event) {
+            fire_events(cpu);
+            b = NULL;
+            continue;
+        }
+
+        // Stop before the instruction at a breakpoint (but not the one we
+        // start at, so a run can continue from a breakpoint)
+        if (cpu->n_breakpoints && n > 0 && is_breakpoint(cpu, cpu->pc)) {
+            *at_breakpoint = 1;
+            break;
+        }
+
+        // Interrupts, and pcs we can't build blocks for, go one at a time
+        if (cpu->irq_pending || cpu->pc >= cpu->mem_len || (cpu->pc & 3)) {
+            step(cpu);
+            n++;
+            b = NULL;
+            continue;
+        }
+
+        b = next_block(cpu, b);
+        if (b == NULL) {
+            step(cpu);
+            n++;
+            continue;
+        }
+
+        int count = b->len;
+        if (instr_limit != -1 && count > instr_limit - n) {
+            count = instr_limit - n;
+        }
+        // Stop at the next event, so it fires on time
+        if (count > cpu->next_event - cpu->icount) {
+            count = cpu->next_event - cpu->icount;
+        }
+
+        cpu->block_exit = 0;
+        n += run_block(cpu, b, count);
+        if (cpu->block_exit) {
+            // b may have been flushed
+            free_dead_blocks(cpu);
+            b = NULL;
+        }
+    }
+    return n;
+}
 void _one_step(long obj)
 {
     struct nios2 *cpu = (struct nios2 *)obj;
-    one_instr(cpu);
+    step(cpu);
 }
 
 int _run_until_halted(long obj, int instr_limit)
 {
     struct nios2 *cpu = (struct nios2 *)obj;
-    int n = 0;
-    while (cpu->halted==0 && (instr_limit==-1 || n<instr_limit)) {
-        one_instr(cpu);
-        n++;
-    }
+    int at_breakpoint;
+    int n = run_blocks(cpu, instr_limit, &at_breakpoint);
     if (n == instr_limit) {
         cpu->halted = 1;
         error_printf(cpu, "Instruction limit reached: %d\n", n);
@@ -866,8 +1882,130 @@ int _run_until_halted(long obj, int instr_limit)
     return n;
 }
 
+// Like _run_until_halted, but running out of instructions isn't an error
+// (the cpu can carry on later). Returns how many instructions were run, and
+// why it stopped (RUN_*) in *reason.
+int _run_until(long obj, int instr_limit, int *reason)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    int n_errors = cpu->n_errors;
+    int at_breakpoint;
+    int n = run_blocks(cpu, instr_limit, &at_breakpoint);
+
+    if (at_breakpoint) {
+        *reason = RUN_BREAKPOINT;
+    } else if (cpu->halted) {
+        *reason = cpu->n_errors != n_errors ? RUN_ERROR : RUN_HALT;
+    } else {
+        *reason = RUN_LIMIT;
+    }
+    return n;
+}
+
+// Runs the program once per context of b, like reset/write inputs/
+// run_until_halted/read results from Python would, but all in one call. The
+// contexts run one after the other on cpu: the in-place reset between them
+// only restores what the last one wrote, and the decoded code and blocks
+// are shared by all of them. cpu is left as the last context finished.
+// Returns 0, or -1 if a write or read is outside of RAM.
+int _run_batch(long obj, struct batch *b)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    size_t out_len = 0;
+    int i, j;
+
+    for (j=0; j<b->n_reads; j++) {
+        out_len += b->read_len[j];
+    }
+
+    for (i=0; i<b->n; i++) {
+        char *out = b->out_mem + out_len*i;
+
+        _reset_nios2(obj, 0);
+        cpu->pc = b->start_pc;
+        for (j=b->first_write[i]; j<b->first_write[i+1]; j++) {
+            struct batch_write *w = &b->writes[j];
+            if (w->len && _write_mem(obj, w->addr, w->data, w->len) == 0) {
+                return -1;
+            }
+        }
+
+        b->out_instrs[i] = _run_until_halted(obj, b->limit);
+        b->out_pc[i] = cpu->pc;
+        memcpy(&b->out_regs[i*32], cpu->regs, sizeof(uint32_t)*32);
+        b->out_error[i] = cpu->error;
+        cpu->error = NULL;
+
+        for (j=0; j<b->n_reads; j++) {
+            if (b->read_len[j] && _read_mem(obj, b->read_addr[j], out, b->read_len[j]) == 0) {
+                return -1;
+            }
+            out += b->read_len[j];
+        }
+    }
+    return 0;
+}
+
+// Shared by the threads of _run_parallel(): each takes the next cpu
+// nobody has run yet until there are none left
+struct run_queue {
+    long        *cpus;
+    int         *out;
+    int         n;
+    int         limit;
+    int         next;
+};
+
+static void *run_worker(void *arg)
+{
+    struct run_queue *q = arg;
+    int i;
+    while ((i = __atomic_fetch_add(&q->next, 1, __ATOMIC_RELAXED)) < q->n) {
+        q->out[i] = _run_until_halted(q->cpus[i], q->limit);
+    }
+    return NULL;
+}
+
+// Runs n independent cpus to a halt (or limit instructions each) on up to
+// n_threads OS threads, the calling one included, and puts what
+// _run_until_halted() returned for cpus[i] in out[i]. No cpu may appear
+// twice. Call it without the GIL: MMIO and event callbacks take it when
+// they need it. If threads can't be started, the calling thread runs
+// whatever is left.
+void _run_parallel(long *cpus, int n, int limit, int *out, int n_threads)
+{
+    struct run_queue q = {cpus, out, n, limit, 0};
+    pthread_t *threads;
+    int started = 0;
+    int i;
+
+    if (n_threads > n) {
+        n_threads = n;
+    }
+    threads = malloc(sizeof(pthread_t) * (n_threads > 1 ? n_threads - 1 : 1));
+    if (threads != NULL) {
+        for (i=0; i<n_threads-1; i++) {
+            if (pthread_create(&threads[started], NULL, run_worker, &q) == 0) {
+                started++;
+            }
+        }
+    }
+    run_worker(&q);
+    for (i=0; i<started; i++) {
+        pthread_join(threads[i], NULL);
+    }
+    free(threads);
+}
+
 void _halt_cpu(long obj)
 {
     struct nios2 *cpu = (struct nios2 *)obj;
     cpu->halted = 1;
 }
+
+// Lets a cpu halted by a device (or _halt_cpu) carry on where it stopped
+void _resume_cpu(long obj)
+{
+    struct nios2 *cpu = (struct nios2 *)obj;
+    cpu->halted = 0;
+}
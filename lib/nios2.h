@@ -2,13 +2,117 @@
 #define PY_SSIZE_T_CLEAN
 #include "Python.h"
 
-#define MAX_MMIOS       16
 #define MAX_CLOBBERED   100
 
+#define MEM_PAGE_SHIFT          12      // guest RAM is filled in per page
+#define MEM_PAGE_SIZE           (1 << MEM_PAGE_SHIFT)
+#define PAGE_PRESENT        0x01    // filled in (else reads as fill)
+#define PAGE_DIRTY          0x02    // written since the last reset
+
+#define ICACHE_PAGE_SHIFT   12
+#define ICACHE_PAGE_WORDS   (1 << (ICACHE_PAGE_SHIFT - 2))
+#define MAX_BLOCK_LEN       64
+
+#define MMIO_PAGE_SHIFT     12
+#define MMIO_PAGE_WORDS     (1 << (MMIO_PAGE_SHIFT - 2))
+#define MMIO_HASH_SIZE      64
+
+// A device register, or a range of them (addr..addr+size-1). Single
+// registers call callback(val)/callback(); ranges pass the offset from
+// addr first: callback(offset, val)/callback(offset).
 struct mmio {
-    uint32_t    addr;
-    PyObject    *callback;
-    void        *arg;
+    uint32_t        addr;
+    uint32_t        size;       // in bytes
+    int             ranged;
+    PyObject        *callback;
+    struct device   *dev;       // simulated in C instead, callback unused
+    int             nwords;     // words mapped to this mmio
+    struct mmio     *all_next;  // cpu->mmio_list, for freeing
+};
+
+// Devices simulated in C, so programs polling them never call into Python
+enum {
+    DEV_REG,    // read/write register
+    DEV_CONST,  // read-only value (e.g. switches), stores are ignored
+    DEV_LOG,    // read/write register that logs every store (e.g. LEDs)
+    DEV_FIFO,   // bounded byte FIFO
+    DEV_JTAG_UART,  // data/control registers of the DE10 JTAG UART
+    DEV_TIMER,      // DE10 interval timer, counting instructions
+};
+
+// Things to do when cpu->icount reaches when (see schedule_event())
+enum {
+    EV_IRQ,     // set bit irq of ipending
+    EV_CALL,    // call a Python callback
+    EV_TIMER,   // interval timer timeout
+};
+
+struct event {
+    int             kind;
+    uint64_t        when;
+    uint64_t        period;     // fire again this many instructions later
+                                // (0: only once)
+    int             irq;        // EV_IRQ
+    PyObject        *callback;  // EV_CALL
+    struct device   *dev;       // EV_TIMER
+    struct event    *next;      // cpu->events, soonest first
+};
+
+struct bytebuf {
+    uint8_t     *buf;
+    size_t      len;
+    size_t      cap;
+};
+
+struct fifo {
+    uint8_t     *buf;
+    uint32_t    depth;
+    uint32_t    head;
+    uint32_t    count;
+};
+
+struct device {
+    int         kind;
+    int         refs;           // Python handles (see _device_ref())
+    int         detached;       // the cpu is done with it
+    uint32_t    init_val;
+    uint32_t    val;
+    uint32_t    *log;           // DEV_LOG: every value stored
+    size_t      log_len;
+    size_t      log_cap;
+    size_t      halt_after;     // DEV_LOG: halt after every this many stores
+                                // (0: never)
+    struct fifo fifo;           // DEV_FIFO, DEV_JTAG_UART: rx
+
+    // DEV_JTAG_UART. The host side moves one byte out of tx every tx_roll
+    // register accesses, and one byte of rx_data into rx every rx_roll.
+    struct fifo     tx;
+    struct bytebuf  rx_data;    // what the host sends
+    size_t          rx_idx;
+    struct bytebuf  tx_data;    // what the host got
+    struct bytebuf  dropped;    // written while tx was full
+    uint32_t        tx_roll;
+    uint32_t        rx_roll;
+    uint32_t        tx_step;
+    uint32_t        rx_step;
+
+    // DEV_TIMER. While running, the counter is derived from ev->when.
+    struct nios2    *cpu;
+    int             irq;
+    uint32_t        status;     // TO, RUN
+    uint32_t        control;    // ITO, CONT
+    uint32_t        period;
+    uint32_t        counter;    // while stopped
+    uint32_t        snap;
+    struct event    *ev;
+};
+
+// The mmios covering each word of one page of the MMIO address space,
+// chained in the cpu->mmio_pages hash table
+struct mmio_page {
+    uint32_t            page;
+    struct mmio         *regs[MMIO_PAGE_WORDS];
+    struct mmio_page    *next;
 };
 
 struct callee_saved {
@@ -23,35 +127,154 @@ struct clobbered {
     int         interrupt;
 };
 
+// Handlers for predecoded instructions (io variants share a handler)
+enum {
+    OP_DECODE = 0,  // not decoded yet
+    OP_NOP,
+    // J-types
+    OP_CALL, OP_JMPI,
+    // R-types
+    OP_ERET, OP_ROLI, OP_ROL, OP_RET, OP_NOR, OP_MULXUU, OP_CMPGE, OP_ROR,
+    OP_JMP, OP_AND, OP_CMPLT, OP_SLLI, OP_SLL, OP_OR, OP_MULXSU, OP_CMPNE,
+    OP_SRLI, OP_SRL, OP_NEXTPC, OP_CALLR, OP_XOR, OP_MULXSS, OP_CMPEQ,
+    OP_DIVU, OP_DIV, OP_RDCTL, OP_MUL, OP_CMPGEU, OP_TRAP, OP_WRCTL,
+    OP_CMPLTU, OP_ADD, OP_BREAK, OP_SUB, OP_SRAI, OP_SRA,
+    // I-types
+    OP_LDBU, OP_ADDI, OP_STB, OP_BR, OP_LDB, OP_CMPGEI, OP_LDHU, OP_ANDI,
+    OP_STH, OP_BGE, OP_LDH, OP_CMPLTI, OP_ORI, OP_STW, OP_BLT, OP_LDW,
+    OP_CMPNEI, OP_XORI, OP_BNE, OP_CMPEQI, OP_MULI, OP_BEQ, OP_CMPGEUI,
+    OP_ANDHI, OP_BGEU, OP_CMPLTUI, OP_ORHI, OP_BLTU, OP_XORHI,
+};
+
+struct decoded {
+    uint8_t     handler;    // OP_*
+    uint8_t     rA;
+    uint8_t     rB;
+    uint8_t     rC;
+    int32_t     imm;        // imm16 (sign- or zero-extended per op), imm5,
+                            // imm26<<2, or imm16<<16 for the *hi ops
+};
+
+// Decoded instructions, and the basic block starting at each word, for one
+// page of RAM
+struct code_page {
+    struct decoded  instrs[ICACHE_PAGE_WORDS];
+    struct block    *blocks[ICACHE_PAGE_WORDS];
+    uint32_t        breakpoints[ICACHE_PAGE_WORDS / 32];    // bit per word
+};
+
+// Why run_until() stopped
+enum {
+    RUN_BREAKPOINT,
+    RUN_HALT,       // break, or halted from outside
+    RUN_LIMIT,      // ran instr_limit instructions
+    RUN_ERROR,      // halted with an error (see cpu->error)
+};
+
+// A batch of runs of the same program over n sets of inputs (see
+// _run_batch()). Context i writes writes[first_write[i]..first_write[i+1])
+// into RAM, runs, then has RAM at each read_addr/read_len copied out, back
+// to back, into its slice of out_mem.
+struct batch_write {
+    uint32_t        addr;
+    const char      *data;
+    size_t          len;
+};
+
+struct batch {
+    int                 n;
+    uint32_t            start_pc;
+    int                 limit;          // instructions per context
+    struct batch_write  *writes;
+    int                 *first_write;   // n+1 entries
+    int                 n_reads;
+    uint32_t            *read_addr;
+    uint32_t            *read_len;
+    // Results, one per context (out_regs: 32, out_mem: sum of read_len)
+    int                 *out_instrs;
+    uint32_t            *out_pc;
+    uint32_t            *out_regs;
+    char                *out_mem;
+    char                **out_error;    // malloc'd, NULL if none
+};
+
+// Straight-line run of instructions ending in a branch/jump/call/ret/eret/
+// trap/wrctl/break (or MAX_BLOCK_LEN). next[] caches the blocks we have
+// previously continued to, keyed by next_pc[].
+struct block {
+    uint32_t        pc;
+    int             len;
+    struct block    *next[2];
+    uint32_t        next_pc[2];
+    struct block    *all_next;  // cpu->blocks / cpu->dead_blocks list
+    struct decoded  instrs[];
+};
+
+// A piece of the initial image: len bytes of data at addr, followed by
+// zero_len zeros. Memory outside of them reads as uninitialized.
+struct init_seg {
+    uint32_t            addr;
+    uint32_t            len;
+    uint32_t            zero_len;
+    unsigned char       *data;
+};
+
 struct nios2 {
     int                 halted;
     char                *error;
+    int                 n_errors;
 
     uint32_t            pc;
     uint32_t            regs[32];
     uint32_t            ctl[32];    // control registers (Some overriden)
+    int                 irq_pending;    // PIE && (ipending & ienable)
+    uint32_t            irq_lines;      // asserted by devices, read as ipending
+
+    uint64_t            icount;         // instructions since reset
+    uint64_t            next_event;     // events->when, or UINT64_MAX
+    struct event        *events;
 
     struct callee_saved *callee_stack_head;
+    struct callee_saved *callee_free;   // popped frames, reused by push_callees
 
     int                 clobbered_idx;
     struct clobbered    clobbered_history[MAX_CLOBBERED];
 
-    unsigned char       *mem;
+    unsigned char       *mem;       // mmap'd, only filled-in pages are used
     size_t              mem_len;
-    struct mmio         mmios[MAX_MMIOS];
+    uint8_t             *page_state;    // PAGE_* flags for each page of mem
+    uint32_t            *dirty_pages;   // page numbers with PAGE_DIRTY set
+    size_t              n_dirty;
+    struct init_seg     *init_segs;     // the initial image, by address
+    int                 n_init_segs;
+    struct code_page    **icache;   // per-page decoded instructions/blocks
+    struct block        *blocks;        // all live blocks
+    struct block        *dead_blocks;   // flushed, freed between blocks
+    int                 block_exit;     // stop the current block early
+    int                 n_breakpoints;  // blocks end before breakpoints
+    struct mmio_page    *mmio_pages[MMIO_HASH_SIZE];
+    struct mmio_page    *mmio_last;     // most recently used page
+    struct mmio         *mmio_list;
 };
 
 // Create/Delete
-long _new_nios2(const char *mem, size_t mem_len);
+long _new_nios2(void);
+int  _load_nios2(long cpu, uint32_t addr, const char *data, size_t len, size_t zero_len);
 void _del_nios2(long cpu);
+void _reset_nios2(long cpu, int clear_mmio);
 
 // Deprecated
 void _print_mem(long cpu);
 void _print_regs(long cpu);
 
 // Memory
+unsigned char *touch_page(struct nios2 *cpu, uint32_t addr);
+void     dirty_page(struct nios2 *cpu, uint32_t addr);
 uint32_t _loadword(long cpu, uint32_t addr);
 void     _storeword(long cpu, uint32_t addr, uint32_t val);
+size_t   _read_mem(long cpu, uint32_t addr, char *buf, size_t len);
+size_t   _write_mem(long cpu, uint32_t addr, const char *buf, size_t len);
+const unsigned char *_map_mem(long cpu, uint32_t addr, size_t len);
 uint32_t _get_reg(long cpu, long reg);
 void     _set_reg(long cpu, long reg, uint32_t val);
 PyObject *_get_error(long cpu);
@@ -59,14 +282,67 @@ PyObject *_get_error(long cpu);
 
 // MMIO
 void _add_mmio(long cpu, uint32_t addr, PyObject *callback);
+void _add_mmio_range(long cpu, uint32_t addr, uint32_t size, PyObject *callback);
+void free_mmios(struct nios2 *cpu);
+long attach_device(struct nios2 *cpu, uint32_t addr, struct device *dev);
+long _add_device(long cpu, uint32_t addr, int kind, uint32_t val, uint32_t n);
+
+// Devices (devices.c)
+int      fifo_put(struct fifo *f, uint8_t c);
+int      fifo_get(struct fifo *f);
+struct device *new_device(int kind, uint32_t val, uint32_t n);
+uint32_t device_size(struct device *dev);
+int      device_has_reg(struct device *dev, uint32_t offset);
+uint32_t device_access(struct nios2 *cpu, struct device *dev, uint32_t offset,
+                       uint32_t val, int is_store);
+void     reset_device(struct device *dev);
+void     free_device(struct device *dev);
+void     _device_ref(long dev);
+void     _device_unref(long dev);
+int      _device_attached(long dev);
+uint32_t _device_get(long dev);
+void     _device_set(long dev, uint32_t val);
+PyObject *_device_log(long dev);
+size_t   _fifo_push(long dev, const char *data, size_t len);
+PyObject *_fifo_read(long dev);
+long     _add_jtag_uart(long cpu, uint32_t addr, uint32_t rx_depth,
+                        uint32_t tx_depth, uint32_t tx_roll, uint32_t rx_roll);
+void     _uart_send(long dev, const char *data, size_t len);
+PyObject *_uart_received(long dev, int flush);
+PyObject *_uart_fifo(long dev, int tx);
+PyObject *_uart_dropped(long dev);
+long     _add_timer(long cpu, uint32_t addr, int irq, uint32_t period);
+void     timer_timeout(struct device *dev);
+
+
+// Events
+struct event *schedule_event(struct nios2 *cpu, int kind, uint64_t when, uint64_t period);
+void     cancel_event(struct nios2 *cpu, struct event *ev);
+void     free_events(struct nios2 *cpu);
+void     fire_events(struct nios2 *cpu);
+void     set_irq_line(struct nios2 *cpu, int irq, int level);
+void     _schedule_irq(long cpu, int irq, uint64_t when, uint64_t period);
+void     _schedule_call(long cpu, uint64_t when, uint64_t period, PyObject *callback);
+uint64_t _get_icount(long cpu);
 
 
 // Control
+void     decode_instr(uint32_t instr, struct decoded *d);
 void     one_instr(struct nios2 *cpu);
+struct block *get_block(struct nios2 *cpu, uint32_t pc);
+void     flush_blocks(struct nios2 *cpu);
+void     free_dead_blocks(struct nios2 *cpu);
+int      run_blocks(struct nios2 *cpu, int instr_limit, int *at_breakpoint);
 void     _halt_cpu(long cpu);
+void     _resume_cpu(long cpu);
 void     _interrupt_cpu(long obj);
 void     _one_step(long obj);
 int      _run_until_halted(long obj, int instr_limit);
+int      _run_until(long obj, int instr_limit, int *reason);
+int      _run_batch(long obj, struct batch *b);
+void     _run_parallel(long *cpus, int n, int limit, int *out, int n_threads);
+int      _set_breakpoint(long cpu, uint32_t addr, int on);
+void     _clear_breakpoints(long cpu);
 void     _set_pc(long obj, uint32_t val);
 uint32_t _get_pc(long obj);
 uint32_t _get_ctl_reg(long cpu, long reg);
@@ -1,16 +1,87 @@
-from libc.stdint cimport uint32_t, int32_t, uint8_t
+from libc.stdint cimport uint32_t, int32_t, uint8_t, uint64_t
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBuffer_FillInfo, PyBUF_SIMPLE
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from cpython.bytearray cimport PyByteArray_AS_STRING
+from cpython.unicode cimport PyUnicode_FromString
+from cpython.array cimport array, clone
+from libc.stdlib cimport malloc, calloc, free
+import os
 
 
 cdef extern from "nios2.h":
-    long _new_nios2(const char *mem, size_t mem_len)
+    struct nios2:
+        pass
+    struct device:
+        pass
+
+    struct batch_write:
+        uint32_t        addr
+        const char      *data
+        size_t          len
+    struct batch:
+        int             n
+        uint32_t        start_pc
+        int             limit
+        batch_write     *writes
+        int             *first_write
+        int             n_reads
+        uint32_t        *read_addr
+        uint32_t        *read_len
+        int             *out_instrs
+        uint32_t        *out_pc
+        uint32_t        *out_regs
+        char            *out_mem
+        char            **out_error
+
+    long _new_nios2()
+    int  _load_nios2(long cpu, uint32_t addr, const char *data, size_t len, size_t zero_len)
     void _del_nios2(long cpu)
+    void _reset_nios2(long cpu, int clear_mmio)
     void _print_mem(long cpu)
     uint32_t _loadword(long cpu, uint32_t addr);
     void     _storeword(long cpu, uint32_t addr, uint32_t val);
+    size_t   _read_mem(long cpu, uint32_t addr, char *buf, size_t len)
+    size_t   _write_mem(long cpu, uint32_t addr, const char *buf, size_t len)
+    const unsigned char *_map_mem(long cpu, uint32_t addr, size_t len)
     void     _add_mmio(long cpu, uint32_t addr, object callback);
+    void     _add_mmio_range(long cpu, uint32_t addr, uint32_t size, object callback);
+    long     _add_device(long cpu, uint32_t addr, int kind, uint32_t val, uint32_t n)
+    void     _device_ref(long dev)
+    void     _device_unref(long dev)
+    int      _device_attached(long dev)
+    uint32_t _device_get(long dev)
+    void     _device_set(long dev, uint32_t val)
+    object   _device_log(long dev)
+    size_t   _fifo_push(long dev, const char *data, size_t len)
+    object   _fifo_read(long dev)
+    long     _add_jtag_uart(long cpu, uint32_t addr, uint32_t rx_depth,
+                            uint32_t tx_depth, uint32_t tx_roll, uint32_t rx_roll)
+    void     _uart_send(long dev, const char *data, size_t len)
+    object   _uart_received(long dev, int flush)
+    object   _uart_fifo(long dev, int tx)
+    object   _uart_dropped(long dev)
+    long     _add_timer(long cpu, uint32_t addr, int irq, uint32_t period)
+    void     _schedule_irq(long cpu, int irq, uint64_t when, uint64_t period)
+    void     _schedule_call(long cpu, uint64_t when, uint64_t period, object callback)
+    uint64_t _get_icount(long cpu)
+    enum:
+        DEV_REG
+        DEV_CONST
+        DEV_LOG
+        DEV_FIFO
     void     _one_step(long cpu);
     void     one_instr(void *cpu);
-    long     _run_until_halted(long cpu, int limit);
+    long     _run_until_halted(long cpu, int limit) nogil;
+    int      _run_until(long cpu, int limit, int *reason) nogil
+    int      _run_batch(long cpu, batch *b) nogil
+    void     _run_parallel(long *cpus, int n, int limit, int *out, int n_threads) nogil
+    int      _set_breakpoint(long cpu, uint32_t addr, int on)
+    void     _clear_breakpoints(long cpu)
+    enum:
+        RUN_BREAKPOINT
+        RUN_HALT
+        RUN_LIMIT
+        RUN_ERROR
     void     _set_pc(long cpu, uint32_t val);
     uint32_t _get_pc(long cpu);
     uint32_t _get_reg(long cpu, long reg);
@@ -19,56 +90,395 @@ cdef extern from "nios2.h":
     void     _set_ctl_reg(long cpu, long reg, uint32_t val);
     object   _get_error(long cpu);
     void     _halt_cpu(long cpu);
+    void     _resume_cpu(long cpu);
     void     _interrupt_cpu(long cpu);
     object   _get_clobbered(long cpu);
 
 
+_run_reasons = {
+    RUN_BREAKPOINT: 'breakpoint',
+    RUN_HALT: 'halt',
+    RUN_LIMIT: 'limit',
+    RUN_ERROR: 'error',
+}
+
+
+# Values and addresses are taken as Python ints and truncated to 32 bits, so
+# negative numbers can be passed in as-is.
+cdef inline uint32_t u32(long long val):
+    return <uint32_t>val
+
+
+cdef class CPU:
+    """A simulated Nios II cpu, owning its struct nios2. RAM starts out as
+    init_mem (loaded at address 0), plus segments: (addr, data[, zeros])
+    for data at addr followed by that many zero bytes. The rest of RAM
+    reads as uninitialized."""
+    cdef nios2 *cpu
+
+    def __cinit__(self, *args, **kwargs):
+        self.cpu = NULL
+
+    def __init__(self, bytes init_mem=b'', segments=()):
+        cdef bytes data
+        if self.cpu != NULL:
+            _del_nios2(<long>self.cpu)
+        self.cpu = <nios2 *>_new_nios2()
+        if self.cpu == NULL:
+            raise MemoryError()
+        if init_mem:
+            segments = [(0, init_mem)] + list(segments)
+        for seg in segments:
+            addr, data = seg[0], seg[1]
+            zeros = seg[2] if len(seg) > 2 else 0
+            if not _load_nios2(<long>self.cpu, u32(addr), data, len(data), zeros):
+                raise MemoryError()
+
+    def __dealloc__(self):
+        if self.cpu != NULL:
+            _del_nios2(<long>self.cpu)
+            self.cpu = NULL
+
+    # Back to the initial state, in place (see _reset_nios2)
+    def reset(self, bint clear_mmio=False):
+        _reset_nios2(<long>self.cpu, clear_mmio)
+
+    def print_mem(self):
+        _print_mem(<long>self.cpu)
+
+    # Registers
+    cpdef uint32_t get_reg(self, int reg):
+        return _get_reg(<long>self.cpu, reg)
+    cpdef set_reg(self, int reg, long long val):
+        _set_reg(<long>self.cpu, reg, u32(val))
+
+    cpdef uint32_t get_ctl_reg(self, int reg):
+        return _get_ctl_reg(<long>self.cpu, reg)
+    cpdef set_ctl_reg(self, int reg, long long val):
+        _set_ctl_reg(<long>self.cpu, reg, u32(val))
+
+    cpdef uint32_t get_pc(self):
+        return _get_pc(<long>self.cpu)
+    cpdef set_pc(self, long long val):
+        _set_pc(<long>self.cpu, u32(val))
+
+    # Memory
+    cpdef uint32_t loadword(self, long long addr):
+        return _loadword(<long>self.cpu, u32(addr))
+    cpdef storeword(self, long long addr, long long val):
+        _storeword(<long>self.cpu, u32(addr), u32(val))
+
+    # Bulk memory access, RAM only. These copy whole ranges in one call.
+    def read_mem(self, long long addr, Py_ssize_t n):
+        out = PyBytes_FromStringAndSize(NULL, n)
+        if n and _read_mem(<long>self.cpu, u32(addr), PyBytes_AS_STRING(out), n) == 0:
+            raise ValueError('0x%08x+%d is outside of RAM' % (u32(addr), n))
+        return out
+
+    # data is anything with the buffer protocol (bytes, array, numpy...)
+    def write_mem(self, long long addr, data):
+        cdef Py_buffer buf
+        cdef size_t done
+        PyObject_GetBuffer(data, &buf, PyBUF_SIMPLE)
+        try:
+            done = _write_mem(<long>self.cpu, u32(addr), <const char *>buf.buf, buf.len)
+            if buf.len and done == 0:
+                raise ValueError('0x%08x+%d is outside of RAM' % (u32(addr), buf.len))
+        finally:
+            PyBuffer_Release(&buf)
+
+    # A read-only memoryview of n bytes of RAM at addr, without copying: it
+    # follows what the program writes, and reset() restoring memory. Wrap
+    # it with numpy.frombuffer() for an array. Changes go through
+    # write_mem(), which keeps decoded instructions and reset in step.
+    def view(self, long long addr, Py_ssize_t n):
+        cdef const unsigned char *p = _map_mem(<long>self.cpu, u32(addr), n)
+        if p == NULL:
+            raise ValueError('0x%08x+%d is outside of RAM' % (u32(addr), n))
+        v = MemView.__new__(MemView)
+        (<MemView>v).cpu = self
+        (<MemView>v).buf = p
+        (<MemView>v).len = n
+        return memoryview(v)
+
+    # MMIO
+    def add_mmio(self, long long addr, cb):
+        _add_mmio(<long>self.cpu, u32(addr), cb)
+
+    # cb(offset) on loads, cb(offset, val) on stores, for any address in
+    # [addr, addr+size)
+    def add_mmio_range(self, long long addr, long long size, cb):
+        _add_mmio_range(<long>self.cpu, u32(addr), u32(size), cb)
+
+    cdef _device(self, cls, long handle):
+        if handle == 0:
+            raise MemoryError()
+        dev = cls.__new__(cls)
+        _device_ref(handle)
+        (<Device>dev).dev = <device *>handle
+        (<Device>dev).cpu = self
+        return dev
+
+    # Native devices (see Device)
+    def add_reg(self, long long addr, long long val=0):
+        return self._device(Device, _add_device(<long>self.cpu, u32(addr), DEV_REG, u32(val), 0))
+
+    # Stores are ignored, the value can still be changed with store()
+    def add_const(self, long long addr, long long val):
+        return self._device(Device, _add_device(<long>self.cpu, u32(addr), DEV_CONST, u32(val), 0))
+
+    # Logs every store (see log()), and halts the cpu after every halt_after
+    # of them (resume() carries on)
+    def add_log_reg(self, long long addr, long long val=0, uint32_t halt_after=0):
+        return self._device(Device, _add_device(<long>self.cpu, u32(addr), DEV_LOG, u32(val), halt_after))
+
+    # Byte FIFO: stores push a byte, loads pop one as
+    # byte | 0x8000 | (bytes left << 16), or read 0 when it's empty
+    def add_fifo(self, long long addr, uint32_t depth):
+        return self._device(Device, _add_device(<long>self.cpu, u32(addr), DEV_FIFO, 0, depth))
+
+    # JTAG UART data/control registers at addr/addr+4. The host side takes
+    # a byte out of tx every step_roll[0] register accesses, and moves a
+    # byte of rx (see JtagUart.send()) into the rx FIFO every step_roll[1].
+    def add_jtag_uart(self, long long addr=0xFF201000, bytes rx=b'', uint32_t rx_depth=64,
+                      uint32_t tx_depth=64, step_roll=(1, 1)):
+        dev = self._device(JtagUart, _add_jtag_uart(<long>self.cpu, u32(addr), rx_depth,
+                                                    tx_depth, step_roll[0], step_roll[1]))
+        dev.send(rx)
+        return dev
+
+    # DE10 interval timer, counting instructions instead of clock cycles
+    def add_timer(self, long long addr=0xFF202000, int irq=0, uint32_t period=12500000):
+        return self._device(Device, _add_timer(<long>self.cpu, u32(addr), irq, period))
+
+    # Events, by instruction count since reset (see get_icount()). They fire
+    # once the cpu has run that many instructions, and then every period
+    # instructions if period isn't 0. reset() drops them.
+    def schedule_irq(self, int irq, uint64_t at, uint64_t period=0):
+        _schedule_irq(<long>self.cpu, irq, at, period)
+
+    def schedule(self, uint64_t at, cb, uint64_t period=0):
+        _schedule_call(<long>self.cpu, at, period, cb)
+
+    cpdef uint64_t get_icount(self):
+        return _get_icount(<long>self.cpu)
+
+    # Running
+    def one_step(self):
+        _one_step(<long>self.cpu)
+
+    def run_until_halted(self, int limit=-1):
+        cdef long n
+        cdef long c = <long>self.cpu
+        # Only MMIO callbacks need Python, access_mmio takes the GIL for those
+        with nogil:
+            n = _run_until_halted(c, limit)
+        return n
+
+    # Runs until a breakpoint, a halt, or limit instructions. Returns
+    # (reason, instructions run), see csim.Nios2.run_until().
+    def run(self, int limit=-1):
+        cdef int n
+        cdef int reason
+        cdef long c = <long>self.cpu
+        with nogil:
+            n = _run_until(c, limit, &reason)
+        return (_run_reasons[reason], n)
+
+    # Runs the program from start_pc once per entry of inputs, a list of
+    # [(addr, data), ...] to write into RAM after each reset, all in one
+    # call (see _run_batch()). reads, [(addr, len), ...], are copied out of
+    # RAM after each run. Returns (instrs, pcs, regs, errors, mem): arrays of
+    # the instruction count, pc and 32 registers of each context, a list of
+    # their errors ('' if none), and bytes with their reads back to back.
+    def run_batch(self, long long start_pc, inputs, reads=(), int limit=-1):
+        cdef batch b
+        cdef int i, j, ret
+        cdef long c = <long>self.cpu
+        cdef size_t out_len = 0
+        cdef array instrs, pcs, regs
+        cdef bytearray mem
+
+        n = len(inputs)
+        n_writes = sum([len(ws) for ws in inputs])
+        datas = []      # keeps what writes point into alive
+        b.n = n
+        b.start_pc = u32(start_pc)
+        b.limit = limit
+        b.n_reads = len(reads)
+        b.writes = <batch_write *>malloc(sizeof(batch_write) * max(n_writes, 1))
+        b.first_write = <int *>malloc(sizeof(int) * (n + 1))
+        b.read_addr = <uint32_t *>malloc(sizeof(uint32_t) * max(b.n_reads, 1))
+        b.read_len = <uint32_t *>malloc(sizeof(uint32_t) * max(b.n_reads, 1))
+        b.out_error = <char **>calloc(max(n, 1), sizeof(char *))
+        try:
+            if (b.writes == NULL or b.first_write == NULL or b.read_addr == NULL or
+                    b.read_len == NULL or b.out_error == NULL):
+                raise MemoryError()
+            j = 0
+            for i, ws in enumerate(inputs):
+                b.first_write[i] = j
+                for addr, data in ws:
+                    if type(data) is not bytes:
+                        data = bytes(data)
+                    datas.append(data)
+                    b.writes[j].addr = u32(addr)
+                    b.writes[j].data = PyBytes_AS_STRING(data)
+                    b.writes[j].len = len(data)
+                    j += 1
+            b.first_write[n] = j
+            for i, (addr, length) in enumerate(reads):
+                b.read_addr[i] = u32(addr)
+                b.read_len[i] = length
+                out_len += length
+
+            instrs = clone(array('i'), n, False)
+            pcs = clone(array('I'), n, False)
+            regs = clone(array('I'), n * 32, False)
+            mem = bytearray(n * out_len)
+            b.out_instrs = instrs.data.as_ints
+            b.out_pc = pcs.data.as_uints
+            b.out_regs = regs.data.as_uints
+            b.out_mem = PyByteArray_AS_STRING(mem)
+
+            with nogil:
+                ret = _run_batch(c, &b)
+
+            errors = []
+            for i in range(n):
+                if b.out_error[i] == NULL:
+                    errors.append('')
+                else:
+                    errors.append(PyUnicode_FromString(b.out_error[i]))
+            if ret != 0:
+                raise ValueError('batch writes or reads outside of RAM')
+            return (instrs, pcs, regs, errors, bytes(mem))
+        finally:
+            if b.out_error != NULL:
+                for i in range(n):
+                    free(b.out_error[i])
+            free(b.writes)
+            free(b.first_write)
+            free(b.read_addr)
+            free(b.read_len)
+            free(b.out_error)
+
+    # Returns False if addr can't have a breakpoint (isn't in RAM)
+    def set_breakpoint(self, long long addr, bint on=True):
+        return bool(_set_breakpoint(<long>self.cpu, u32(addr), on))
+
+    def clear_breakpoints(self):
+        _clear_breakpoints(<long>self.cpu)
+
+    def halt(self):
+        _halt_cpu(<long>self.cpu)
+
+    def resume(self):
+        _resume_cpu(<long>self.cpu)
+
+    def interrupt(self):
+        _interrupt_cpu(<long>self.cpu)
+
+    def get_clobbered(self):
+        return _get_clobbered(<long>self.cpu)
+
+    def get_error(self):
+        err = _get_error(<long>self.cpu)
+        if err is None:
+            return ''
+        return err
+
+
+# Runs each of cpus (CPU objects, all different) to a halt or limit
+# instructions, on up to threads OS threads with the GIL released (see
+# _run_parallel()). Returns an array of what run_until_halted() would have
+# returned for each.
+def run_parallel(cpus, int limit=-1, int threads=0):
+    cdef int i
+    cdef int n = len(cpus)
+    cdef array out = clone(array('i'), n, False)
+    cdef long *handles
+
+    if threads <= 0:
+        threads = os.cpu_count() or 1
+    if len(set([id(c) for c in cpus])) != n:
+        raise ValueError('run_parallel() needs different cpus')
+    handles = <long *>malloc(sizeof(long) * max(n, 1))
+    if handles == NULL:
+        raise MemoryError()
+    try:
+        for i in range(n):
+            handles[i] = <long>(<CPU?>cpus[i]).cpu
+        with nogil:
+            _run_parallel(handles, n, limit, out.data.as_ints, threads)
+    finally:
+        free(handles)
+    return out
+
 
-def py_new_nios2(mem: bytes):
-    return _new_nios2(mem, len(mem))
+cdef class MemView:
+    """Exports part of a cpu's RAM through the buffer protocol (see
+    CPU.view())"""
+    cdef object cpu     # keeps the RAM mapped
+    cdef const unsigned char *buf
+    cdef Py_ssize_t len
 
-def py_del_nios2(cpu: long):
-    return _del_nios2(cpu)
+    def __init__(self):
+        raise TypeError('MemViews are made by CPU.view()')
 
-def py_print_mem(cpu: long) -> None:
-    _print_mem(cpu)
+    def __getbuffer__(self, Py_buffer *view, int flags):
+        PyBuffer_FillInfo(view, self, <void *>self.buf, self.len, 1, flags)
 
+    def __releasebuffer__(self, Py_buffer *view):
+        pass
 
-def py_loadword(cpu: long, addr: long) -> long:
-    return _loadword(cpu, addr)
 
-def py_storeword(cpu: long, addr: long, val: long):
-    return _storeword(cpu, addr, val)
+cdef class Device:
+    """A device simulated in the C core (see CPU.add_reg() etc.), so accessing
+    it doesn't call back into Python. Its state is read back after a run.
+    Once something else is mapped over it, or the cpu is reset with
+    clear_mmio, the handle raises ValueError."""
+    cdef device *dev
+    cdef object cpu     # the C cpu owns the device, keep it alive
 
+    def __init__(self):
+        raise TypeError('Devices are made by CPU.add_*()')
 
-def py_add_mmio(cpu: long, addr: long, cb: object):
-    _add_mmio(cpu, addr, cb)
+    def __dealloc__(self):
+        if self.dev != NULL:
+            _device_unref(<long>self.dev)
 
-def py_one_step(cpu: long) -> None:
-    _one_step(cpu)
+    # The device, if the cpu still has it
+    cdef long attached(self):
+        if not _device_attached(<long>self.dev):
+            raise ValueError('Device was removed from the cpu')
+        return <long>self.dev
 
-def py_run_until_halted(cpu: long, limit: long):
-    return _run_until_halted(cpu, limit)
+    cpdef uint32_t load(self):
+        return _device_get(self.attached())
+    cpdef store(self, long long val):
+        _device_set(self.attached(), u32(val))
+    def log(self):
+        return _device_log(self.attached())
+    def push(self, bytes data):
+        return _fifo_push(self.attached(), data, len(data))
+    def read(self):
+        return _fifo_read(self.attached())
 
 
-def py_set_pc(cpu: long, val: long):
-    _set_pc(cpu, val)
-def py_get_pc(cpu: long):
-    return _get_pc(cpu)
+cdef class JtagUart(Device):
+    """DE10 JTAG UART simulated in the C core (see CPU.add_jtag_uart())"""
 
-def py_set_reg(cpu: long, reg: long, val: long):
-    _set_reg(cpu, reg, val)
-def py_get_reg(cpu: long, reg: long):
-    return _get_reg(cpu, reg)
-def py_set_ctl_reg(cpu: long, reg: long, val: long):
-    _set_ctl_reg(cpu, reg, val)
-def py_get_ctl_reg(cpu: long, reg: long):
-    return _get_ctl_reg(cpu, reg)
-def py_get_error(cpu: long):
-    return _get_error(cpu)
-def py_halt_cpu(cpu: long):
-    _halt_cpu(cpu)
-def py_interrupt(cpu: long):
-    _interrupt_cpu(cpu)
-def py_get_clobbered(cpu: long):
-    return _get_clobbered(cpu)
+    # Queue bytes for the program to read
+    def send(self, bytes data):
+        _uart_send(self.attached(), data, len(data))
+    # Bytes the program wrote, with what's left in the tx FIFO if flush
+    def received(self, bint flush=True):
+        return _uart_received(self.attached(), flush)
+    def rx_fifo(self):
+        return _uart_fifo(self.attached(), False)
+    def tx_fifo(self):
+        return _uart_fifo(self.attached(), True)
+    # Bytes written while the tx FIFO was full
+    def dropped(self):
+        return _uart_dropped(self.attached())
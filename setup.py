@@ -5,9 +5,10 @@ from Cython.Build import cythonize
 nios2_extension = Extension(
     name="pynios2",
     sources=["nios2.pyx"],
-    libraries=["nios2"],
+    libraries=["nios2", "pthread"],
     library_dirs=["lib"],
-    include_dirs=["lib"]
+    include_dirs=["lib"],
+    depends=["lib/libnios2.a", "lib/nios2.h"]
 )
 setup(name="pynios2",
       ext_modules=cythonize([nios2_extension]))
@@ -3,6 +3,12 @@ import numpy as np
 import struct
 import sys
 
+RAM_SIZE = 64*1024*1024
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+MEM_FILL = b'\xaa'
+
 class Nios2(object):
 
     class MMIO_Reg(object):
@@ -17,12 +23,13 @@ class Nios2(object):
                 return self.load()
             self.store(val)
 
+    # obj is a program image (image.Image), as nios2_as() returns
     def __init__(self, init_mem=b'', start_pc=0, obj=None):
         if obj is not None:
             self.obj = obj
-            self.symbols = obj['symbols']
-            init_mem = flip_word_endian(bytes.fromhex(obj['prog']))
-            start_pc = obj['symbols']['_start']
+            self.symbols = obj.symbols
+            init_mem = obj.flat()
+            start_pc = obj.symbols['_start']
 
         self.init_mem = init_mem
         self.init_pc = start_pc
@@ -39,7 +46,9 @@ class Nios2(object):
         self.error = ''
         self.regs = [np.uint32(0)]*32
         self.pc = np.uint32(self.init_pc)
-        self.mem = bytearray(self.init_mem + (64*1024*1024 - len(self.init_mem))*b'\xaa')
+        # Guest RAM is sparse: pages are materialized on first write, and
+        # unwritten pages read back as the fill pattern
+        self.pages = {}
         self.ctls_regs = [np.uint32(0)]*32
         self.halted = False
 
@@ -67,41 +76,63 @@ class Nios2(object):
     ########################
     # Loads and stores
     ########################
+    def page(self, addr):
+        # Returns the (writable) page containing addr, creating it if needed
+        pn = addr >> PAGE_SHIFT
+        pg = self.pages.get(pn)
+        if pg is None:
+            base = pn << PAGE_SHIFT
+            init = self.init_mem[base:base+PAGE_SIZE]
+            pg = bytearray(init + (PAGE_SIZE - len(init))*MEM_FILL)
+            self.pages[pn] = pg
+        return pg
+
+    def read_mem(self, addr, n):
+        # n bytes starting at addr, never crossing a page boundary
+        pg = self.pages.get(addr >> PAGE_SHIFT)
+        off = addr & PAGE_MASK
+        if pg is None:
+            init = self.init_mem[addr:addr+n]
+            return init + (n - len(init))*MEM_FILL
+        return pg[off:off+n]
+
     def loadword(self, addr):
         # Word align
         addr = addr & 0xfffffffc
-        if addr > len(self.mem):
+        if addr >= RAM_SIZE:
             # check mmio
             if addr in self.mmios:
                 return np.uint32(self.mmios[addr]())
 
-        word, = struct.unpack('<I', self.mem[addr:addr+4])
+        word, = struct.unpack('<I', self.read_mem(addr, 4))
         return np.uint32(word)
 
     def loadhalfword(self, addr):
         addr = addr & 0xfffffffe
-        hw, = struct.unpack('<H', self.mem[addr:addr+2])
+        hw, = struct.unpack('<H', self.read_mem(addr, 2))
         return np.uint16(hw)
 
     def loadbyte(self, addr):
-        by, = struct.unpack('<B', self.mem[addr:addr+1])
+        by, = struct.unpack('<B', self.read_mem(addr, 1))
         return np.uint8(by)
 
     def storeword(self, addr, val):
         # Word align
         addr = addr & 0xfffffffc
-        if addr > len(self.mem):
+        if addr >= RAM_SIZE:
             if addr in self.mmios:
                 self.mmios[addr](val)
                 return
-        self.mem[addr:addr+4] = bytearray(struct.pack('<I', val))
+        off = addr & PAGE_MASK
+        self.page(addr)[off:off+4] = struct.pack('<I', val)
 
     def storehalfword(self, addr, val):
         addr = addr & 0xfffffffe
-        self.mem[addr:addr+2] = bytearray(struct.pack('<H', val))
+        off = addr & PAGE_MASK
+        self.page(addr)[off:off+2] = struct.pack('<H', val)
 
     def storebyte(self, addr, val):
-        self.mem[addr] = val
+        self.page(addr)[addr & PAGE_MASK] = val
 
 
     ########################
@@ -613,7 +644,7 @@ class Nios2(object):
             if (addr & 0xf) == 0:
                 out += '\n0x%08x: ' % addr
 
-            word, = struct.unpack('<I', self.mem[addr:addr+4])
+            word, = struct.unpack('<I', self.read_mem(addr, 4))
             out += '%08x  ' % word
         out += '\n'
         return out
@@ -638,11 +669,7 @@ class Nios2(object):
 
 
 def flip_word_endian(s):
-    out = b''
-    for i in range(len(s)>>2):
-        word, = struct.unpack('>I', s[4*i:4*i+4])
-        out += struct.pack('<I', word)
-    return out
+    return np.frombuffer(s[:len(s) & ~3], dtype='>u4').astype('<u4').tobytes()
 
 
 '''
@@ -697,15 +724,14 @@ if __name__ == '__main__':
     start_pc = 0
     obj = None
     if len(sys.argv) > 1:
-        import json
-        test_prog = sys.argv[1]
-        obj = json.loads(test_prog)
+        import image
+        obj = image.load(sys.argv[1])
 
     cpu = None
     if obj is not None:
         cpu = Nios2(obj=obj)
     else:
-        cpu = Nios2(init_mem=flip_word_endian(test_prog), start_pc=start_pc)
+        cpu = Nios2(init_mem=flip_word_endian(bytes.fromhex(test_prog)), start_pc=start_pc)
     print(cpu.dump_mem(0x00, 0x100))
 
     inst = 0
@@ -0,0 +1,38 @@
+
+import time
+import functools
+import threading
+
+# Where grading spends its time: functions decorated with @timed(stage)
+# add how long they took to that stage, for the thread that called
+# start(). Calls made from inside a timed function only count once, for
+# the outermost one.
+
+local = threading.local()
+
+# Starts counting, from zero, in this thread
+def start():
+    local.times = {}
+    local.active = None
+
+# Stops counting and returns {stage: seconds}
+def stop():
+    times = getattr(local, 'times', None)
+    local.times = None
+    return times or {}
+
+def timed(stage):
+    def wrap(f):
+        @functools.wraps(f)
+        def timed_f(*args, **kwargs):
+            if getattr(local, 'times', None) is None or local.active is not None:
+                return f(*args, **kwargs)
+            local.active = stage
+            t = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                local.active = None
+                local.times[stage] = local.times.get(stage, 0) + time.perf_counter() - t
+        return timed_f
+    return wrap
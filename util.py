@@ -1,72 +1,256 @@
 
 import tempfile
 import subprocess
-import json
-from collections import defaultdict
+import shutil
+from collections import defaultdict, OrderedDict
 import struct
+import os
+import sys
+import json
+import hashlib
+import threading
+from elf import read_elf, elf_to_image, ElfError
+import image
+import assembler
+from timing import timed
+
+TOOLS = ['bin/nios2-elf-as', 'bin/nios2-elf-ld']
+LINKER_SCRIPT = 'de10.ld'
+OBJ_VERSION = 4     # bump when what nios2_as() returns changes
+
+# Which assembler nios2_as() uses: 'auto' tries the one in assembler.py and
+# falls back to binutils for anything it doesn't handle, 'binutils' always
+# runs the real tools, and 'check' runs both and reports any difference on
+# stderr (going with binutils).
+AS_BACKEND = os.environ.get('NIOS2_AS_BACKEND', 'auto')
+
+
+# An in-memory LRU of up to size entries, backed by one file per entry
+# under path (if given) that survives restarts. Keys are hex digests;
+# subclasses say how values are stored on disk (encode()/decode(), JSON by
+# default).
+class Cache(object):
+    def __init__(self, size=1024, path=None):
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, val):
+        return json.dumps(val).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'))
+
+    def file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    # Returns (found, result)
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return (True, self.entries[key])
+        if self.path is not None:
+            try:
+                with open(self.file(key), 'rb') as f:
+                    val = self.decode(f.read())
+                self.remember(key, val)
+                with self.lock:
+                    self.hits += 1
+                return (True, val)
+            except (OSError, ValueError):
+                pass
+        with self.lock:
+            self.misses += 1
+        return (False, None)
+
+    def put(self, key, val):
+        self.remember(key, val)
+        if self.path is not None:
+            fn = self.file(key)
+            try:
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                tmp = '%s.%d.%d' % (fn, os.getpid(), threading.get_ident())
+                with open(tmp, 'wb') as f:
+                    f.write(self.encode(val))
+                os.replace(tmp, fn)
+            except OSError:
+                pass
+
+    def remember(self, key, val):
+        with self.lock:
+            self.entries[key] = val
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Results of nios2_as(), errors included, keyed by a hash of the source and
+# the toolchain. Entries are the program image as bytes (see image.py), or
+# the error string.
+class AsCache(Cache):
+    def __init__(self, size=1024, path=None):
+        super().__init__(size, path)
+        self.toolchain = None
+
+    # What the tools are: assembling the same source with a different
+    # assembler, linker script or loader mustn't hit
+    def toolchain_id(self):
+        if self.toolchain is None:
+            h = hashlib.sha256(b'%d' % OBJ_VERSION)
+            for t in TOOLS:
+                try:
+                    st = os.stat(t)
+                    h.update(('%s %d %d\n' % (t, st.st_size, st.st_mtime_ns)).encode())
+                except OSError:
+                    h.update(('%s missing\n' % t).encode())
+            for fn in (LINKER_SCRIPT, assembler.__file__):
+                with open(fn, 'rb') as f:
+                    h.update(f.read())
+            self.toolchain = h.hexdigest()
+        return self.toolchain
+
+    def key(self, asm):
+        return hashlib.sha256(self.toolchain_id().encode() + b'\0' + asm).hexdigest()
+
+    # Tagged with what it is
+    def encode(self, val):
+        if isinstance(val, bytes):
+            return b'I' + val
+        return b'E' + val.encode('utf-8')
+
+    def decode(self, data):
+        if data[:1] == b'I':
+            return data[1:]
+        elif data[:1] == b'E':
+            return data[1:].decode('utf-8')
+        raise ValueError('Bad cache entry')
+
+as_cache = AsCache(size=int(os.environ.get('NIOS2_AS_CACHE_SIZE', 1024)),
+                   path=os.environ.get('NIOS2_AS_CACHE_DIR'))
+
 
+# Assembles and links asm (bytes). Returns the program image (see
+# image.Image), or an error string. Results come from as_cache when
+# the same source has been seen before.
+@timed('assemble')
 def nios2_as(asm):
-    asm_f = tempfile.NamedTemporaryFile()
-    asm_f.write(asm)
-    asm_f.flush()
-
-    obj_f = tempfile.NamedTemporaryFile()
-
-    ########## Assemble
-    p = subprocess.Popen(['bin/nios2-elf-as', \
-                          asm_f.name, \
-                          '-o', obj_f.name],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if p.wait() != 0:
-        ret = 'Assembler error: %s' % p.stderr.read()
+    return cached_as(asm, lambda: nios2_as_uncached(asm))
+
+# The cached result for asm, or what assemble() returns for it
+def cached_as(asm, assemble):
+    key = as_cache.key(asm)
+    found, val = as_cache.get(key)
+    if not found:
         try:
-            obj_f.close()
-            asm_f.close()
-            p.stdout.close()
-            p.stderr.close()
-        except:
-            pass
-        return ret
-
-    asm_f.close()
-    p.stdout.close()
-    p.stderr.close()
-
-
-    ######### Link
-    exe_f = tempfile.NamedTemporaryFile()
-    p = subprocess.Popen(['bin/nios2-elf-ld', \
-                          '-T', 'de10.ld', \
-                          obj_f.name, '-o', exe_f.name],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE) 
-    if p.wait() != 0:
-        ret = 'Linker error: %s' % p.stderr.read()
-        p.stderr.close()
-        p.stdout.close()
-        obj_f.close()
-        return ret
-
-    obj_f.close()
-    p.stdout.close()
-    p.stderr.close()
-
-    ######## objdump
-    p = subprocess.Popen(['./gethex.sh', exe_f.name], \
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if p.wait() != 0:
-        ret = 'Objdump error: %s' % p.stderr.read()
-        p.stderr.close()
-        p.stdout.close()
-        exe_f.close()
-        return ret
-
-    obj = json.loads(p.stdout.read().decode('ascii'))
-    p.stdout.close()
-    p.stderr.close()
-    exe_f.close()
+            val = assemble()
+        except ToolTimeout as e:
+            # Might go through next time, don't cache it
+            return 'Error: %s' % e
+        if isinstance(val, image.Image):
+            val = val.to_bytes()
+        as_cache.put(key, val)
+    # A new Image each time: callers are free to change what they get
+    if isinstance(val, bytes):
+        return image.from_bytes(val)
+    return val
+
+
+# The assembly a checker pastes in front of each submission (a harness
+# with _start, the functions it calls...), read once when the exercise is
+# defined. harness.assemble(asm) returns the same as nios2_as(harness +
+# asm), but only asm is read each time, then linked with the harness in
+# process. Sources assembler.py leaves to binutils are assembled whole.
+class Harness(object):
+    def __init__(self, asm):
+        self.asm = asm
+        try:
+            self.prefix = assembler.Prefix(asm.encode('utf-8'))
+        except assembler.Unsupported:
+            self.prefix = None
+
+    @timed('assemble')
+    def assemble(self, asm):
+        full = (self.asm + asm).encode('utf-8')
+        if self.prefix is None or AS_BACKEND != 'auto':
+            return nios2_as(full)
+        return cached_as(full, lambda: self.assemble_uncached(asm, full))
+
+    def assemble_uncached(self, asm, full):
+        try:
+            return self.prefix.assemble(asm.encode('utf-8'))
+        except assembler.Unsupported:
+            return nios2_as_uncached(full)
+
+
+# Intermediate files go in RAM when we can, they only live for one call
+WORK_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+AS_TIMEOUT = 10     # seconds, per tool
+LD_TIMEOUT = 10
 
+class ToolTimeout(Exception):
+    pass
+
+def run_tool(args, timeout, input=None):
+    try:
+        return subprocess.run(args, input=input, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise ToolTimeout('%s timed out after %g seconds' % (os.path.basename(args[0]), timeout))
+
+# Assembles and links asm without the cache, in Python when it can (see
+# AS_BACKEND)
+def nios2_as_uncached(asm):
+    if AS_BACKEND == 'binutils':
+        return binutils_as(asm)
+    try:
+        obj = assembler.assemble(asm)
+    except assembler.Unsupported:
+        return binutils_as(asm)
+    if AS_BACKEND == 'check':
+        ref = binutils_as(asm)
+        if obj != ref:
+            sys.stderr.write('nios2_as: assembler.py and binutils differ on:\n%s\n'
+                             % asm.decode('utf-8', 'replace'))
+        return ref
     return obj
 
+# Assembles and links asm with binutils. The source goes to the assembler
+# on stdin, and the object and executable are written to a private
+# directory in WORK_DIR (tmpfs). Raises ToolTimeout if a tool takes too
+# long.
+def binutils_as(asm):
+    work = tempfile.mkdtemp(prefix='nios2-as-', dir=WORK_DIR)
+    try:
+        obj_fn = os.path.join(work, 'prog.o')
+        exe_fn = os.path.join(work, 'prog.elf')
+
+        ########## Assemble
+        p = run_tool(['bin/nios2-elf-as', '-o', obj_fn, '--'], AS_TIMEOUT, input=asm)
+        if p.returncode != 0:
+            return 'Assembler error: %s' % p.stderr
+
+        ######### Link
+        p = run_tool(['bin/nios2-elf-ld', '-T', LINKER_SCRIPT, obj_fn, '-o', exe_fn], LD_TIMEOUT)
+        if p.returncode != 0:
+            return 'Linker error: %s' % p.stderr
+
+        ######## Load
+        try:
+            return elf_to_image(read_elf(exe_fn))
+        except ElfError as e:
+            return 'ELF error: %s' % e
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
 def get_clobbered(cpu):
     feedback = ''
     for addr,rid,interrupt in cpu.get_clobbered():
@@ -93,21 +277,32 @@ def get_debug(cpu, mem_len=0x100, show_stack=False):
         out += '\n</pre>'
     return out
 
+# Assembles new_start_asm after obj's whole image (as data in .text, with
+# its labels), e.g. to call a student's function from a _start of our own.
+# This is done in process when assembler.py can, otherwise the image goes
+# back through nios2_as() as .word lines.
+@timed('assemble')
 def hotpatch(obj, new_start_asm):
+    if AS_BACKEND == 'auto':
+        try:
+            return assembler.image_prefix(obj).assemble(new_start_asm.encode('utf-8'))
+        except assembler.Unsupported:
+            pass
+
     hp = '.text\n'
     # fill symbols
     rev_map = defaultdict(list) # addr => [list_of_symbols]
     # TODO: this will only work for word-aligned labels...
-    for s,addr in obj['symbols'].items():
+    for s,addr in obj.symbols.items():
         #hp += '.equ %s, 0x%08x\n' % (s, addr)
         if s != '_start':
             rev_map[addr].append(s)
 
     # fill bytes
-    p = bytes.fromhex(obj['prog'])
+    p = obj.flat()
     for i in range(len(p)>>2):
         addr = 4*i
-        word, = struct.unpack('>I', p[4*i:4*i+4])
+        word, = struct.unpack('<I', p[4*i:4*i+4])
         for sym in rev_map[addr]:
             hp += '%s:\n' % sym
         hp += ' .word 0x%08x\n' % (word)
@@ -115,11 +310,11 @@ def hotpatch(obj, new_start_asm):
     return nios2_as(hp.encode('utf-8'))
 
 def require_symbols(obj, symbols):
-    if not(isinstance(obj, dict)):
+    if not(isinstance(obj, image.Image)):
         return str(obj)
-    #if '_start' not in obj['symbols']:
+    #if '_start' not in obj.symbols:
     for s in symbols:
-        if s not in obj['symbols']:
+        if s not in obj.symbols:
             return '%s not found in memory (did you enter any instructions?)' % (s)
     return None
 